@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-18 00:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Account', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='gender',
+            field=models.CharField(blank=True, choices=[('M', 'Male'), ('F', 'Female')], max_length=1, null=True, verbose_name='Gender'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='location',
+            field=models.CharField(blank=True, max_length=30, null=True, verbose_name='Location'),
+        ),
+    ]
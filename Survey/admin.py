@@ -1,8 +1,12 @@
 from django.contrib import admin
+from django.db import transaction
 from django.utils.html import format_html
 from .models import Survey, Question, Response, Answer
 from django.conf import settings
 from .config import ANSWER_FILE_PATH_KEY
+from .rollups import RollupDelta
+from .deletion import delete_answers, delete_responses, release_answer_files
+from .facts import delete_answer_facts
 
 class QuestionInline(admin.TabularInline):
     model = Question
@@ -72,6 +76,35 @@ class ResponseAdmin(admin.ModelAdmin):
         return obj.answers.count()
     answer_count.short_description = 'Number of Answers'
 
+    # keep the question rollups up to date with answers deleted from the admin
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            rollup_delta = RollupDelta()
+            rollup_delta.remove_answers(obj.answers.select_related('question'))
+            delete_responses(Response.objects.filter(pk=obj.pk))
+            rollup_delta.apply()
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            rollup_delta = RollupDelta()
+            rollup_delta.remove_answers(Answer.objects.filter(response__in=queryset).select_related('question'))
+            delete_responses(queryset)
+            rollup_delta.apply()
+
+    def save_formset(self, request, form, formset, change):
+        rollup_delta = RollupDelta()
+        if formset.model is Answer:
+            deleted_answers = [deleted_form.instance for deleted_form in formset.deleted_forms if deleted_form.instance.pk]
+            rollup_delta.remove_answers(deleted_answers)
+            if deleted_answers:
+                # deleted by the formset one by one, their files and facts are released here
+                deleted_queryset = Answer.objects.filter(pk__in=[answer.pk for answer in deleted_answers])
+                release_answer_files(deleted_queryset)
+                delete_answer_facts(deleted_queryset)
+                Survey.bump_data_version(pk=form.instance.survey_id)
+        super().save_formset(request, form, formset, change)
+        rollup_delta.apply()
+
 @admin.register(Answer)
 class AnswerAdmin(admin.ModelAdmin):
     list_display = ('id', 'get_question_text', 'get_response_info', 'formatted_value')
@@ -87,6 +120,30 @@ class AnswerAdmin(admin.ModelAdmin):
         return f"Response #{obj.response.id} - {obj.response.survey.title}"
     get_response_info.short_description = 'Response'
 
+    # keep the question rollups up to date with answers changed from the admin
+    def save_model(self, request, obj, form, change):
+        rollup_delta = RollupDelta()
+        if change:
+            previous = Answer.objects.select_related('question').get(pk=obj.pk)
+            rollup_delta.remove(previous.question, previous.value)
+        super().save_model(request, obj, form, change)
+        rollup_delta.add(obj.question, obj.value)
+        rollup_delta.apply()
+
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            rollup_delta = RollupDelta()
+            rollup_delta.remove(obj.question, obj.value)
+            delete_answers(Answer.objects.filter(pk=obj.pk))
+            rollup_delta.apply()
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            rollup_delta = RollupDelta()
+            rollup_delta.remove_answers(queryset.select_related('question'))
+            delete_answers(queryset)
+            rollup_delta.apply()
+
     def formatted_value(self, obj):
         if obj.question.question_type == 'file' and obj.value and obj.value.get(ANSWER_FILE_PATH_KEY):
             # return format_html('<a href="{}" target="_blank">View File</a>', obj.value['file_path'])
@@ -0,0 +1,275 @@
+"""
+Benchmarks of the survey analytics on synthetic datasets.
+
+Each scale is a closed synthetic survey with that many responses, generated by
+synthetic.py from a fixed seed so that two commits are timed on the same data.
+The cases are the statistics action with each of its options alone, with a filter
+expression and all together, the general correlation, the pattern recognition by
+demographic, the trends by period and the PDF export, on two paths: from the
+answer matrix of the survey ("matrix", materialized before the cases are timed,
+its build timed on its own) and from the database with the matrix disabled
+("queryset"). The response by response paths are only run up to `scan_limit`
+responses.
+
+A case runs once to warm up, counting its queries, then `repeat` timed times. The
+results are JSON, two result files are compared with compare_results.
+"""
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+
+import django
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from django.http import QueryDict
+from django.test.utils import override_settings
+
+from .bitmaps import BitmapIndex
+from .cache import normalize_statistics_params
+from .deletion import delete_survey_in_batches
+from .matrix import build_answer_matrix, get_answer_matrix
+from .models import Question
+from .services import _calculate_general_correlation
+from .synthetic import DEFAULT_QUESTION_COUNTS, generate_dataset
+from .views import SurveyResponseManagementView, SurveyViewSet
+
+DEFAULT_SCALES = [1000, 10000, 100000]
+DEFAULT_REPEAT = 5
+# largest survey the queryset path and the PDF export are run on
+DEFAULT_SCAN_LIMIT = 1000
+PATHS = ['matrix', 'queryset']
+BENCHMARKS = [
+    'answer_matrix', 'bitmap_index', 'statistics', 'general_correlation',
+    'recognize_patterns', 'calculate_trends', 'generate_pdf',
+]
+GROUP_BY = ['respondent__gender', 'respondent__location', 'respondent__date_of_birth']
+TREND_PERIODS = ['day', 'week', 'month', 'quarter']
+# one file question, for the exports
+QUESTION_COUNTS = {**DEFAULT_QUESTION_COUNTS, Question.QUESTION_TYPES.FILE: 1}
+
+
+def _statistics_options(survey):
+    """The query parameters of each option of the statistics action, and a filter expression"""
+    questions = list(survey.questions.order_by('order'))
+    ratings = [question for question in questions if question.question_type == Question.QUESTION_TYPES.RATING]
+    singles = [question for question in questions if question.question_type == Question.QUESTION_TYPES.SINGLE]
+    multiples = [question for question in questions if question.question_type == Question.QUESTION_TYPES.MULTIPLE]
+    options = {
+        'filter': {'filter_question': [str(singles[0].id)], 'filter_value': [singles[0].settings['options'][0]]},
+        'correlate': {'correlate': [str(ratings[0].id), str(singles[0].id)]},
+        'general_correlation': {'general_correlation': ['true']},
+        'group_by': {'group_by': ['respondent__gender']},
+        'trend_period': {'trend_period': ['week']},
+    }
+    filters = {'or': [
+        {'and': [
+            {'question': singles[0].id, 'value': singles[0].settings['options'][0]},
+            {'not': {'question': ratings[0].id, 'value': 1}},
+        ]},
+        {'question': multiples[0].id, 'value': multiples[0].settings['options'][1]},
+    ]}
+    return options, {'filters': [json.dumps(filters)]}
+
+
+def _query_params(*parts):
+    query_params = QueryDict(mutable=True)
+    for part in parts:
+        for key, values in part.items():
+            query_params.setlist(key, values)
+    return normalize_statistics_params(query_params)
+
+
+def _statistics_cases(survey):
+    options, filters = _statistics_options(survey)
+    variants = {'plain': _query_params()}
+    for name, option in options.items():
+        variants[name] = _query_params(option)
+    variants['filters'] = _query_params(filters)
+    for name, option in options.items():
+        if name != 'filter':
+            variants[f'{name}+filters'] = _query_params(option, filters)
+    variants['all'] = _query_params(*options.values(), filters)
+
+    view = SurveyViewSet()
+    for variant, params in variants.items():
+        yield variant, (lambda params=params: view._compute_statistics(survey, params))
+
+
+def _with_matrix(survey, compute):
+    """Call compute(responses, matrix, rows) as the statistics action does"""
+    matrix = get_answer_matrix(survey)
+    rows = matrix.all_rows() if matrix is not None else None
+    return compute(survey.responses.all(), matrix, rows)
+
+
+def _cases(benchmark, survey):
+    """(variant, callable) of the cases of the benchmark on the survey"""
+    if benchmark == 'answer_matrix':
+        yield 'build', lambda: build_answer_matrix(survey)
+    elif benchmark == 'bitmap_index':
+        matrix = get_answer_matrix(survey)
+        yield 'build', lambda: BitmapIndex.build(matrix)
+    elif benchmark == 'statistics':
+        yield from _statistics_cases(survey)
+    elif benchmark == 'general_correlation':
+        yield 'all', lambda: _with_matrix(
+            survey, lambda responses, matrix, rows: _calculate_general_correlation(survey, responses, matrix, rows)
+        )
+    elif benchmark == 'recognize_patterns':
+        view = SurveyViewSet()
+        for group_by in GROUP_BY:
+            yield group_by, lambda group_by=group_by: _with_matrix(
+                survey, lambda responses, matrix, rows: view._recognize_patterns(survey, responses, group_by, matrix, rows)
+            )
+    elif benchmark == 'calculate_trends':
+        view = SurveyViewSet()
+        for period in TREND_PERIODS:
+            yield period, lambda period=period: _with_matrix(
+                survey, lambda responses, matrix, rows: view._calculate_trends(responses, period, matrix, rows)
+            )
+    elif benchmark == 'generate_pdf':
+        view = SurveyResponseManagementView()
+        for include_stats in (False, True):
+            yield 'stats' if include_stats else 'plain', lambda include_stats=include_stats: view._generate_pdf(
+                survey, survey.responses.all(), include_stats
+            )
+
+
+def _paths(benchmark, scale, paths, scan_limit):
+    for path in paths:
+        if benchmark in ('answer_matrix', 'bitmap_index') and path != 'matrix':
+            continue
+        # the PDF export reads the responses whatever the path
+        if benchmark == 'generate_pdf' and path != 'queryset':
+            continue
+        if (path == 'queryset' or benchmark == 'generate_pdf') and scale > scan_limit:
+            continue
+        yield path
+
+
+class QueryCounter:
+    """Database execute wrapper counting the queries"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def time_case(function, repeat):
+    """Timings of a warm up run, counting its queries, and of `repeat` runs"""
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries):
+        started = time.perf_counter()
+        function()
+        first = time.perf_counter() - started
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return {
+        'first': first,
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.fmean(timings),
+        'runs': repeat,
+        'queries': queries.count,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(
+        scales=DEFAULT_SCALES, benchmarks=BENCHMARKS, paths=PATHS, repeat=DEFAULT_REPEAT,
+        scan_limit=DEFAULT_SCAN_LIMIT, seed=0, keep=False, log=None):
+    """
+    Generate a synthetic survey of each scale, time the cases of the benchmarks on it and
+    delete it unless `keep`. Returns the JSON-serializable results, `log` is called with
+    a line of progress.
+    """
+    log = log or (lambda line: None)
+    results = []
+    for scale in scales:
+        started = time.monotonic()
+        survey, = generate_dataset(
+            seed, responses=scale, respondents=max(1, scale // 5), question_counts=QUESTION_COUNTS
+        )
+        log(f'{scale} responses: generated survey {survey.id} in {time.monotonic() - started:.1f}s')
+        try:
+            # materialized once, like the first statistics request on a closed survey
+            get_answer_matrix(survey)
+            for benchmark in benchmarks:
+                for path in _paths(benchmark, scale, paths, scan_limit):
+                    with override_settings(SURVEY_ANSWER_MATRIX_ENABLED=path == 'matrix'):
+                        for variant, function in _cases(benchmark, survey):
+                            timing = time_case(function, repeat)
+                            results.append({
+                                'benchmark': benchmark, 'variant': variant, 'path': path, 'scale': scale, **timing,
+                            })
+                            log(
+                                f"{scale} responses: {benchmark} {variant} ({path}) "
+                                f"median {timing['median'] * 1000:.2f} ms, {timing['queries']} queries"
+                            )
+        finally:
+            if not keep:
+                for _ in delete_survey_in_batches(survey):
+                    pass
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'seed': seed,
+            'scales': list(scales),
+            'repeat': repeat,
+            'scan_limit': scan_limit,
+            'database': connection.vendor,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'numpy': np.__version__,
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+
+
+def result_key(result):
+    return result['benchmark'], result['variant'], result['path'], result['scale']
+
+
+def compare_results(baseline, current):
+    """
+    The cases of both result files with their median timings and the ratio of the
+    current one to the baseline one, above 1 when it got slower
+    """
+    baseline_results = {result_key(result): result for result in baseline['results']}
+    comparison = []
+    for result in current['results']:
+        base = baseline_results.get(result_key(result))
+        if base is None:
+            continue
+        comparison.append({
+            'benchmark': result['benchmark'],
+            'variant': result['variant'],
+            'path': result['path'],
+            'scale': result['scale'],
+            'baseline': base['median'],
+            'current': result['median'],
+            'ratio': result['median'] / base['median'] if base['median'] else None,
+        })
+    return comparison
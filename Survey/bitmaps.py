@@ -0,0 +1,278 @@
+"""
+Inverted bitmap index of the answers of a survey, for multi-condition filtering.
+
+Every option of the choice questions and every rating given to the rating
+questions maps to the set of responses whose answer matches it, as a bitmap of
+response ordinals: the rows of the survey's answer matrix (responses ordered by
+id). A bitmap is kept as packed 64 bit words, or compressed to its sorted
+ordinals when fewer than one response in 32 matches, which is smaller. The
+index of a closed survey is written next to its answer matrix once per data
+version and memory-mapped, so a filter expression over a million responses is
+evaluated with a few word-wise AND/OR/NOT of 16k words.
+
+Filter expressions are JSON:
+
+- `{"question": 3, "value": "A"}` the responses that chose A, or gave the rating
+- `{"and": [expr, ...]}`, `{"or": [expr, ...]}` and `{"not": expr}`
+"""
+import json
+import os
+import shutil
+import uuid
+from functools import reduce
+
+import numpy as np
+
+from .config import MAX_FILTER_CONDITIONS
+from .matrix import MANIFEST_NAME, answer_matrix_directory
+from .models import Question
+from .rollups import rating_key
+
+BITMAP_INDEX_DIR = 'bitmaps'
+INDEX_NAME = 'index.json'
+# nesting accepted in a filter expression
+MAX_FILTER_DEPTH = 8
+
+
+class FilterExpressionError(ValueError):
+    """A filter expression that cannot be parsed"""
+
+
+def parse_filter_expression(value):
+    """Parse and validate a JSON filter expression, in canonical form with the values as strings"""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise FilterExpressionError('filters must be a JSON filter expression')
+    conditions = 0
+
+    def parse(node, depth):
+        nonlocal conditions
+        if depth > MAX_FILTER_DEPTH:
+            raise FilterExpressionError(f'filters cannot be nested more than {MAX_FILTER_DEPTH} levels deep')
+        if not isinstance(node, dict):
+            raise FilterExpressionError('every filter must be an object')
+        if 'question' in node:
+            question_id, condition_value = node.get('question'), node.get('value')
+            if set(node) != {'question', 'value'} or isinstance(question_id, bool) or not isinstance(question_id, int):
+                raise FilterExpressionError('a condition must have an integer `question` and a `value`')
+            if isinstance(condition_value, bool) or not isinstance(condition_value, (str, int, float)):
+                raise FilterExpressionError('the `value` of a condition must be a string or a number')
+            conditions += 1
+            if conditions > MAX_FILTER_CONDITIONS:
+                raise FilterExpressionError(f'filters cannot have more than {MAX_FILTER_CONDITIONS} conditions')
+            return {'question': question_id, 'value': str(condition_value)}
+        if len(node) != 1:
+            raise FilterExpressionError('a filter must be a condition or one of `and`, `or` and `not`')
+        (operator, operand), = node.items()
+        if operator in ('and', 'or'):
+            if not isinstance(operand, list) or not operand:
+                raise FilterExpressionError(f'`{operator}` must be a non empty list of filters')
+            return {operator: [parse(child, depth + 1) for child in operand]}
+        if operator == 'not':
+            return {operator: parse(operand, depth + 1)}
+        raise FilterExpressionError(f'unknown filter operator `{operator}`')
+
+    return parse(value, 0)
+
+
+def expression_question_ids(expression):
+    """The ids of the questions a filter expression has conditions on"""
+    if 'question' in expression:
+        return {expression['question']}
+    operand = next(iter(expression.values()))
+    children = operand if isinstance(operand, list) else [operand]
+    return set().union(*(expression_question_ids(child) for child in children))
+
+
+class Bitmap:
+    """Set of response ordinals, as little endian packed 64 bit words"""
+    __slots__ = ('words', 'size')
+
+    def __init__(self, words, size):
+        self.words = words
+        self.size = size
+
+    @classmethod
+    def from_mask(cls, mask):
+        packed = np.packbits(mask, bitorder='little')
+        packed = np.pad(packed, (0, -len(packed) % 8))
+        return cls(packed.view('<u8'), len(mask))
+
+    @classmethod
+    def from_ordinals(cls, ordinals, size):
+        mask = np.zeros(size, dtype=bool)
+        mask[ordinals] = True
+        return cls.from_mask(mask)
+
+    @classmethod
+    def empty(cls, size):
+        return cls(np.zeros(-(-size // 64), dtype='<u8'), size)
+
+    def __and__(self, other):
+        return Bitmap(self.words & other.words, self.size)
+
+    def __or__(self, other):
+        return Bitmap(self.words | other.words, self.size)
+
+    def __invert__(self):
+        words = ~self.words
+        if self.size % 64:
+            # the padding bits of the last word are not responses
+            words[-1] &= np.uint64((1 << (self.size % 64)) - 1)
+        return Bitmap(words, self.size)
+
+    def __len__(self):
+        return int(np.bitwise_count(self.words).sum())
+
+    def to_mask(self):
+        """Row mask of the answer matrix"""
+        return np.unpackbits(self.words.view(np.uint8), count=self.size, bitorder='little').astype(bool)
+
+
+class BitmapIndex:
+    """
+    Bitmaps of the responses matching each option or rating of the questions, built
+    from an answer matrix. Dense bitmaps are the rows of a 2d array of words, sparse
+    ones slices of the concatenated sorted ordinals.
+    """
+
+    def __init__(self, size, question_types, entries, dense, sparse):
+        self.size = size
+        self.question_types = question_types  # question_id -> question type
+        self.entries = entries  # "<question_id>:<value>" -> ['dense', row] or ['sparse', start, stop]
+        self.dense = dense
+        self.sparse = sparse
+
+    @classmethod
+    def build(cls, matrix):
+        size = len(matrix)
+        question_types = {}
+        entries = {}
+        dense = []
+        sparse = []
+        sparse_length = 0
+
+        def add(key, ordinals):
+            nonlocal sparse_length
+            # 4 bytes per ordinal against size / 8 bytes of words
+            if len(ordinals) * 32 < size:
+                entries[key] = ['sparse', sparse_length, sparse_length + len(ordinals)]
+                sparse.append(ordinals.astype(np.uint32))
+                sparse_length += len(ordinals)
+            else:
+                entries[key] = ['dense', len(dense)]
+                dense.append(Bitmap.from_ordinals(ordinals, size).words)
+
+        for question_id, meta in matrix.questions.items():
+            if not matrix.is_encoded(question_id):
+                continue
+            question_types[question_id] = meta['type']
+            answered = matrix.answered_rows(question_id)
+            if meta['type'] == Question.QUESTION_TYPES.RATING:
+                ratings = matrix.ratings(question_id)
+                known_rows = np.flatnonzero(answered & ~np.isnan(ratings))
+                values, inverse = np.unique(ratings[known_rows], return_inverse=True)
+                # the rows of every rating, in order, without a pass per rating
+                order = np.argsort(inverse, kind='stable')
+                groups = np.split(known_rows[order], np.cumsum(np.bincount(inverse, minlength=len(values)))[:-1])
+                for value, ordinals in zip(values, groups):
+                    add(f"{question_id}:{rating_key(value)}", ordinals)
+            else:
+                selections = matrix.selections(question_id) & answered[:, None]
+                for j, option in enumerate(matrix.options(question_id)):
+                    add(f"{question_id}:{option}", np.flatnonzero(selections[:, j]))
+
+        return cls(
+            size=size,
+            question_types=question_types,
+            entries=entries,
+            dense=np.stack(dense) if dense else np.zeros((0, -(-size // 64)), dtype='<u8'),
+            sparse=np.concatenate(sparse) if sparse else np.zeros(0, dtype=np.uint32),
+        )
+
+    def bitmap(self, question_id, value):
+        """The responses whose answer to the question matches the value, like AnswerMatrix.match_rows"""
+        if self.question_types.get(question_id) == Question.QUESTION_TYPES.RATING:
+            try:
+                value = rating_key(value)
+            except (TypeError, ValueError):
+                return Bitmap.empty(self.size)
+        entry = self.entries.get(f"{question_id}:{value}")
+        if entry is None:
+            return Bitmap.empty(self.size)
+        if entry[0] == 'dense':
+            return Bitmap(np.asarray(self.dense[entry[1]]), self.size)
+        return Bitmap.from_ordinals(np.asarray(self.sparse[entry[1]:entry[2]]), self.size)
+
+    def evaluate(self, expression):
+        """The bitmap of the responses matching a parsed filter expression"""
+        if 'question' in expression:
+            return self.bitmap(expression['question'], expression['value'])
+        if 'not' in expression:
+            return ~self.evaluate(expression['not'])
+        bitmaps = (self.evaluate(child) for child in next(iter(expression.values())))
+        if 'and' in expression:
+            return reduce(lambda left, right: left & right, bitmaps)
+        return reduce(lambda left, right: left | right, bitmaps)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'dense.npy'), self.dense)
+        np.save(os.path.join(directory, 'sparse.npy'), self.sparse)
+        with open(os.path.join(directory, INDEX_NAME), 'w') as index_file:
+            json.dump({
+                'size': self.size,
+                'question_types': [[question_id, question_type] for question_id, question_type in self.question_types.items()],
+                'entries': self.entries,
+            }, index_file)
+
+    @classmethod
+    def load(cls, directory):
+        """Memory-map an index written by save()"""
+        with open(os.path.join(directory, INDEX_NAME)) as index_file:
+            index = json.load(index_file)
+
+        def load_array(name):
+            try:
+                return np.load(os.path.join(directory, name), mmap_mode='r')
+            except ValueError:
+                # empty arrays cannot be memory-mapped
+                return np.load(os.path.join(directory, name))
+
+        return cls(
+            size=index['size'],
+            question_types=dict((question_id, question_type) for question_id, question_type in index['question_types']),
+            entries=index['entries'],
+            dense=load_array('dense.npy'),
+            sparse=load_array('sparse.npy'),
+        )
+
+
+def get_bitmap_index(survey, matrix):
+    """
+    The bitmap index over the rows of the survey's answer matrix. It is written next to
+    the materialized matrix of a closed survey and memory-mapped by later calls, the
+    index of a matrix built in memory is built in memory too.
+    """
+    matrix_directory = answer_matrix_directory(survey, matrix.data_version)
+    if not survey.is_closed or not os.path.exists(os.path.join(matrix_directory, MANIFEST_NAME)):
+        return BitmapIndex.build(matrix)
+
+    directory = os.path.join(matrix_directory, BITMAP_INDEX_DIR)
+    if os.path.exists(os.path.join(directory, INDEX_NAME)):
+        return BitmapIndex.load(directory)
+
+    index = BitmapIndex.build(matrix)
+    # removed with the matrix directory once the data version is stale
+    tmp_directory = f'{directory}.tmp-{uuid.uuid4().hex}'
+    try:
+        index.save(tmp_directory)
+        os.rename(tmp_directory, directory)
+    except OSError:
+        # another worker published the index first, or MEDIA_ROOT is not writable
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        if not os.path.exists(os.path.join(directory, INDEX_NAME)):
+            return index
+    return BitmapIndex.load(directory)
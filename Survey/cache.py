@@ -0,0 +1,121 @@
+"""
+Memoization of a survey's analytics results.
+
+Results are keyed by the survey id, its data version and the normalized query
+parameters they were computed from. Every Response/Answer/Question change bumps
+`Survey.data_version` (see signals.py), so a stale result is never looked up
+again and is simply evicted. So does a change of the gender, location or date of
+birth of a respondent, which the group_by patterns depend on. The age groups
+also depend on the current date, their results are keyed by the day.
+
+Two levels are used:
+
+- a small in-process LRU of the most recently used results
+- the shared `analytics` cache alias so all workers benefit from a computation
+  (configure it with ANALYTICS_CACHE_URL, e.g. a redis instance running with
+  `maxmemory-policy allkeys-lru` for a shared LRU)
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+from .bitmaps import parse_filter_expression
+
+ANALYTICS_CACHE_ALIAS = 'analytics'
+STATISTICS_CACHE_PREFIX = 'survey-statistics'
+# the respondents are grouped by their age of the current day
+AGE_GROUP_BY = 'respondent__date_of_birth'
+
+
+class LRUCache:
+    """
+    Thread safe, size bounded mapping evicting the least recently used entries.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+local_cache = LRUCache(settings.ANALYTICS_CACHE_LOCAL_MAX_ENTRIES)
+
+
+def normalize_statistics_params(query_params):
+    """
+    Canonical form of the statistics query parameters, ignoring the ones
+    that do not change the computed result.
+    """
+    filter_question = query_params.get('filter_question') or None
+    filter_value = query_params.get('filter_value') or None
+    if not (filter_question and filter_value):
+        # the filter is only applied when both are given
+        filter_question = filter_value = None
+    return {
+        # the order matters, it defines the pairs and their keys
+        'correlate': query_params.getlist('correlate'),
+        'general_correlation': query_params.get('general_correlation', 'false').lower() == 'true',
+        'filter_question': filter_question,
+        'filter_value': filter_value,
+        # AND/OR/NOT of conditions, raises FilterExpressionError when invalid
+        'filters': parse_filter_expression(query_params['filters']) if query_params.get('filters') else None,
+        'group_by': query_params.get('group_by') or None,
+        'trend_period': query_params.get('trend_period') or None,
+    }
+
+
+def statistics_cache_key(survey, params):
+    if params['group_by'] == AGE_GROUP_BY:
+        params = {**params, 'today': timezone.now().date().isoformat()}
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+    return f"{STATISTICS_CACHE_PREFIX}:{survey.pk}:{survey.data_version}:{digest}"
+
+
+def get_or_compute_statistics(survey, params, compute):
+    """
+    Return the memoized statistics of the survey for the params, computing
+    (and storing) them with `compute()` on a miss.
+    """
+    if not settings.ANALYTICS_CACHE_ENABLED:
+        return compute()
+
+    key = statistics_cache_key(survey, params)
+    stats = local_cache.get(key)
+    if stats is not None:
+        return stats
+
+    shared_cache = caches[ANALYTICS_CACHE_ALIAS]
+    stats = shared_cache.get(key)
+    if stats is None:
+        stats = compute()
+        shared_cache.set(key, stats)
+    local_cache.set(key, stats)
+    return stats
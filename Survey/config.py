@@ -1,2 +1,22 @@
 QUESTION_ATTACHEMENT_FILE_PATH_KEY = 'attachment_file_path'
-ANSWER_FILE_PATH_KEY = 'file_path'
\ No newline at end of file
+ANSWER_FILE_PATH_KEY = 'file_path'
+ANSWER_MATRIX_DIR = 'analytics'
+LIVE_STATISTICS_KEEPALIVE_SECONDS = 15
+# seconds a live statistics token opens the stream of its survey for, EventSource reconnections past it need a new one
+LIVE_STATISTICS_TOKEN_MAX_AGE = 60
+EXPORT_ARTIFACT_DIR = 'exports'
+# responses submitted at once by the batch endpoint, inserted by chunks each in its own transaction
+RESPONSE_BATCH_MAX_SIZE = 1000
+RESPONSE_BATCH_CHUNK_SIZE = 100
+# surveys whose compiled answer validators are kept in memory by each process
+SURVEY_VALIDATORS_CACHE_SIZE = 256
+# the bodies of chunked uploads and the stored files are read by blocks of UPLOAD_READ_SIZE bytes
+UPLOAD_READ_SIZE = 64 * 1024
+# uploaded files are stored once by content under STORED_FILE_DIR/<2 hex>/<2 hex>/<sha256>.<ext>
+STORED_FILE_DIR = 'files'
+# queued file releases processed per transaction by the deletion worker
+FILE_DELETION_BATCH_SIZE = 500
+# responses deleted per transaction when purging old surveys
+PURGE_BATCH_SIZE = 1000
+# conditions accepted in the filter expression of the statistics
+MAX_FILTER_CONDITIONS = 32
@@ -0,0 +1,129 @@
+"""
+Cached survey definitions, the survey and questions respondents load before answering.
+
+Rendered definitions are stored in the `definitions` cache alias under the survey
+id and its `schema_version`, bumped whenever the survey or one of its questions
+is edited. The current version of each survey is itself kept in the cache and
+published by the edits once committed (see signals.py), so serving a definition,
+or a 304 to a client already holding it, does not query the database.
+"""
+import hashlib
+import json
+
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.response import Response as DRFResponse
+
+from .models import Survey
+
+DEFINITIONS_CACHE_ALIAS = 'definitions'
+VERSION_CACHE_PREFIX = 'survey-definition-version'
+DEFINITION_CACHE_PREFIX = 'survey-definition'
+
+
+def _version_key(survey_id):
+    return f"{VERSION_CACHE_PREFIX}:{survey_id}"
+
+
+def get_definition_version(survey_id):
+    """Current schema version of the survey, None if it does not exist"""
+    cache = caches[DEFINITIONS_CACHE_ALIAS]
+    version = cache.get(_version_key(survey_id))
+    if version is None:
+        version = Survey.objects.filter(pk=survey_id).values_list('schema_version', flat=True).first()
+        if version is None:
+            return None
+        # an edit publishing a newer version concurrently wins over this read
+        cache.add(_version_key(survey_id), version, timeout=None)
+    return version
+
+
+def publish_definition_version(survey_id):
+    """Record the version of an edited (or deleted) survey, once the edit is committed"""
+    cache = caches[DEFINITIONS_CACHE_ALIAS]
+    version = Survey.objects.filter(pk=survey_id).values_list('schema_version', flat=True).first()
+    if version is None:
+        cache.delete(_version_key(survey_id))
+    else:
+        cache.set(_version_key(survey_id), version, timeout=None)
+
+
+def _definition_timeout(survey):
+    """Seconds a definition stays valid, until the survey closes as it shows whether it is closed"""
+    cache = caches[DEFINITIONS_CACHE_ALIAS]
+    if survey.is_closed:
+        return cache.default_timeout
+    seconds_to_close = int((survey.closes_at - timezone.now()).total_seconds()) + 1
+    return min(seconds_to_close, cache.default_timeout) if cache.default_timeout else seconds_to_close
+
+
+def get_survey_definition(survey_id, kind, render):
+    """
+    The cached definition of a survey: its rendered data `render(survey)`, where the survey
+    has its questions prefetched, with a strong ETag of the data and the survey fields the
+    permissions depend on. `kind` names the rendering. None if the survey does not exist.
+    """
+    version = get_definition_version(survey_id)
+    if version is None:
+        return None
+    cache = caches[DEFINITIONS_CACHE_ALIAS]
+    key = f"{DEFINITION_CACHE_PREFIX}:{survey_id}:{version}:{kind}"
+    definition = cache.get(key)
+    if definition is not None and (definition['is_closed'] or definition['closes_at'] > timezone.now()):
+        return definition
+
+    survey = Survey.objects.prefetch_related('questions').filter(pk=survey_id).first()
+    if survey is None:
+        return None
+    data = render(survey)
+    digest = hashlib.sha256(json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True).encode()).hexdigest()
+    definition = {
+        'etag': digest[:32],
+        'data': data,
+        'creator_id': survey.creator_id,
+        'is_active': survey.is_active,
+        'is_closed': survey.is_closed,
+        'closes_at': survey.closes_at,
+    }
+    # stored under the version read first, a concurrent edit makes it unreachable
+    cache.set(key, definition, timeout=_definition_timeout(survey))
+    return definition
+
+
+def definition_survey(definition, survey_id):
+    """Unsaved survey with the fields of a cached definition, for the permission checks"""
+    return Survey(
+        pk=survey_id,
+        creator_id=definition['creator_id'],
+        is_active=definition['is_active'],
+        closes_at=definition['closes_at'],
+    )
+
+
+def definition_response(request, definition, max_age):
+    """
+    The definition with its ETag and caching headers, or a 304 when the client
+    already holds it (If-None-Match).
+    """
+    # a strong ETag identifies the bytes, they depend on the renderer
+    etag = f'"{definition["etag"]}-{request.accepted_renderer.format}"'
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and ('*' in parse_etags(if_none_match) or etag in parse_etags(if_none_match)):
+        response = DRFResponse(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = DRFResponse(definition['data'])
+    response['ETag'] = etag
+    if not definition['is_closed']:
+        # clients must not keep showing the survey open once it closed
+        max_age = min(max_age, max(int((definition['closes_at'] - timezone.now()).total_seconds()), 0))
+    # responses depend on the user (creators only see their own surveys)
+    if request.user and request.user.is_authenticated:
+        patch_cache_control(response, private=True, max_age=max_age)
+    else:
+        patch_cache_control(response, public=True, max_age=max_age)
+    patch_vary_headers(response, ['Authorization'])
+    return response
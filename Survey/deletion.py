@@ -0,0 +1,151 @@
+"""
+Deferred, batched release of the files of deleted answers and questions.
+
+Responses and answers have no delete signal receivers, so Django deletes them,
+alone or cascading from their survey, with a few set-based DELETE statements
+instead of loading every row. The files they reference are released by queuing
+their paths in the FileDeletion table (with one query for a whole queryset of
+answers) before the rows are deleted. A background worker drains the queue by
+batches once the deleting transaction is committed: it removes the references
+to the stored files and deletes the files left without any (see files.py).
+`python manage.py drain_file_deletions` drains what a stopped process left.
+Old surveys are deleted by batches of responses (`python manage.py purge_surveys`).
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from django.db import close_old_connections, connection, transaction
+
+from .config import ANSWER_FILE_PATH_KEY, FILE_DELETION_BATCH_SIZE, PURGE_BATCH_SIZE
+from .facts import delete_answer_facts
+from .files import delete_unreferenced_file, release_stored_files
+from .models import Answer, FileDeletion, Question, Response, Survey
+from .rollups import RollupDelta
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_drain_pending = False
+_lock = threading.Lock()
+
+
+def release_files(paths):
+    """Queue the release of the files at the paths, processed once the transaction is committed"""
+    paths = iter(paths)
+    queued = False
+    while batch := [FileDeletion(path=path) for path in islice(paths, FILE_DELETION_BATCH_SIZE) if path]:
+        FileDeletion.objects.bulk_create(batch)
+        queued = True
+    if queued:
+        transaction.on_commit(schedule_drain)
+
+
+def release_file(path):
+    release_files([path])
+
+
+def release_answer_files(answers):
+    """Queue the release of the files of the answers of the queryset, before deleting them"""
+    paths = answers.filter(question__question_type=Question.QUESTION_TYPES.FILE).values_list(
+        f'value__{ANSWER_FILE_PATH_KEY}', flat=True
+    )
+    release_files(path for path in paths.iterator() if isinstance(path, str))
+
+
+def delete_answers(answers):
+    """
+    Delete the answers of the queryset set-based with their analytics facts, releasing
+    their files and bumping their surveys' data versions
+    """
+    with transaction.atomic():
+        survey_ids = set(answers.values_list('response__survey_id', flat=True).distinct())
+        release_answer_files(answers)
+        delete_answer_facts(answers)
+        answers.delete()
+        Survey.bump_data_version(pk__in=survey_ids)
+
+
+def delete_responses(responses):
+    """Delete the responses of the queryset and their answers set-based, like `delete_answers`"""
+    with transaction.atomic():
+        survey_ids = set(responses.values_list('survey_id', flat=True).distinct())
+        release_answer_files(Answer.objects.filter(response__in=responses))
+        responses.delete()
+        Survey.bump_data_version(pk__in=survey_ids)
+
+
+def drain_file_deletions(batch_size=FILE_DELETION_BATCH_SIZE):
+    """Process the queued file releases by batches until the queue is empty, return how many were processed"""
+    processed = 0
+    while True:
+        with transaction.atomic():
+            # workers draining concurrently take distinct batches (where rows can be locked)
+            batch = list(FileDeletion.objects.select_for_update(skip_locked=True).order_by('id')[:batch_size])
+            if not batch:
+                return processed
+            unreferenced = release_stored_files([deletion.path for deletion in batch])
+            FileDeletion.objects.filter(pk__in=[deletion.pk for deletion in batch]).delete()
+        for path in unreferenced:
+            try:
+                delete_unreferenced_file(path)
+            except Exception:
+                logger.exception('Could not delete the unreferenced file %s', path)
+        processed += len(batch)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='survey-file-deletion')
+    return _executor
+
+
+def schedule_drain():
+    """Drain the queue in the background, unless a drain is already waiting to start"""
+    global _drain_pending
+    with _lock:
+        if _drain_pending:
+            return
+        _drain_pending = True
+        _get_executor().submit(_run_drain)
+
+
+def _run_drain():
+    global _drain_pending
+    with _lock:
+        # releases queued from now on schedule another drain
+        _drain_pending = False
+    close_old_connections()
+    try:
+        drain_file_deletions()
+    except Exception:
+        logger.exception('Draining the file deletion queue failed')
+    finally:
+        connection.close()
+
+
+def delete_survey_in_batches(survey, batch_size=PURGE_BATCH_SIZE):
+    """
+    Delete the survey, its responses first by ranges of `batch_size` response ids each in a
+    short transaction, then the survey itself with its questions. Yields the number of responses
+    deleted by each batch. Committed batches stay deleted, so an interrupted deletion resumes
+    from the responses left. The rollups of the survey are updated with each batch, the live
+    statistics and the statistics read from them count the responses left meanwhile.
+    """
+    while True:
+        response_ids = list(
+            Response.objects.filter(survey=survey).order_by('id').values_list('id', flat=True)[:batch_size]
+        )
+        if not response_ids:
+            break
+        with transaction.atomic():
+            responses = Response.objects.filter(survey=survey, id__range=(response_ids[0], response_ids[-1]))
+            rollup_delta = RollupDelta()
+            rollup_delta.remove_answers(Answer.objects.filter(response__in=responses).select_related('question').iterator())
+            delete_responses(responses)
+            rollup_delta.apply()
+        yield len(response_ids)
+    with transaction.atomic():
+        survey.delete()
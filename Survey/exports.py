@@ -0,0 +1,293 @@
+"""
+Streaming exports of survey responses, as PDF, CSV or NDJSON.
+
+Responses are read with a server-side cursor and their answers fetched once per
+chunk of responses, so exports run in constant memory whatever their size.
+PDF pages are laid out by the minimal writer of pdf.py and sent to the client as
+soon as they are full, optionally rendered by a pool of processes.
+"""
+import csv
+import logging
+import multiprocessing
+import threading
+import time
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from itertools import islice
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Avg, Count, Max
+from django.utils import timezone
+
+from .config import ANSWER_FILE_PATH_KEY
+from .models import Answer
+from .pdf import ROWS_PER_PAGE, ResponsesPDFLayout, StreamingPDFWriter, render_pages
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CHUNK_SIZE = 2000
+# pages rendered by a worker process at a time in parallel exports
+PARALLEL_PAGES_PER_TASK = 20
+
+_pool = None
+_pool_processes = 0
+_pool_lock = threading.Lock()
+
+
+def answer_display_value(value):
+    """Human readable form of an answer value, as shown in the exports"""
+    if value is None:
+        return ''
+    if isinstance(value, dict):
+        if 'choice' in value:
+            return str(value['choice'])
+        if 'choices' in value:
+            return ', '.join(str(choice) for choice in value['choices'])
+        return str(value.get(ANSWER_FILE_PATH_KEY, ''))
+    return str(value)
+
+
+ResponseRow = namedtuple('ResponseRow', ['id', 'submitted_at', 'completion_time', 'respondent_email', 'answers'])
+
+
+def iter_response_rows(survey, chunk_size=EXPORT_CHUNK_SIZE, last_response_id=None):
+    """
+    Yield a ResponseRow, with the answer values by question id, for every response of
+    the survey ordered by id, up to `last_response_id` when given. Responses are read with
+    a server-side cursor and the answers of each chunk of responses with a single query,
+    in constant memory.
+    """
+    responses = survey.responses.order_by('id')
+    if last_response_id is not None:
+        responses = responses.filter(id__lte=last_response_id)
+    responses = responses.values_list(
+        'id', 'submitted_at', 'completion_time', 'respondent__email'
+    ).iterator(chunk_size=chunk_size)
+    while chunk := list(islice(responses, chunk_size)):
+        # the chunk is ordered by id, its answers are fetched by id range
+        answers = defaultdict(dict)
+        chunk_answers = Answer.objects.filter(
+            response__survey=survey, response__id__range=(chunk[0][0], chunk[-1][0])
+        ).values_list('response_id', 'question_id', 'value')
+        for response_id, question_id, value in chunk_answers:
+            answers[response_id][question_id] = value
+        for response_id, submitted_at, completion_time, respondent_email in chunk:
+            yield ResponseRow(response_id, submitted_at, completion_time, respondent_email, answers.get(response_id, {}))
+
+
+def _local_datetime(value):
+    if value is not None and timezone.is_aware(value):
+        return timezone.localtime(value)
+    return value
+
+
+def export_statistics(survey):
+    """
+    Number of responses, average completion time and id of the last response, in one
+    aggregate query: the responses exported with them are those up to that id.
+    """
+    aggregates = survey.responses.aggregate(
+        total=Count('id'), avg_completion_time=Avg('completion_time'), last_response_id=Max('id')
+    )
+    avg_completion_time = aggregates['avg_completion_time'] or timedelta()
+    return {
+        'total_responses': aggregates['total'],
+        'avg_completion_time': f"{avg_completion_time.total_seconds()/60:.2f} minutes",
+        'last_response_id': aggregates['last_response_id'],
+    }
+
+
+def response_row_cells(row, question_ids):
+    """Cell texts of a response in the PDF table"""
+    submitted_at = _local_datetime(row.submitted_at)
+    cells = [
+        str(row.id),
+        submitted_at.strftime('%Y-%m-%d %H:%M:%S') if submitted_at else '',
+        row.respondent_email or 'Anonymous',
+    ]
+    cells.extend(answer_display_value(row.answers.get(question_id)) for question_id in question_ids)
+    return cells
+
+
+def _iter_pages(survey, question_ids, chunk_size, last_response_id):
+    """Cell texts of the rows of every page, a survey without responses has one empty page"""
+    rows = []
+    page_count = 0
+    if last_response_id is None:
+        yield rows
+        return
+    for row in iter_response_rows(survey, chunk_size, last_response_id):
+        rows.append(response_row_cells(row, question_ids))
+        if len(rows) == ROWS_PER_PAGE:
+            yield rows
+            rows = []
+            page_count += 1
+    if rows or page_count == 0:
+        yield rows
+
+
+def _get_pool(processes):
+    """The pool of worker processes of this process, shared by its parallel exports"""
+    global _pool, _pool_processes
+    with _pool_lock:
+        if _pool is None or _pool_processes != processes:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # spawned workers do not inherit the threads and connections of the serving process
+            _pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+            _pool_processes = processes
+        return _pool
+
+
+def _discard_pool(pool):
+    """Replace a pool whose workers died, the next export starts a new one"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _render_pages_in_pool(layout, pages, processes, pages_per_task, render_times):
+    """
+    Yield the compressed content of the pages in order, rendered by the pool of processes
+    by batches of consecutive pages whose CPU rendering times are added to `render_times`.
+    At most two batches per process are in flight so memory stays bounded.
+    """
+    pool = _get_pool(processes)
+    in_flight = deque()
+    try:
+        page_number = 1
+        pages = iter(pages)
+        while batch := list(islice(pages, pages_per_task)):
+            in_flight.append(pool.submit(render_pages, layout, page_number, batch))
+            page_number += len(batch)
+            while len(in_flight) >= 2 * processes:
+                contents, seconds = in_flight.popleft().result()
+                render_times.append(seconds)
+                yield from contents
+        while in_flight:
+            contents, seconds = in_flight.popleft().result()
+            render_times.append(seconds)
+            yield from contents
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        raise
+    finally:
+        # the pool outlives the export, the batches of an interrupted one are dropped
+        for future in in_flight:
+            future.cancel()
+
+
+def stream_responses_pdf(survey, include_stats=False, chunk_size=EXPORT_CHUNK_SIZE, processes=1):
+    """
+    Yield the bytes of the responses PDF of the survey, page by page. With more than one
+    process, pages are rendered in parallel by a pool of worker processes while this one
+    reads the responses and writes the document. The responses counted for the "Page N
+    of M" numbering are those exported: submitted after the count, they are left out.
+    """
+    statistics = export_statistics(survey)
+    questions = list(survey.questions.all())
+    layout = ResponsesPDFLayout(
+        f"Survey Responses: {survey.title}", [question.question_text for question in questions],
+        statistics['total_responses'], statistics if include_stats else None
+    )
+    writer = StreamingPDFWriter(title=layout.title)
+    yield writer.begin()
+
+    pages = _iter_pages(survey, [question.id for question in questions], chunk_size, statistics['last_response_id'])
+    if processes <= 1:
+        for page_number, rows in enumerate(pages, start=1):
+            yield writer.page(layout.page_content(page_number, rows))
+        yield writer.end()
+        return
+
+    started = time.perf_counter()
+    render_times = []
+    for compressed in _render_pages_in_pool(layout, pages, processes, PARALLEL_PAGES_PER_TASK, render_times):
+        yield writer.compressed_page(compressed)
+    yield writer.end()
+    elapsed = time.perf_counter() - started
+    render_seconds = sum(render_times)
+    # the share of the time the workers were rendering, not a speedup over a serial export
+    logger.info(
+        'Rendered %d PDF pages of survey %s with %d processes in %.2fs, %.2fs of page rendering CPU time '
+        '(%.0f%% CPU utilisation of the processes)',
+        len(writer.page_ids), survey.id, processes, elapsed, render_seconds,
+        100 * render_seconds / (elapsed * processes) if elapsed else 100.0
+    )
+
+
+class _Echo:
+    """File-like object handing back what the csv writer writes"""
+
+    def write(self, value):
+        return value
+
+
+def _flat_headers(questions):
+    return ['response_id', 'submitted_at', 'completion_seconds', 'respondent'] + [
+        question.question_text for question in questions
+    ]
+
+
+def stream_responses_csv(survey, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield the responses of the survey as utf-8 CSV, one row per response and one column per question"""
+    questions = list(survey.questions.all())
+    writer = csv.writer(_Echo())
+    yield writer.writerow(_flat_headers(questions)).encode()
+    lines = []
+    for row in iter_response_rows(survey, chunk_size):
+        lines.append(writer.writerow([
+            row.id,
+            row.submitted_at.isoformat() if row.submitted_at else '',
+            row.completion_time.total_seconds() if row.completion_time is not None else '',
+            row.respondent_email or '',
+        ] + [answer_display_value(row.answers.get(question.id)) for question in questions]))
+        if len(lines) == chunk_size:
+            yield ''.join(lines).encode()
+            lines = []
+    if lines:
+        yield ''.join(lines).encode()
+
+
+def stream_responses_ndjson(survey, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield the responses of the survey as newline delimited JSON, one object per response
+    with the raw answer values by question id.
+    """
+    question_ids = list(survey.questions.values_list('id', flat=True))
+    encoder = DjangoJSONEncoder()
+    lines = []
+    for row in iter_response_rows(survey, chunk_size):
+        lines.append(encoder.encode({
+            'response_id': row.id,
+            'submitted_at': row.submitted_at,
+            'completion_seconds': row.completion_time.total_seconds() if row.completion_time is not None else None,
+            'respondent': row.respondent_email,
+            'answers': {str(question_id): row.answers.get(question_id) for question_id in question_ids},
+        }))
+        if len(lines) == chunk_size:
+            yield ('\n'.join(lines) + '\n').encode()
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode()
+
+
+def normalize_export_options(export_format, options):
+    """The options an export of the format depends on, with their defaults"""
+    if export_format != 'pdf':
+        return {}
+    return {
+        'include_stats': str(options.get('include_stats', 'false')).lower() == 'true',
+    }
+
+
+# format -> (content type, file extension, renderer yielding the bytes of the export)
+EXPORT_RENDERERS = {
+    'pdf': ('application/pdf', 'pdf', lambda survey, options: stream_responses_pdf(survey, options['include_stats'])),
+    'csv': ('text/csv; charset=utf-8', 'csv', lambda survey, options: stream_responses_csv(survey)),
+    'ndjson': ('application/x-ndjson', 'ndjson', lambda survey, options: stream_responses_ndjson(survey)),
+}
@@ -0,0 +1,103 @@
+"""
+Typed analytics facts of the answers to rating and choice questions.
+
+Answer values are JSON, which the database can neither index nor aggregate
+without casting every row. Each answer to a rating or choice question is also
+written as AnswerFact rows: its rating, or one row per selected option with its
+text and option index, carrying the survey, question and response ids. The
+statistics, filters and correlations aggregate those indexed columns.
+
+Facts are written in the transaction writing the answers: by the Answer post_save
+receiver for single saves (signals.py), by `add_answer_facts` for bulk inserts, and
+deleted with their answers by deletion.py. Answers written before the facts existed
+get theirs from `manage.py rebuild_answer_facts`.
+"""
+from django.db import transaction
+from django.db.models import Case, IntegerField, Value, When
+
+from .models import Answer, AnswerFact, Question
+from .rollups import answer_options, answer_rating
+
+FACT_QUESTION_TYPES = [Question.QUESTION_TYPES.RATING, Question.QUESTION_TYPES.SINGLE, Question.QUESTION_TYPES.MULTIPLE]
+
+
+def _option_indices(question):
+    return {option: i for i, option in enumerate(question.settings.get('options') or []) if isinstance(option, str)}
+
+
+def answer_facts(answer, question, option_indices=None):
+    """The unsaved facts of an answer to the question"""
+    if question.question_type not in FACT_QUESTION_TYPES:
+        return []
+    fact_fields = {
+        'answer_id': answer.pk,
+        'survey_id': question.survey_id,
+        'question_id': question.pk,
+        'response_id': answer.response_id,
+    }
+    rating = answer_rating(question.question_type, answer.value)
+    if rating is not None:
+        return [AnswerFact(rating=rating, **fact_fields)]
+    if option_indices is None:
+        option_indices = _option_indices(question)
+    return [
+        AnswerFact(choice=option, option_index=option_indices.get(option), **fact_fields)
+        for option in answer_options(question.question_type, answer.value)
+    ]
+
+
+def add_answer_facts(answers):
+    """Insert the facts of new answers, which have their question loaded"""
+    option_indices = {}
+    facts = []
+    for answer in answers:
+        question = answer.question
+        if question.pk not in option_indices:
+            option_indices[question.pk] = _option_indices(question)
+        facts.extend(answer_facts(answer, question, option_indices[question.pk]))
+    AnswerFact.objects.bulk_create(facts)
+
+
+def replace_answer_facts(answers):
+    """Replace the facts of changed answers"""
+    with transaction.atomic():
+        AnswerFact.objects.filter(answer_id__in=[answer.pk for answer in answers]).delete()
+        add_answer_facts(answers)
+
+
+def delete_answer_facts(answers):
+    """Delete the facts of the answers of the queryset, before deleting them"""
+    AnswerFact.objects.filter(answer_id__in=answers.values('pk')).delete()
+
+
+def reindex_question_facts(question):
+    """Update the option indices of the facts of a choice question after its options changed"""
+    option_indices = _option_indices(question)
+    AnswerFact.objects.filter(question=question).update(option_index=Case(
+        *[When(choice=option, then=Value(index)) for option, index in option_indices.items()],
+        default=Value(None),
+        output_field=IntegerField(),
+    ))
+
+
+def rebuild_survey_facts(survey, chunk_size=5000):
+    """Replace the facts of the survey by facts written from its answers, return how many were written"""
+    questions = {
+        question.pk: question
+        for question in survey.questions.filter(question_type__in=FACT_QUESTION_TYPES)
+    }
+    option_indices = {question_id: _option_indices(question) for question_id, question in questions.items()}
+    written = 0
+    with transaction.atomic():
+        AnswerFact.objects.filter(survey=survey).delete()
+        answers = Answer.objects.filter(question_id__in=questions).only('pk', 'response_id', 'question_id', 'value')
+        facts = []
+        for answer in answers.iterator(chunk_size=chunk_size):
+            facts.extend(answer_facts(answer, questions[answer.question_id], option_indices[answer.question_id]))
+            if len(facts) >= chunk_size:
+                AnswerFact.objects.bulk_create(facts)
+                written += len(facts)
+                facts = []
+        AnswerFact.objects.bulk_create(facts)
+        written += len(facts)
+    return written
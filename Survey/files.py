@@ -0,0 +1,140 @@
+"""
+Content-addressed storage of the files of answers and question attachments.
+
+A file is stored once, under the sha256 of its content, in two levels of shard
+directories taken from the hash (`files/ab/cd/abcd...ef.pdf`) so no directory
+grows past a few hundred entries whatever the number of files. Identical
+uploads share the stored file: a StoredFile row counts the answers, questions
+and pending uploads referencing it, and the file is deleted with its last
+reference, released through the deletion queue of deletion.py.
+"""
+import hashlib
+import os
+import re
+from collections import Counter
+
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+from .config import STORED_FILE_DIR, UPLOAD_READ_SIZE
+from .models import StoredFile
+
+_STORED_FILE_PATH = re.compile(
+    rf'^{re.escape(STORED_FILE_DIR)}/[0-9a-f]{{2}}/[0-9a-f]{{2}}/(?P<sha256>[0-9a-f]{{64}})(?:\.(?P<extension>[0-9a-z]+))?$'
+)
+
+
+def normalize_extension(extension):
+    """The extension stored files are named with, lowercase alphanumeric"""
+    return re.sub(r'[^0-9a-z]', '', (extension or '').lower())[:20]
+
+
+def stored_file_path(sha256, extension):
+    name = f"{sha256}.{extension}" if extension else sha256
+    return f"{STORED_FILE_DIR}/{sha256[:2]}/{sha256[2:4]}/{name}"
+
+
+def file_sha256(file):
+    """Hex sha256 of the content of a django File, read by chunks"""
+    digest = hashlib.sha256()
+    for chunk in file.chunks(UPLOAD_READ_SIZE):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_stored_file(path, file):
+    if default_storage.exists(path):
+        return
+    # a file closed since the reference was taken is reopened by its name
+    reopened = file.closed
+    if reopened:
+        file.open('rb')
+    try:
+        file.seek(0)
+        saved_path = default_storage.save(path, file)
+    finally:
+        if reopened:
+            file.close()
+    if saved_path != path:
+        # stored concurrently by an identical upload, keep a single copy
+        default_storage.delete(saved_path)
+
+
+def store_file(file, extension=None, sha256=None):
+    """
+    Store the content of a django File unless an identical file is already stored, add
+    a reference to it and return its storage path. The extension defaults to the one of
+    the file name, `sha256` spares hashing the content again when it is already known.
+    The content is only written once the transaction is committed, so the file must stay
+    open until then and a rolled back reference leaves no file behind.
+    """
+    extension = normalize_extension(extension or os.path.splitext(file.name or '')[1])
+    if sha256 is None:
+        sha256 = file_sha256(file)
+    while True:
+        stored, _ = StoredFile.objects.get_or_create(
+            sha256=sha256, extension=extension, defaults={'size': file.size}
+        )
+        # the row may have been deleted with its file in the meantime
+        if StoredFile.objects.filter(pk=stored.pk).update(ref_count=F('ref_count') + 1):
+            break
+
+    path = stored_file_path(sha256, extension)
+    transaction.on_commit(lambda: _write_stored_file(path, file))
+    return path
+
+
+def release_stored_files(paths):
+    """
+    Remove one reference to the stored file at each path, a path released several times
+    loses as many references, and return the paths of the files left without any, whose
+    rows are kept until `delete_unreferenced_file` deletes them with their files. Files
+    stored before content addressing (any other path) belong to a single answer or
+    question and are returned as they are.
+    """
+    unreferenced = []
+    releases = Counter()
+    for path in paths:
+        match = _STORED_FILE_PATH.match(path)
+        if match is None:
+            unreferenced.append(path)
+        else:
+            releases[(match['sha256'], match['extension'] or '')] += 1
+    if not releases:
+        return unreferenced
+
+    for (sha256, extension), count in releases.items():
+        StoredFile.objects.filter(sha256=sha256, extension=extension).update(
+            ref_count=Greatest(F('ref_count') - count, 0)
+        )
+    released = StoredFile.objects.filter(sha256__in={sha256 for sha256, _ in releases}, ref_count=0)
+    unreferenced.extend(
+        stored_file_path(stored.sha256, stored.extension) for stored in released
+        if (stored.sha256, stored.extension) in releases
+    )
+    return unreferenced
+
+
+def delete_unreferenced_file(path):
+    """
+    Delete a file returned by `release_stored_files`, once the release is committed, and
+    its row. The row is locked until both are deleted: `store_file` adds a reference to it
+    before, and the file is kept, or after, and stores the file again under a new row.
+    """
+    match = _STORED_FILE_PATH.match(path)
+    if match is None:
+        if default_storage.exists(path):
+            default_storage.delete(path)
+        return
+    with transaction.atomic():
+        stored = StoredFile.objects.select_for_update().filter(
+            sha256=match['sha256'], extension=match['extension'] or ''
+        ).first()
+        # deleted by another drain, or an identical file was stored again since
+        if stored is None or stored.ref_count > 0:
+            return
+        if default_storage.exists(path):
+            default_storage.delete(path)
+        stored.delete()
@@ -0,0 +1,159 @@
+"""
+Background export jobs.
+
+Exports are generated by a worker pool of the process serving the API instead
+of inside the request, and written gzip compressed to the default storage under
+a name derived from their fingerprint: the survey, the export format and options
+and the survey data version. Submitting an export identical to one already
+generated (or being generated) returns that job instead of doing the work again.
+Once an export is generated for a newer data version, the jobs of the same export
+for older versions are deleted with their artifacts.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .config import EXPORT_ARTIFACT_DIR
+from .exports import EXPORT_RENDERERS
+from .models import ExportJob
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.EXPORT_WORKERS, thread_name_prefix='survey-export')
+        return _executor
+
+
+def export_fingerprint(survey_id, export_format, options, data_version):
+    payload = json.dumps({
+        'survey': survey_id,
+        'format': export_format,
+        'options': options,
+        'data_version': data_version,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def export_artifact_path(job):
+    extension = EXPORT_RENDERERS[job.format][1]
+    return f"{EXPORT_ARTIFACT_DIR}/{job.survey_id}/{job.fingerprint}.{extension}.gz"
+
+
+def find_reusable_job(fingerprint):
+    """
+    A completed job with the fingerprint whose artifact still exists, or one still
+    being generated (jobs of a crashed worker are ignored after EXPORT_JOB_TIMEOUT).
+    """
+    in_flight_since = timezone.now() - timedelta(seconds=settings.EXPORT_JOB_TIMEOUT)
+    jobs = ExportJob.objects.filter(fingerprint=fingerprint).filter(
+        Q(status=ExportJob.Status.COMPLETED)
+        | Q(status__in=[ExportJob.Status.PENDING, ExportJob.Status.RUNNING], updated_at__gte=in_flight_since)
+    ).order_by('-created_at')
+    for job in jobs:
+        if job.status != ExportJob.Status.COMPLETED or default_storage.exists(job.artifact_path):
+            return job
+    return None
+
+
+def submit_export_job(survey, export_format, options, requested_by=None):
+    """
+    Return (job, created): the job generating the export, an existing one when an
+    identical export was already submitted for the current data of the survey.
+    """
+    fingerprint = export_fingerprint(survey.id, export_format, options, survey.data_version)
+    job = find_reusable_job(fingerprint)
+    if job is not None:
+        return job, False
+
+    job = ExportJob.objects.create(
+        survey=survey,
+        requested_by=requested_by,
+        format=export_format,
+        options=options,
+        data_version=survey.data_version,
+        fingerprint=fingerprint,
+    )
+    # the worker must see the job row
+    transaction.on_commit(lambda: get_executor().submit(run_export_job, job.pk))
+    return job, True
+
+
+def delete_superseded_jobs(job):
+    """
+    Delete the finished jobs of the same export as a completed job (survey, format and
+    options) for older data versions, their artifacts are deleted with them (see signals.py)
+    """
+    superseded = ExportJob.objects.filter(
+        survey_id=job.survey_id,
+        format=job.format,
+        data_version__lt=job.data_version,
+        status__in=[ExportJob.Status.COMPLETED, ExportJob.Status.FAILED],
+    )
+    # options are compared as values, whatever the order of their keys
+    superseded_ids = [other.pk for other in superseded.only('pk', 'options') if other.options == job.options]
+    if superseded_ids:
+        ExportJob.objects.filter(pk__in=superseded_ids).delete()
+
+
+def run_export_job(job_id):
+    """Generate the artifact of a job, run by the worker pool"""
+    close_old_connections()
+    try:
+        job = ExportJob.objects.select_related('survey').get(pk=job_id)
+        survey = job.survey
+        # the export reflects the data when it runs, which may have changed since it was submitted
+        job.data_version = survey.data_version
+        job.fingerprint = export_fingerprint(survey.id, job.format, job.options, job.data_version)
+        job.artifact_path = export_artifact_path(job)
+        job.status = ExportJob.Status.RUNNING
+        job.started_at = timezone.now()
+        job.save(update_fields=['data_version', 'fingerprint', 'artifact_path', 'status', 'started_at', 'updated_at'])
+
+        # an identical export may have been generated in the meantime
+        if not default_storage.exists(job.artifact_path):
+            render = EXPORT_RENDERERS[job.format][2]
+            with tempfile.TemporaryFile() as artifact:
+                with gzip.GzipFile(fileobj=artifact, mode='wb') as compressed:
+                    for chunk in render(survey, job.options):
+                        compressed.write(chunk)
+                artifact.seek(0)
+                saved_path = default_storage.save(job.artifact_path, File(artifact))
+            if saved_path != job.artifact_path:
+                # saved concurrently by another job, keep a single artifact
+                default_storage.delete(saved_path)
+
+        job.artifact_size = default_storage.size(job.artifact_path)
+        job.status = ExportJob.Status.COMPLETED
+        job.finished_at = timezone.now()
+        job.save(update_fields=['artifact_size', 'status', 'finished_at', 'updated_at'])
+    except Exception as e:
+        logger.exception('Export job %s failed', job_id)
+        ExportJob.objects.filter(pk=job_id).update(
+            status=ExportJob.Status.FAILED, error=str(e), finished_at=timezone.now(), updated_at=timezone.now()
+        )
+    else:
+        try:
+            delete_superseded_jobs(job)
+        except Exception:
+            logger.exception('Could not delete the exports superseded by job %s', job_id)
+    finally:
+        connection.close()
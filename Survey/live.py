@@ -0,0 +1,165 @@
+"""
+Live statistics of open surveys, pushed to dashboards as server-sent events.
+
+Each process runs at most one broadcaster per watched survey. It checks the
+survey's data version once per interval and only when it changed reads the
+question rollups and fans the new snapshot out to every subscriber, so bursts
+of responses are coalesced into one event per interval and the number of
+queries does not depend on the number of viewers.
+
+Browsers' EventSource cannot send an Authorization header, the stream is opened
+with a short-lived token signed for one survey and its creator instead, so the
+long-lived API token never appears in URLs and server logs.
+"""
+import asyncio
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .config import LIVE_STATISTICS_TOKEN_MAX_AGE
+from .models import Survey
+from .services import _calculate_question_statistics, _calculate_rollup_question_statistics
+
+logger = logging.getLogger(__name__)
+
+LIVE_STATISTICS_TOKEN_SALT = 'survey-live-statistics'
+
+# survey_id -> SurveyStatisticsBroadcaster
+_broadcasters = {}
+
+
+def live_statistics_token(survey, user):
+    """Token opening the live statistics stream of the survey for the user during LIVE_STATISTICS_TOKEN_MAX_AGE seconds"""
+    return signing.dumps({'survey': survey.id, 'user': user.id}, salt=LIVE_STATISTICS_TOKEN_SALT)
+
+
+def live_statistics_token_user_id(token, survey_id):
+    """Id of the user the token was issued to, None when it is invalid, expired or for another survey"""
+    try:
+        payload = signing.loads(token, salt=LIVE_STATISTICS_TOKEN_SALT, max_age=LIVE_STATISTICS_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return None
+    if not isinstance(payload, dict) or payload.get('survey') != survey_id:
+        return None
+    return payload.get('user')
+
+
+def survey_data_version(survey_id):
+    return Survey.objects.filter(pk=survey_id).values_list('data_version', flat=True).first()
+
+
+def build_live_statistics(survey_id):
+    """Snapshot of the counters of a survey, None if it does not exist anymore"""
+    survey = Survey.objects.filter(pk=survey_id).first()
+    if survey is None:
+        return None
+    total_responses = survey.responses.count()
+    questions = list(survey.questions.all())
+    questions_stats = _calculate_rollup_question_statistics(questions, total_responses)
+    if questions_stats is None:
+        questions_stats = _calculate_question_statistics(survey, survey.responses.all(), total_responses)
+    return {
+        'survey': survey.id,
+        'data_version': survey.data_version,
+        'is_closed': survey.is_closed,
+        'total_responses': total_responses,
+        'questions': questions_stats,
+    }
+
+
+class SurveyStatisticsBroadcaster:
+    """
+    Polls one survey while it has subscribers and publishes a snapshot to all of them
+    whenever its data changed. Subscribers get bounded queues only holding the latest
+    snapshot, a slow consumer skips intermediate snapshots instead of piling them up.
+    """
+
+    def __init__(self, survey_id, interval):
+        self.survey_id = survey_id
+        self.interval = interval
+        self.loop = asyncio.get_running_loop()
+        self.subscribers = set()
+        self.snapshot = None
+        self.data_version = None
+        self._task = None
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=1)
+        if self.snapshot is not None:
+            queue.put_nowait(self.snapshot)
+        self.subscribers.add(queue)
+        if self._task is None or self._task.done():
+            self._task = self.loop.create_task(self._run())
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    def publish(self, snapshot):
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(snapshot)
+
+    async def _run(self):
+        try:
+            while self.subscribers:
+                try:
+                    data_version = await sync_to_async(survey_data_version)(self.survey_id)
+                    if data_version is None or data_version != self.data_version:
+                        self.snapshot = await sync_to_async(build_live_statistics)(self.survey_id)
+                        self.data_version = self.snapshot['data_version'] if self.snapshot else None
+                        # None tells the subscribers the survey was deleted
+                        self.publish(self.snapshot)
+                        if self.snapshot is None:
+                            break
+                except Exception:
+                    # keep the subscribers connected, the next interval retries
+                    logger.exception('Live statistics of survey %s failed', self.survey_id)
+                await asyncio.sleep(self.interval)
+        finally:
+            if _broadcasters.get(self.survey_id) is self:
+                del _broadcasters[self.survey_id]
+
+
+def get_broadcaster(survey_id):
+    """The broadcaster of the survey for the running event loop"""
+    broadcaster = _broadcasters.get(survey_id)
+    if broadcaster is None or broadcaster.loop is not asyncio.get_running_loop():
+        broadcaster = SurveyStatisticsBroadcaster(survey_id, settings.SURVEY_LIVE_STATISTICS_INTERVAL)
+        _broadcasters[survey_id] = broadcaster
+    return broadcaster
+
+
+def format_event(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, cls=DjangoJSONEncoder)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+async def live_statistics_events(survey_id, keepalive):
+    """Server-sent events stream of the survey statistics, until the client disconnects"""
+    broadcaster = get_broadcaster(survey_id)
+    queue = broadcaster.subscribe()
+    try:
+        yield f"retry: {int(broadcaster.interval * 1000)}\n\n"
+        while True:
+            try:
+                snapshot = await asyncio.wait_for(queue.get(), timeout=keepalive)
+            except asyncio.TimeoutError:
+                # comment lines keep proxies from closing idle connections
+                yield ': keep-alive\n\n'
+                continue
+            if snapshot is None:
+                yield format_event('deleted', {'survey': survey_id})
+                break
+            yield format_event('statistics', snapshot, event_id=snapshot['data_version'])
+    finally:
+        broadcaster.unsubscribe(queue)
@@ -0,0 +1,71 @@
+"""
+Request-scoped loading of the surveys responses are submitted to.
+
+The survey of a submission, its questions and its auth requirement are used by
+the permission, the view and the serializers handling the request. The loader of
+a request reads every survey and its questions once, keeps them by id in the
+context the serializers resolve their related fields from, and hands the same
+instances to every step, so none of them queries them again.
+"""
+from .models import Question, Survey
+
+
+def parse_survey_id(value):
+    """The survey id of a submitted value, None when it is not one"""
+    if isinstance(value, bool):
+        return None
+    try:
+        survey_id = int(value)
+    except (TypeError, ValueError):
+        return None
+    return survey_id if survey_id > 0 else None
+
+
+class SurveyLoader:
+    """The surveys loaded for a request with their questions, by id"""
+
+    def __init__(self):
+        self.surveys = {}
+        # questions by id, and by survey id in their order
+        self.questions = {}
+        self.survey_questions = {}
+        self._missing = set()
+
+    def load(self, survey_ids):
+        """Load the surveys not loaded yet and their questions, in two queries"""
+        survey_ids = set(survey_ids) - self.surveys.keys() - self._missing
+        if not survey_ids:
+            return
+        surveys = Survey.objects.in_bulk(survey_ids)
+        self._missing |= survey_ids - surveys.keys()
+        self.surveys.update(surveys)
+        for survey_id in surveys:
+            self.survey_questions[survey_id] = []
+        for question in Question.objects.filter(survey_id__in=surveys):
+            question.survey = surveys[question.survey_id]
+            self.questions[question.id] = question
+            self.survey_questions[question.survey_id].append(question)
+
+    def get(self, value):
+        """The survey with the submitted id, None when it does not exist"""
+        survey_id = parse_survey_id(value)
+        if survey_id is None:
+            return None
+        self.load([survey_id])
+        return self.surveys.get(survey_id)
+
+    def serializer_context(self):
+        """The loaded instances, in the context keys the response serializers read them from"""
+        return {
+            'surveys': self.surveys,
+            'questions': self.questions,
+            'survey_questions': self.survey_questions,
+        }
+
+
+def get_survey_loader(request):
+    """The survey loader of the request, created on first use"""
+    loader = getattr(request, '_survey_loader', None)
+    if loader is None:
+        loader = request._survey_loader = SurveyLoader()
+    return loader
@@ -0,0 +1,285 @@
+"""
+HTTP load test of the respondent and creator endpoints against a running server.
+
+Concurrent workers, each with its own keep-alive connection and synthetic
+respondent, send a weighted mix of requests to the real URLconf: the survey
+definition, response submissions, answer updates (`bulk_update`), answers added
+to a submitted response (`add_answers`) and the management listing of the
+creator. The updates and additions only target responses the worker submitted
+itself. Every request is timed from sending it to reading its whole body; the
+results give the throughput, latency percentiles and error rates of every
+endpoint.
+
+The fixture is an open synthetic survey (synthetic.py) created in the database
+of the server before the run, with the tokens of its respondents and creator.
+"""
+import http.client
+import json
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from urllib.parse import urlsplit
+
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+
+from .models import Question
+from .synthetic import generate_dataset, get_respondents, synthetic_email
+
+User = get_user_model()
+
+ENDPOINTS = ['retrieve', 'submit', 'bulk_update', 'add_answers', 'management']
+DEFAULT_MIX = {'retrieve': 4, 'submit': 2, 'bulk_update': 1, 'add_answers': 1, 'management': 1}
+# no file question, answers are sent as JSON
+QUESTION_COUNTS = {
+    Question.QUESTION_TYPES.RATING: 3,
+    Question.QUESTION_TYPES.SINGLE: 2,
+    Question.QUESTION_TYPES.MULTIPLE: 2,
+    Question.QUESTION_TYPES.TEXT: 1,
+}
+
+
+class Fixture:
+    """The survey under load, its questions and the tokens of its respondents and creator"""
+
+    def __init__(self, survey, questions, respondent_tokens, creator_token):
+        self.survey = survey
+        self.questions = questions
+        self.respondent_tokens = respondent_tokens
+        self.creator_token = creator_token
+        # left out of the submissions, answered later with add_answers
+        self.added_question = next(
+            question for question in reversed(questions)
+            if question.question_type == Question.QUESTION_TYPES.TEXT and not question.required
+        )
+        # changed with bulk_update
+        self.updated_question = next(
+            question for question in questions if question.question_type == Question.QUESTION_TYPES.RATING
+        )
+
+
+def create_fixture(seed, respondents):
+    """An open synthetic survey, with a token for each of the respondents and for its creator"""
+    survey, = generate_dataset(
+        seed, responses=0, respondents=respondents, question_counts=QUESTION_COUNTS, closed=False
+    )
+    respondent_ids, _, _ = get_respondents(seed, respondents)
+    respondent_tokens = [Token.objects.get_or_create(user_id=int(user_id))[0].key for user_id in respondent_ids]
+    creator_token = Token.objects.get_or_create(user=User.objects.get(email=synthetic_email(seed)))[0].key
+    return Fixture(survey, list(survey.questions.order_by('order')), respondent_tokens, creator_token)
+
+
+def answer_value(question, rng):
+    """A valid random value of an answer to the question"""
+    if question.question_type == Question.QUESTION_TYPES.RATING:
+        return float(rng.randint(question.settings['min_value'], question.settings['max_value']))
+    if question.question_type == Question.QUESTION_TYPES.SINGLE:
+        return {'choice': rng.choice(question.settings['options'])}
+    if question.question_type == Question.QUESTION_TYPES.MULTIPLE:
+        options = question.settings['options']
+        return {'choices': rng.sample(options, rng.randint(1, len(options)))}
+    return f'Load test answer {rng.randint(0, 999)}'
+
+
+class Client:
+    """One keep-alive HTTP connection to the server, reopened when the server closed it"""
+
+    def __init__(self, base_url, timeout):
+        url = urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, method, path, token=None, data=None):
+        """Send the request and read the response, return its status and body"""
+        headers = {'Accept': 'application/json'}
+        if token:
+            headers['Authorization'] = f'Token {token}'
+        body = None
+        if data is not None:
+            body = json.dumps(data).encode()
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            reused = self.connection is not None
+            if not reused:
+                self.connection = self.connection_class(self.netloc, timeout=self.timeout)
+            try:
+                self.connection.request(method, self.prefix + path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                content = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.close()
+                # a kept alive connection closed by the server in the meantime, retried once on a new one
+                if reused and attempt == 0:
+                    continue
+                raise
+            except Exception:
+                self.close()
+                raise
+            if response.will_close:
+                self.close()
+            return response.status, content
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class Recorder:
+    """Latencies and statuses of the requests of every endpoint, shared by the workers"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+
+    def record(self, endpoint, status, latency):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            self.statuses[endpoint][status] += 1
+
+    def summary(self, elapsed):
+        """Throughput, latency percentiles (ms) and error rate of every endpoint and of all of them"""
+        def summarize(latencies, statuses):
+            latencies = np.array(latencies) * 1000
+            errors = sum(count for status, count in statuses.items() if not (isinstance(status, int) and status < 400))
+            requests = len(latencies)
+            return {
+                'requests': requests,
+                'throughput': requests / elapsed if elapsed else 0,
+                'errors': errors,
+                'error_rate': errors / requests if requests else 0,
+                'latency_ms': {
+                    'mean': float(latencies.mean()),
+                    'p50': float(np.percentile(latencies, 50)),
+                    'p95': float(np.percentile(latencies, 95)),
+                    'p99': float(np.percentile(latencies, 99)),
+                    'max': float(latencies.max()),
+                } if requests else None,
+                'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+            }
+
+        endpoints = {
+            endpoint: summarize(self.latencies[endpoint], self.statuses[endpoint])
+            for endpoint in ENDPOINTS if endpoint in self.latencies
+        }
+        total = summarize(
+            [latency for latencies in self.latencies.values() for latency in latencies],
+            sum(self.statuses.values(), Counter()),
+        )
+        return {'elapsed': elapsed, 'endpoints': endpoints, 'total': total}
+
+
+class Worker(threading.Thread):
+    """Sends requests of the mix until the deadline or until the shared request budget is spent"""
+
+    def __init__(self, index, fixture, base_url, mix, deadline, budget, recorder, seed, timeout):
+        super().__init__(name=f'loadtest-worker-{index}', daemon=True)
+        self.fixture = fixture
+        self.client = Client(base_url, timeout)
+        self.token = fixture.respondent_tokens[index % len(fixture.respondent_tokens)]
+        self.endpoints, self.weights = zip(*mix.items())
+        self.deadline = deadline
+        self.budget = budget
+        self.recorder = recorder
+        self.rng = random.Random(seed * 1000 + index)
+        # (response id, answer id of the updated question) of the responses submitted by the worker
+        self.submitted = []
+        # submitted responses the added question was not answered for yet
+        self.incomplete = []
+
+    def run(self):
+        try:
+            while time.monotonic() < self.deadline and self.budget.take():
+                endpoint = self.rng.choices(self.endpoints, self.weights)[0]
+                if endpoint == 'bulk_update' and not self.submitted or endpoint == 'add_answers' and not self.incomplete:
+                    # a response of the worker is needed first
+                    endpoint = 'submit'
+                self.send(endpoint)
+        finally:
+            self.client.close()
+
+    def send(self, endpoint):
+        method, path, token, data = getattr(self, endpoint)()
+        started = time.perf_counter()
+        try:
+            status, content = self.client.request(method, path, token, data)
+        except Exception as e:
+            self.recorder.record(endpoint, type(e).__name__, time.perf_counter() - started)
+            return
+        self.recorder.record(endpoint, status, time.perf_counter() - started)
+        if endpoint == 'submit' and status == 201:
+            response = json.loads(content)
+            self.submitted.append((response['id'], next(
+                answer['id'] for answer in response['answers'] if answer['question'] == self.fixture.updated_question.id
+            )))
+            self.incomplete.append(response['id'])
+
+    def retrieve(self):
+        # as an anonymous respondent loading the survey
+        return 'GET', reverse('survey-detail', args=[self.fixture.survey.id]), None, None
+
+    def submit(self):
+        answers = [
+            {'question': question.id, 'value': answer_value(question, self.rng)}
+            for question in self.fixture.questions if question.id != self.fixture.added_question.id
+        ]
+        return 'POST', reverse('survey-responses-list'), self.token, {
+            'survey': self.fixture.survey.id, 'answers': answers,
+        }
+
+    def bulk_update(self):
+        response_id, answer_id = self.rng.choice(self.submitted)
+        return 'PATCH', reverse('response-answers-bulk-update', kwargs={'response_pk': response_id}), self.token, {
+            'answers': [{'id': answer_id, 'value': answer_value(self.fixture.updated_question, self.rng)}],
+        }
+
+    def add_answers(self):
+        response_id = self.incomplete.pop()
+        question = self.fixture.added_question
+        return 'POST', reverse('response-answers-add-answers', kwargs={'response_pk': response_id}), self.token, {
+            'answers': [{'question': question.id, 'value': answer_value(question, self.rng)}],
+        }
+
+    def management(self):
+        return 'GET', reverse('survey-management'), self.fixture.creator_token, None
+
+
+class Budget:
+    """Number of requests left to send, unlimited when None"""
+
+    def __init__(self, requests):
+        self.lock = threading.Lock()
+        self.left = requests
+
+    def take(self):
+        if self.left is None:
+            return True
+        with self.lock:
+            if self.left <= 0:
+                return False
+            self.left -= 1
+            return True
+
+
+def run_load_test(fixture, base_url, workers=8, duration=30, requests=None, mix=DEFAULT_MIX, seed=0, timeout=10):
+    """Run the workers against the server for `duration` seconds or `requests` requests, return the summary"""
+    recorder = Recorder()
+    budget = Budget(requests)
+    mix = {endpoint: weight for endpoint, weight in mix.items() if weight > 0}
+    started = time.monotonic()
+    threads = [
+        Worker(index, fixture, base_url, mix, started + duration, budget, recorder, seed, timeout)
+        for index in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder.summary(time.monotonic() - started)
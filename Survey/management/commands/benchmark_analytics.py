@@ -0,0 +1,100 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Survey.benchmarks import (
+    BENCHMARKS, DEFAULT_REPEAT, DEFAULT_SCALES, DEFAULT_SCAN_LIMIT, PATHS, compare_results, run_benchmarks,
+)
+
+
+def _list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+class Command(BaseCommand):
+    help = (
+        'Time the survey analytics on synthetic surveys of several sizes and write the results as JSON, '
+        'optionally compared with the results of another commit. Run it against a development database: '
+        'the synthetic surveys are created and deleted in it.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scales', default=','.join(map(str, DEFAULT_SCALES)),
+            help='Comma separated numbers of responses of the benchmarked surveys',
+        )
+        parser.add_argument(
+            '--benchmarks', default=','.join(BENCHMARKS),
+            help=f"Comma separated benchmarks to run, among {', '.join(BENCHMARKS)}",
+        )
+        parser.add_argument('--paths', default=','.join(PATHS), help='Comma separated paths: matrix and/or queryset')
+        parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='Timed runs of every case')
+        parser.add_argument(
+            '--scan-limit', type=int, default=DEFAULT_SCAN_LIMIT,
+            help='Largest survey the queryset path and the PDF export are run on',
+        )
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic surveys')
+        parser.add_argument('--output', help='Write the results to this file instead of the standard output')
+        parser.add_argument('--compare', help='Results of a previous run to compare the median timings with')
+        parser.add_argument(
+            '--threshold', type=float, default=0.1,
+            help='Relative change of a median timing reported as a regression or an improvement',
+        )
+        parser.add_argument('--keep', action='store_true', help='Keep the synthetic surveys')
+
+    def handle(self, *args, **options):
+        try:
+            scales = [int(scale) for scale in _list(options['scales'])]
+        except ValueError:
+            raise CommandError('--scales must be comma separated numbers of responses')
+        benchmarks = _list(options['benchmarks'])
+        paths = _list(options['paths'])
+        if unknown := set(benchmarks) - set(BENCHMARKS):
+            raise CommandError(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+        if unknown := set(paths) - set(PATHS):
+            raise CommandError(f"Unknown paths: {', '.join(sorted(unknown))}")
+        if not scales or min(scales) < 1 or options['repeat'] < 1:
+            raise CommandError('--scales and --repeat must be at least 1')
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as baseline_file:
+                    baseline = json.load(baseline_file)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Cannot read the results to compare with: {e}")
+
+        log = (lambda line: self.stderr.write(line)) if options['verbosity'] else None
+        results = run_benchmarks(
+            scales=scales,
+            benchmarks=benchmarks,
+            paths=paths,
+            repeat=options['repeat'],
+            scan_limit=options['scan_limit'],
+            seed=options['seed'],
+            keep=options['keep'],
+            log=log,
+        )
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output + '\n')
+            self.stderr.write(f"Results written to {options['output']}")
+        else:
+            self.stdout.write(output)
+
+        if baseline is not None:
+            self.report(compare_results(baseline, results), baseline['meta'].get('commit'), options['threshold'])
+
+    def report(self, comparison, baseline_commit, threshold):
+        self.stderr.write(f"Median timings compared with {baseline_commit or 'the baseline'}:")
+        for case in comparison:
+            line = (
+                f"{case['scale']:>8} {case['benchmark']} {case['variant']} ({case['path']}): "
+                f"{case['baseline'] * 1000:.2f} ms -> {case['current'] * 1000:.2f} ms"
+            )
+            if case['ratio'] is not None and case['ratio'] > 1 + threshold:
+                self.stderr.write(self.style.ERROR(f"{line}, {case['ratio']:.2f}x slower"))
+            elif case['ratio'] is not None and case['ratio'] < 1 - threshold:
+                self.stderr.write(self.style.SUCCESS(f"{line}, {1 / case['ratio']:.2f}x faster"))
+            else:
+                self.stderr.write(line)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from Survey.models import Upload
+from Survey.uploads import discard_upload
+
+
+class Command(BaseCommand):
+    help = 'Delete the uploads not completed and attached before they expired, with their files'
+
+    def handle(self, *args, **options):
+        discarded = 0
+        for upload in Upload.objects.filter(expires_at__lte=timezone.now()).iterator():
+            discard_upload(upload)
+            discarded += 1
+        self.stdout.write(self.style.SUCCESS(f"Deleted {discarded} expired uploads"))
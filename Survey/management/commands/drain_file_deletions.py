@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from Survey.config import FILE_DELETION_BATCH_SIZE
+from Survey.deletion import drain_file_deletions
+
+
+class Command(BaseCommand):
+    help = 'Release the queued files of deleted answers and questions, e.g. left by a stopped process'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=FILE_DELETION_BATCH_SIZE,
+            help='Queued releases processed per transaction',
+        )
+
+    def handle(self, *args, **options):
+        processed = drain_file_deletions(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Processed {processed} queued file releases"))
@@ -0,0 +1,72 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from Survey.models import Question
+from Survey.synthetic import DEFAULT_QUESTION_COUNTS, generate_dataset
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        'Create reproducible synthetic surveys with their respondents, responses and answers: '
+        'the same --seed and options always give the same data.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the dataset')
+        parser.add_argument('--surveys', type=int, default=1, help='Number of surveys')
+        parser.add_argument('--responses', type=int, default=1000, help='Responses per survey')
+        parser.add_argument(
+            '--respondents', type=int, default=200,
+            help='Registered respondents with demographics, shared by the surveys of the seed',
+        )
+        for question_type, count in DEFAULT_QUESTION_COUNTS.items():
+            parser.add_argument(
+                f"--{question_type.split('_')[0]}-questions", dest=f'{question_type}_questions',
+                type=int, default=count, help=f'{question_type} questions per survey',
+            )
+        parser.add_argument('--answer-rate', type=float, default=0.9, help='Share of the optional questions answered')
+        parser.add_argument('--anonymous-rate', type=float, default=0.1, help='Share of the anonymous responses')
+        parser.add_argument('--days', type=int, default=90, help='Days the submissions are spread over')
+        parser.add_argument('--open', action='store_true', help='Leave the surveys open instead of closed')
+        parser.add_argument('--creator', help='Email of the creator of the surveys, a synthetic user by default')
+
+    def handle(self, *args, **options):
+        question_counts = {
+            question_type: options[f'{question_type}_questions'] for question_type in Question.QUESTION_TYPES.values
+        }
+        if min(options['surveys'], options['responses'], options['respondents'], *question_counts.values()) < 0:
+            raise CommandError('The numbers of surveys, responses, respondents and questions must be positive')
+        if not 0 <= options['answer_rate'] <= 1 or not 0 <= options['anonymous_rate'] <= 1:
+            raise CommandError('--answer-rate and --anonymous-rate must be between 0 and 1')
+        creator = None
+        if options['creator']:
+            try:
+                creator = User.objects.get(email=options['creator'])
+            except User.DoesNotExist:
+                raise CommandError(f"No user with the email {options['creator']}")
+
+        started = time.monotonic()
+        surveys = generate_dataset(
+            options['seed'],
+            surveys=options['surveys'],
+            responses=options['responses'],
+            respondents=options['respondents'],
+            creator=creator,
+            question_counts=question_counts,
+            answer_rate=options['answer_rate'],
+            anonymous_rate=options['anonymous_rate'],
+            days=options['days'],
+            closed=not options['open'],
+        )
+        for survey in surveys:
+            self.stdout.write(f"Survey {survey.id} ({survey.title}): {options['responses']} responses")
+        elapsed = time.monotonic() - started
+        total_responses = options['surveys'] * options['responses']
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {options['surveys']} surveys with {total_responses} responses in {elapsed:.1f}s "
+            f"({total_responses / elapsed if elapsed else 0:.0f} responses/s)"
+        ))
@@ -0,0 +1,92 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Survey.deletion import delete_survey_in_batches
+from Survey.loadtest import DEFAULT_MIX, ENDPOINTS, create_fixture, run_load_test
+
+
+def _mix(value):
+    mix = {}
+    for item in value.split(','):
+        endpoint, _, weight = item.partition('=')
+        endpoint = endpoint.strip()
+        if endpoint not in ENDPOINTS:
+            raise CommandError(f"Unknown endpoint {endpoint}, the endpoints are {', '.join(ENDPOINTS)}")
+        try:
+            mix[endpoint] = float(weight) if weight else 1.0
+        except ValueError:
+            raise CommandError(f'The weight of {endpoint} must be a number')
+    if not any(weight > 0 for weight in mix.values()):
+        raise CommandError('At least one endpoint must have a positive weight')
+    return mix
+
+
+class Command(BaseCommand):
+    help = (
+        'Load test a running server with concurrent workers sending a mix of survey, submission and '
+        'answer requests, and report the throughput, latency percentiles and error rate of every endpoint. '
+        'The survey under load is created in the database of the server and deleted afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Base URL of the server')
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent workers')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to run for')
+        parser.add_argument('--requests', type=int, help='Stop after this many requests')
+        parser.add_argument(
+            '--mix', default=','.join(f'{endpoint}={weight}' for endpoint, weight in DEFAULT_MIX.items()),
+            help=f"Comma separated endpoint=weight of the requests, among {', '.join(ENDPOINTS)}",
+        )
+        parser.add_argument('--timeout', type=float, default=10, help='Seconds to wait for a response')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the survey, respondents and answers')
+        parser.add_argument('--output', help='Also write the results as JSON to this file')
+        parser.add_argument('--keep', action='store_true', help='Keep the survey and its responses')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['duration'] <= 0 or (options['requests'] or 1) < 1:
+            raise CommandError('--workers, --duration and --requests must be positive')
+        mix = _mix(options['mix'])
+
+        fixture = create_fixture(options['seed'], options['workers'])
+        self.stdout.write(
+            f"Load testing {options['url']} with {options['workers']} workers on survey {fixture.survey.id}"
+        )
+        try:
+            results = run_load_test(
+                fixture,
+                options['url'],
+                workers=options['workers'],
+                duration=options['duration'],
+                requests=options['requests'],
+                mix=mix,
+                seed=options['seed'],
+                timeout=options['timeout'],
+            )
+        finally:
+            if not options['keep']:
+                for _ in delete_survey_in_batches(fixture.survey):
+                    pass
+
+        self.report(results)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump({'url': options['url'], 'workers': options['workers'], 'mix': mix, **results}, output_file, indent=2)
+        if results['total']['requests'] and results['total']['errors'] == results['total']['requests']:
+            raise CommandError(f"Every request failed, is the server running at {options['url']}?")
+
+    def report(self, results):
+        self.stdout.write(
+            f"{'endpoint':<12} {'requests':>9} {'req/s':>8} {'errors':>7} "
+            f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+        )
+        for endpoint, summary in [*results['endpoints'].items(), ('total', results['total'])]:
+            latency = summary['latency_ms'] or dict.fromkeys(['p50', 'p95', 'p99', 'max'], 0)
+            line = (
+                f"{endpoint:<12} {summary['requests']:>9} {summary['throughput']:>8.1f} {summary['error_rate']:>7.1%} "
+                f"{latency['p50']:>8.1f} {latency['p95']:>8.1f} {latency['p99']:>8.1f} {latency['max']:>8.1f}"
+            )
+            self.stdout.write(self.style.ERROR(line) if summary['errors'] else line)
+            if summary['errors']:
+                self.stdout.write(f"{'':<12} statuses: {summary['statuses']}")
+        self.stdout.write(f"{results['elapsed']:.1f}s")
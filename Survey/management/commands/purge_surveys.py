@@ -0,0 +1,112 @@
+import gzip
+import os
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from Survey.config import PURGE_BATCH_SIZE
+from Survey.deletion import delete_survey_in_batches
+from Survey.exports import stream_responses_ndjson
+from Survey.models import Survey
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete the surveys closed for more than --days days, with their responses, by batches of '
+        'responses each in a short transaction. An interrupted purge resumes when run again.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey_ids', nargs='*', type=int, help='Only purge these surveys, if they are old enough')
+        parser.add_argument('--days', type=int, required=True, help='Purge surveys closed for more than this many days')
+        parser.add_argument(
+            '--archive-dir',
+            help='Archive every survey to <dir>/survey-<id>.ndjson.gz before deleting it',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=PURGE_BATCH_SIZE,
+            help='Responses deleted per transaction',
+        )
+        parser.add_argument(
+            '--pause', type=float, default=0,
+            help='Seconds to wait between batches, letting other writers through',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Only list the surveys that would be purged')
+
+    def handle(self, *args, **options):
+        if options['days'] < 0 or options['batch_size'] < 1:
+            raise CommandError('--days must be positive and --batch-size at least 1')
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        surveys = Survey.objects.filter(closes_at__lt=cutoff).order_by('id')
+        if options['survey_ids']:
+            surveys = surveys.filter(id__in=options['survey_ids'])
+        if options['archive_dir']:
+            os.makedirs(options['archive_dir'], exist_ok=True)
+
+        total_responses = 0
+        started = time.monotonic()
+        for survey in surveys.iterator():
+            if options['dry_run']:
+                self.stdout.write(
+                    f"Survey {survey.id} ({survey.title}), closed {survey.closes_at:%Y-%m-%d}: "
+                    f"{survey.responses.count()} responses"
+                )
+                continue
+            if options['archive_dir']:
+                self.archive(survey, options['archive_dir'])
+            total_responses += self.purge(survey, options['batch_size'], options['pause'])
+
+        if not options['dry_run']:
+            elapsed = time.monotonic() - started
+            self.stdout.write(self.style.SUCCESS(
+                f"Purged {total_responses} responses in {elapsed:.1f}s "
+                f"({total_responses / elapsed if elapsed else 0:.0f} responses/s)"
+            ))
+
+    def archive(self, survey, archive_dir):
+        """Write the survey, its questions and its responses, unless archived by an interrupted run"""
+        path = os.path.join(archive_dir, f"survey-{survey.id}.ndjson.gz")
+        if os.path.exists(path):
+            # the responses may already be partly deleted, the first archive is the complete one
+            self.stdout.write(f"Survey {survey.id}: already archived to {path}")
+            return
+        header = {
+            'survey': {
+                'id': survey.id,
+                'title': survey.title,
+                'description': survey.description,
+                'creator_id': survey.creator_id,
+                'created_at': survey.created_at,
+                'closes_at': survey.closes_at,
+                'respondent_auth_requirement': survey.respondent_auth_requirement,
+            },
+            'questions': list(survey.questions.values(
+                'id', 'question_text', 'question_type', 'required', 'order', 'settings'
+            )),
+        }
+        partial = f"{path}.part"
+        with gzip.open(partial, 'wb') as archive:
+            archive.write((DjangoJSONEncoder().encode(header) + '\n').encode())
+            for chunk in stream_responses_ndjson(survey):
+                archive.write(chunk)
+        # only complete archives are found by a resumed run
+        os.replace(partial, path)
+        self.stdout.write(f"Survey {survey.id}: archived to {path}")
+
+    def purge(self, survey, batch_size, pause):
+        survey_id = survey.id
+        deleted = 0
+        started = time.monotonic()
+        for count in delete_survey_in_batches(survey, batch_size):
+            deleted += count
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                f"Survey {survey_id}: deleted {deleted} responses ({deleted / elapsed if elapsed else 0:.0f}/s)"
+            )
+            if pause:
+                time.sleep(pause)
+        self.stdout.write(f"Survey {survey_id}: deleted in {time.monotonic() - started:.1f}s")
+        return deleted
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from Survey.facts import rebuild_survey_facts
+from Survey.models import Survey
+
+
+class Command(BaseCommand):
+    help = 'Rewrite the analytics facts of the answers, e.g. for answers stored before the facts existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey_ids', nargs='*', type=int, help='Surveys to rebuild (all surveys by default)')
+
+    def handle(self, *args, **options):
+        surveys = Survey.objects.order_by('id')
+        if options['survey_ids']:
+            surveys = surveys.filter(id__in=options['survey_ids'])
+            missing = set(options['survey_ids']) - set(surveys.values_list('id', flat=True))
+            if missing:
+                raise CommandError(f"Surveys not found: {', '.join(map(str, sorted(missing)))}")
+
+        for survey in surveys.iterator():
+            written = rebuild_survey_facts(survey)
+            self.stdout.write(f"Survey {survey.id}: wrote {written} answer facts")
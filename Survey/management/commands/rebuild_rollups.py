@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from Survey.models import QuestionRollup, Survey
+from Survey.rollups import ROLLUP_FIELDS, build_survey_rollups, rebuild_survey_rollups
+
+COMPARED_FIELDS = [field for field in ROLLUP_FIELDS if field != 'updated_at']
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the question rollups from the stored answers, or verify them with --verify'
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey_ids', nargs='*', type=int, help='Surveys to rebuild (all surveys by default)')
+        parser.add_argument(
+            '--verify', action='store_true',
+            help='Only compare the stored rollups with the answers and report the differences',
+        )
+
+    def handle(self, *args, **options):
+        surveys = Survey.objects.order_by('id')
+        if options['survey_ids']:
+            surveys = surveys.filter(id__in=options['survey_ids'])
+            missing = set(options['survey_ids']) - set(surveys.values_list('id', flat=True))
+            if missing:
+                raise CommandError(f"Surveys not found: {', '.join(map(str, sorted(missing)))}")
+
+        mismatches = 0
+        for survey in surveys.iterator():
+            if options['verify']:
+                mismatches += self.verify(survey)
+            else:
+                rollups = rebuild_survey_rollups(survey)
+                self.stdout.write(f"Survey {survey.id}: rebuilt {len(rollups)} question rollups")
+
+        if options['verify']:
+            if mismatches:
+                raise CommandError(f"{mismatches} question rollups do not match the answers")
+            self.stdout.write(self.style.SUCCESS('All question rollups match the answers'))
+
+    def verify(self, survey):
+        stored = {rollup.question_id: rollup for rollup in QuestionRollup.objects.filter(question__survey=survey)}
+        mismatches = 0
+        for question_id, expected in build_survey_rollups(survey).items():
+            rollup = stored.get(question_id)
+            if rollup is None:
+                differences = ['missing']
+            else:
+                differences = [
+                    field for field in COMPARED_FIELDS
+                    if not self.same_value(getattr(rollup, field), getattr(expected, field))
+                ]
+            if differences:
+                mismatches += 1
+                self.stdout.write(self.style.WARNING(
+                    f"Survey {survey.id}, question {question_id}: {', '.join(differences)} differ"
+                ))
+        return mismatches
+
+    @staticmethod
+    def same_value(stored, expected):
+        if isinstance(expected, float):
+            # sums accumulated incrementally may differ in the last bits
+            return abs(stored - expected) <= 1e-9 * max(1.0, abs(expected))
+        return stored == expected
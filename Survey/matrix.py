@@ -0,0 +1,338 @@
+"""
+Columnar responses x questions representation of a survey's answers.
+
+Closed surveys do not change anymore, so their answers are materialized once
+per survey data version as `.npy` files under MEDIA_ROOT and memory-mapped by
+every analytics computation instead of re-reading the Answer rows:
+
+- ratings are stored as float64 columns (NaN when not answered)
+- single choices as int32 option indices (-1 when not answered)
+- multiple choices as uint64 option bitmasks, or a responses x options
+  boolean matrix when a question has more than 64 options
+"""
+import datetime
+import json
+import os
+import re
+import shutil
+import uuid
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from .config import ANSWER_MATRIX_DIR
+from .models import Answer, AnswerFact, Question
+
+MAX_BITMASK_OPTIONS = 64
+MANIFEST_NAME = 'manifest.json'
+
+
+class AnswerMatrix:
+    """
+    Answers of a survey as numpy columns, one row per response ordered by response id.
+    """
+
+    def __init__(self, survey_id, data_version, questions, response_ids, respondent_ids,
+                 submitted_at, completion_seconds, answered, columns):
+        self.survey_id = survey_id
+        self.data_version = data_version
+        # question_id -> {'type': ..., 'options': [...], 'encoding': ...}
+        self.questions = questions
+        self.response_ids = response_ids
+        self.respondent_ids = respondent_ids  # -1 for anonymous responses
+        self.submitted_at = submitted_at  # datetime64[us], UTC
+        self.completion_seconds = completion_seconds  # NaN when unknown
+        self.answered = answered  # responses x questions booleans, in self.questions order
+        self.columns = columns  # question_id -> encoded column
+        self._question_index = {question_id: i for i, question_id in enumerate(questions)}
+
+    def __len__(self):
+        return len(self.response_ids)
+
+    def all_rows(self):
+        return np.ones(len(self), dtype=bool)
+
+    def rows_for_responses(self, response_ids):
+        """Row mask of the given response ids"""
+        return np.isin(self.response_ids, np.asarray(list(response_ids), dtype=np.int64))
+
+    def is_encoded(self, question_id):
+        return question_id in self.columns
+
+    def question_type(self, question_id):
+        return self.questions[question_id]['type']
+
+    def options(self, question_id):
+        return self.questions[question_id]['options']
+
+    def answered_rows(self, question_id):
+        """Row mask of the responses that have an answer to the question"""
+        if question_id not in self._question_index:
+            return np.zeros(len(self), dtype=bool)
+        return np.asarray(self.answered[:, self._question_index[question_id]])
+
+    def ratings(self, question_id):
+        return np.asarray(self.columns[question_id], dtype=np.float64)
+
+    def selections(self, question_id):
+        """responses x options boolean matrix of the selected options of a choice question"""
+        column = np.asarray(self.columns[question_id])
+        encoding = self.questions[question_id]['encoding']
+        option_count = len(self.options(question_id))
+        if encoding == 'index':
+            return column[:, None] == np.arange(option_count)[None, :]
+        if encoding == 'bitmask':
+            bits = np.left_shift(np.uint64(1), np.arange(option_count, dtype=np.uint64))
+            return (column[:, None] & bits[None, :]) != 0
+        return column.astype(bool)
+
+    def match_rows(self, question_id, value):
+        """
+        Row mask of the responses whose answer to the question matches the value,
+        the chosen option for choice questions or the exact rating for rating questions.
+        Returns None when the question is not encoded in the matrix.
+        """
+        if not self.is_encoded(question_id):
+            return None
+        if self.question_type(question_id) == Question.QUESTION_TYPES.RATING:
+            try:
+                return self.ratings(question_id) == float(value)
+            except (TypeError, ValueError):
+                return np.zeros(len(self), dtype=bool)
+        options = [str(option) for option in self.options(question_id)]
+        if str(value) not in options:
+            return np.zeros(len(self), dtype=bool)
+        return self.selections(question_id)[:, options.index(str(value))]
+
+    def raw_values(self, question_id, rows):
+        """
+        Rebuild the stored answer values of the given rows, None where there is no answer.
+        Multiple choice selections come back in option order.
+        """
+        question_type = self.question_type(question_id)
+        answered = self.answered_rows(question_id)
+        indices = np.flatnonzero(rows)
+        if question_type == Question.QUESTION_TYPES.RATING:
+            ratings = self.ratings(question_id)
+            return [float(ratings[i]) if answered[i] else None for i in indices]
+        options = self.options(question_id)
+        selections = self.selections(question_id)
+        if question_type == Question.QUESTION_TYPES.SINGLE:
+            return [
+                {'choice': options[int(np.argmax(selections[i]))]} if answered[i] and selections[i].any() else None
+                for i in indices
+            ]
+        return [
+            {'choices': [options[j] for j in np.flatnonzero(selections[i])]} if answered[i] else None
+            for i in indices
+        ]
+
+    def save(self, directory):
+        """Write the matrix as .npy files plus a json manifest into the directory"""
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'response_ids.npy'), self.response_ids)
+        np.save(os.path.join(directory, 'respondent_ids.npy'), self.respondent_ids)
+        np.save(os.path.join(directory, 'submitted_at.npy'), self.submitted_at)
+        np.save(os.path.join(directory, 'completion_seconds.npy'), self.completion_seconds)
+        np.save(os.path.join(directory, 'answered.npy'), self.answered)
+        for question_id, column in self.columns.items():
+            np.save(os.path.join(directory, f'question_{question_id}.npy'), column)
+        manifest = {
+            'survey_id': self.survey_id,
+            'data_version': self.data_version,
+            'questions': [{'id': question_id, **meta} for question_id, meta in self.questions.items()],
+        }
+        with open(os.path.join(directory, MANIFEST_NAME), 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+
+    @classmethod
+    def load(cls, directory):
+        """Memory-map a matrix written by save()"""
+        with open(os.path.join(directory, MANIFEST_NAME)) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        def load_array(name):
+            try:
+                return np.load(os.path.join(directory, name), mmap_mode='r')
+            except ValueError:
+                # empty arrays (a survey without responses) cannot be memory-mapped
+                return np.load(os.path.join(directory, name))
+
+        questions = {meta.pop('id'): meta for meta in manifest['questions']}
+        return cls(
+            survey_id=manifest['survey_id'],
+            data_version=manifest['data_version'],
+            questions=questions,
+            response_ids=load_array('response_ids.npy'),
+            respondent_ids=load_array('respondent_ids.npy'),
+            submitted_at=load_array('submitted_at.npy'),
+            completion_seconds=load_array('completion_seconds.npy'),
+            answered=load_array('answered.npy'),
+            columns={
+                question_id: load_array(f'question_{question_id}.npy')
+                for question_id, meta in questions.items() if meta['encoding']
+            },
+        )
+
+
+def build_answer_matrix(survey):
+    """Build the answer matrix of a survey from one scan of its responses, answers and answer facts"""
+    questions = list(survey.questions.all())
+    responses = list(
+        survey.responses.order_by('id').values_list('id', 'respondent_id', 'submitted_at', 'completion_time')
+    )
+    response_count = len(responses)
+    response_ids = np.array([r[0] for r in responses], dtype=np.int64)
+    respondent_ids = np.array([r[1] if r[1] is not None else -1 for r in responses], dtype=np.int64)
+    submitted_at = np.array(
+        [timezone.make_naive(r[2], datetime.timezone.utc) if timezone.is_aware(r[2]) else r[2] for r in responses],
+        dtype='datetime64[us]'
+    )
+    completion_seconds = np.array(
+        [r[3].total_seconds() if r[3] is not None else np.nan for r in responses], dtype=np.float64
+    )
+    row_of = {response_id: i for i, response_id in enumerate(response_ids.tolist())}
+
+    question_meta = {}
+    question_index = {}
+    ratings = {}
+    single_choices = {}
+    multiple_choices = {}
+    for i, question in enumerate(questions):
+        question_index[question.id] = i
+        options = list(question.settings.get('options') or []) if question.question_type != Question.QUESTION_TYPES.RATING else []
+        question_meta[question.id] = {
+            'type': question.question_type,
+            'options': options,
+            'encoding': None,
+        }
+        if question.question_type == Question.QUESTION_TYPES.RATING:
+            ratings[question.id] = np.full(response_count, np.nan, dtype=np.float64)
+        elif question.question_type == Question.QUESTION_TYPES.SINGLE:
+            single_choices[question.id] = np.full(response_count, -1, dtype=np.int32)
+        elif question.question_type == Question.QUESTION_TYPES.MULTIPLE:
+            multiple_choices[question.id] = {}  # row -> option indices
+
+    option_index = {
+        question_id: {option: j for j, option in enumerate(meta['options'])}
+        for question_id, meta in question_meta.items()
+    }
+
+    def encode_option(question_id, option):
+        indices = option_index[question_id]
+        if option not in indices:
+            # flexable questions accept choices that are not in the settings options
+            indices[option] = len(indices)
+            question_meta[question_id]['options'].append(option)
+        return indices[option]
+
+    answered = np.zeros((response_count, len(questions)), dtype=bool)
+    answered_pairs = Answer.objects.filter(response__survey=survey).values_list('response_id', 'question_id')
+    for response_id, question_id in answered_pairs.iterator(chunk_size=5000):
+        row = row_of.get(response_id)
+        if row is not None and question_id in question_index:
+            answered[row, question_index[question_id]] = True
+
+    # the values are read from the typed answer facts, without decoding the JSON of the answers
+    facts = AnswerFact.objects.filter(survey=survey).values_list('response_id', 'question_id', 'rating', 'choice')
+    for response_id, question_id, rating, choice in facts.iterator(chunk_size=5000):
+        row = row_of.get(response_id)
+        if row is None:
+            continue
+        if question_id in ratings:
+            if rating is not None:
+                ratings[question_id][row] = rating
+        elif question_id in single_choices:
+            if choice is not None:
+                single_choices[question_id][row] = encode_option(question_id, choice)
+        elif question_id in multiple_choices:
+            if choice is not None:
+                multiple_choices[question_id].setdefault(row, []).append(encode_option(question_id, choice))
+
+    columns = {}
+    for question_id, column in ratings.items():
+        columns[question_id] = column
+        question_meta[question_id]['encoding'] = 'float'
+    for question_id, column in single_choices.items():
+        columns[question_id] = column
+        question_meta[question_id]['encoding'] = 'index'
+    for question_id, selections in multiple_choices.items():
+        option_count = len(question_meta[question_id]['options'])
+        if option_count <= MAX_BITMASK_OPTIONS:
+            column = np.zeros(response_count, dtype=np.uint64)
+            for row, indices in selections.items():
+                for j in indices:
+                    column[row] |= np.uint64(1) << np.uint64(j)
+            question_meta[question_id]['encoding'] = 'bitmask'
+        else:
+            column = np.zeros((response_count, option_count), dtype=bool)
+            for row, indices in selections.items():
+                column[row, indices] = True
+            question_meta[question_id]['encoding'] = 'boolean'
+        columns[question_id] = column
+
+    return AnswerMatrix(
+        survey_id=survey.id,
+        data_version=survey.data_version,
+        questions=question_meta,
+        response_ids=response_ids,
+        respondent_ids=respondent_ids,
+        submitted_at=submitted_at,
+        completion_seconds=completion_seconds,
+        answered=answered,
+        columns=columns,
+    )
+
+
+def answer_matrix_directory(survey, data_version=None):
+    """MEDIA_ROOT/analytics/<survey_id>/v<data_version>"""
+    survey_directory = os.path.join(settings.MEDIA_ROOT, ANSWER_MATRIX_DIR, str(survey.id))
+    if data_version is None:
+        return survey_directory
+    return os.path.join(survey_directory, f'v{data_version}')
+
+
+def get_answer_matrix(survey):
+    """
+    Return the answer matrix of the survey, or None when SURVEY_ANSWER_MATRIX_ENABLED is off.
+    Closed surveys get their matrix materialized once per data version and memory-mapped on later calls,
+    open surveys are scanned into memory on every call.
+    """
+    if not getattr(settings, 'SURVEY_ANSWER_MATRIX_ENABLED', True):
+        return None
+    if not survey.is_closed:
+        return build_answer_matrix(survey)
+
+    directory = answer_matrix_directory(survey, survey.data_version)
+    if os.path.exists(os.path.join(directory, MANIFEST_NAME)):
+        return AnswerMatrix.load(directory)
+
+    matrix = build_answer_matrix(survey)
+    # write into a private directory first so concurrent readers never see a partial matrix
+    tmp_directory = f'{directory}.tmp-{uuid.uuid4().hex}'
+    try:
+        matrix.save(tmp_directory)
+        os.rename(tmp_directory, directory)
+    except OSError:
+        # another worker published this version first, or MEDIA_ROOT is not writable
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        if not os.path.exists(os.path.join(directory, MANIFEST_NAME)):
+            return matrix
+    else:
+        _remove_stale_versions(survey, survey.data_version)
+    return AnswerMatrix.load(directory)
+
+
+def delete_answer_matrices(survey):
+    """Delete the matrices of every data version of a deleted survey, with their bitmap indexes"""
+    shutil.rmtree(answer_matrix_directory(survey), ignore_errors=True)
+
+
+def _remove_stale_versions(survey, data_version):
+    """Delete the matrices (and abandoned temporary directories) of older data versions"""
+    survey_directory = answer_matrix_directory(survey)
+    for name in os.listdir(survey_directory):
+        version = re.match(r'v(\d+)', name)
+        if version and int(version.group(1)) < data_version:
+            shutil.rmtree(os.path.join(survey_directory, name), ignore_errors=True)
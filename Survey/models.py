@@ -5,6 +5,8 @@ from django.db import models
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
 import json
+import uuid
+from .config import ANSWER_FILE_PATH_KEY
 User = get_user_model()
 
 class Survey(models.Model):
@@ -25,10 +27,45 @@ class Survey(models.Model):
         default=AuthRequirement.QUICK,
         help_text='Level of authentication required for respondents'
     )
+    data_version = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text='Bumped whenever a response or an answer of the survey changes'
+    )
+    schema_version = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text='Bumped whenever a question of the survey changes'
+    )
+
+    class Meta:
+        indexes = [
+            # default ordering of the cursor paginated listings
+            models.Index(fields=['-created_at', 'id'], name='survey_created_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        # the versions are only changed through the bump methods, never written back from a (possibly stale) instance
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in ('data_version', 'schema_version')
+            ]
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def bump_data_version(cls, **filters):
+        """Increase the data version of the matching surveys so derived analytics data gets rebuilt"""
+        return cls.objects.filter(**filters).update(data_version=models.F('data_version') + 1)
+
+    @classmethod
+    def bump_schema_version(cls, **filters):
+        """Increase the schema version of the matching surveys so what is compiled from their questions gets rebuilt"""
+        return cls.objects.filter(**filters).update(schema_version=models.F('schema_version') + 1)
+
     @property
     def is_closed(self):
         from django.utils import timezone
@@ -122,7 +159,12 @@ class Response(models.Model):
     submitted_at = models.DateTimeField(auto_now_add=True)
     completion_time = models.DurationField(null=True, blank=True)
 
-    
+    class Meta:
+        indexes = [
+            # keyset pagination of the responses of a survey
+            models.Index(fields=['survey', '-submitted_at', '-id'], name='response_survey_submitted_idx'),
+        ]
+
     def __str__(self):
         return f"Response to {self.survey.title} at {self.submitted_at}"
 
@@ -155,49 +197,168 @@ class Answer(models.Model):
 
     def validate_answer_format(self):
         """Validate answer format based on question type"""
-        question_type = self.question.question_type
-        settings = self.question.settings
+        from .validators import get_survey_validators
 
         if not self.value and not self.question.required:
             return
 
-        if question_type == 'text':
-            if not isinstance(self.value, str):
-                raise ValidationError("Text answer must be a string")
-            min_length = settings.get('min_length')
-            max_length = settings.get('max_length')
-            if min_length and len(self.value) < min_length:
-                raise ValidationError(f"Answer must be at least {min_length} characters")
-            if max_length and len(self.value) > max_length:
-                raise ValidationError(f"Answer cannot exceed {max_length} characters")
-
-        elif question_type == 'single_choice':
-            if self.value not in settings.get('options', []):
-                raise ValidationError("Invalid choice selected")
-
-        elif question_type == 'multiple_choice':
-            if not isinstance(self.value, list):
-                raise ValidationError("Multiple choice answer must be a list")
-            options = settings.get('options', [])
-            if not all(choice in options for choice in self.value):
-                raise ValidationError("Invalid choices selected")
-            min_selections = settings.get('min_selections', 1)
-            max_selections = settings.get('max_selections')
-            if len(self.value) < min_selections:
-                raise ValidationError(f"Must select at least {min_selections} options")
-            if max_selections and len(self.value) > max_selections:
-                raise ValidationError(f"Cannot select more than {max_selections} options")
-
-        elif question_type == 'rating':
-            try:
-                rating = float(self.value)
-                min_value = float(settings.get('min_value', 1))
-                max_value = float(settings.get('max_value', 5))
-                if not (min_value <= rating <= max_value):
-                    raise ValidationError(f"Rating must be between {min_value} and {max_value}")
-            except (TypeError, ValueError):
-                raise ValidationError("Rating must be a number")
-
-        elif question_type == 'file':
-            if not isinstance(self.value, dict) or 'filename' not in self.value:
+        if self.question.question_type == Question.QUESTION_TYPES.FILE:
+            if not isinstance(self.value, dict) or ANSWER_FILE_PATH_KEY not in self.value:
                 raise ValidationError("Invalid file answer format")
+            return
+        get_survey_validators(self.question.survey).validate(self.question, self.value)
+
+
+class QuestionRollup(models.Model):
+    """
+    Running aggregates of the answers to a question, updated in the same transaction
+    as the answers themselves are created, updated or deleted (see rollups.py).
+    """
+    question = models.OneToOneField(Question, related_name='rollup', on_delete=models.CASCADE)
+    answer_count = models.PositiveIntegerField(default=0)
+    option_counts = models.JSONField(default=dict)  # choice -> count, for choice questions
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.FloatField(default=0)
+    rating_sum_squares = models.FloatField(default=0)
+    rating_counts = models.JSONField(default=dict)  # rating -> count, for rating questions
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Rollup of question {self.question_id}"
+
+
+class AnswerFact(models.Model):
+    """
+    Typed copy of an answer to a rating or choice question for the analytics (see facts.py):
+    the rating, or one row per selected option with its text and its index in the options.
+    Deleted with the response or question; the answer is not a cascading relation so the
+    answers themselves are still deleted set-based, deletion.py deletes their facts.
+    """
+    answer = models.ForeignKey(
+        Answer, related_name='facts', on_delete=models.DO_NOTHING, db_constraint=False
+    )
+    survey = models.ForeignKey(Survey, related_name='+', on_delete=models.CASCADE)
+    question = models.ForeignKey(Question, related_name='facts', on_delete=models.CASCADE)
+    response = models.ForeignKey(Response, related_name='facts', on_delete=models.CASCADE)
+    rating = models.FloatField(null=True, blank=True)
+    choice = models.TextField(null=True, blank=True)
+    # index of the choice in the options of the question, None for answers to flexable questions
+    option_index = models.PositiveIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['question', 'rating'], name='answer_fact_rating_idx'),
+            models.Index(fields=['question', 'choice', 'response'], name='answer_fact_choice_idx'),
+            models.Index(fields=['question', 'option_index'], name='answer_fact_option_idx'),
+            models.Index(fields=['survey', 'question', 'response'], name='answer_fact_survey_idx'),
+        ]
+
+    def __str__(self):
+        return f"Fact of answer {self.answer_id}"
+
+
+class ExportJob(models.Model):
+    """
+    Export of the responses of a survey generated in the background (see jobs.py).
+    Jobs with the same fingerprint (survey, format, options and data version) share
+    their artifact.
+    """
+    class Status(models.TextChoices):
+        PENDING = 'PENDING', 'Pending'
+        RUNNING = 'RUNNING', 'Running'
+        COMPLETED = 'COMPLETED', 'Completed'
+        FAILED = 'FAILED', 'Failed'
+
+    class Format(models.TextChoices):
+        PDF = 'pdf', 'PDF'
+        CSV = 'csv', 'CSV'
+        NDJSON = 'ndjson', 'NDJSON'
+
+    survey = models.ForeignKey(Survey, related_name='export_jobs', on_delete=models.CASCADE)
+    requested_by = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
+    format = models.CharField(max_length=10, choices=Format.choices, default=Format.PDF)
+    options = models.JSONField(default=dict, blank=True)
+    data_version = models.PositiveIntegerField(default=0)
+    fingerprint = models.CharField(max_length=64, db_index=True)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+    artifact_path = models.CharField(max_length=255, blank=True)
+    artifact_size = models.PositiveBigIntegerField(null=True, blank=True)  # compressed size in bytes
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.get_format_display()} export of {self.survey} ({self.status})"
+
+
+class StoredFile(models.Model):
+    """
+    Uploaded file stored once by content (see files.py), shared by the answers and
+    question attachments referencing it and deleted with its last reference.
+    """
+    sha256 = models.CharField(max_length=64)
+    extension = models.CharField(max_length=20)
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['sha256', 'extension'], name='stored_file_content_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.sha256}.{self.extension} ({self.ref_count} references)"
+
+
+class FileDeletion(models.Model):
+    """
+    Reference to a stored file released by a deleted answer, question or upload, queued
+    to be processed by batches in the background (see deletion.py).
+    """
+    path = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Release of {self.path}"
+
+
+class Upload(models.Model):
+    """
+    File uploaded in chunks ahead of the answer or question attachment referencing it
+    (see uploads.py). The upload is consumed, and its row deleted, when it is attached.
+    """
+    class Purpose(models.TextChoices):
+        ANSWER = 'answer', 'Answer file'
+        ATTACHMENT = 'attachment', 'Question attachment'
+
+    class Status(models.TextChoices):
+        UPLOADING = 'UPLOADING', 'Uploading'
+        COMPLETED = 'COMPLETED', 'Completed'
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    purpose = models.CharField(max_length=10, choices=Purpose.choices, default=Purpose.ANSWER)
+    question = models.ForeignKey(Question, related_name='uploads', null=True, blank=True, on_delete=models.CASCADE)
+    uploaded_by = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE)
+    extension = models.CharField(max_length=20)
+    size = models.PositiveBigIntegerField()  # declared size in bytes
+    offset = models.PositiveBigIntegerField(default=0)  # bytes received so far
+    checksum = models.CharField(max_length=64, blank=True)  # sha256 declared by the client
+    sha256 = models.CharField(max_length=64, blank=True)  # sha256 of the received file
+    file_path = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.UPLOADING)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    expires_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Upload {self.pk} ({self.offset}/{self.size} bytes)"
+
+    @property
+    def size_mb(self):
+        return self.size / (1024 * 1024)
@@ -0,0 +1,160 @@
+import base64
+import binascii
+import json
+import operator
+from datetime import datetime
+from functools import reduce
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset pagination following an ordering whose last field is unique.
+
+    A cursor holds the values of the ordering fields of the row a page starts after and
+    the direction to read in, so every page is a range read of an index on the ordering
+    that costs the same at any depth, and rows inserted while paginating neither shift
+    nor duplicate the following pages.
+    """
+    page_size = 50
+    max_page_size = 500
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+    ordering = ('-id',)
+
+    def get_ordering(self, request, queryset, view):
+        return list(self.ordering)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(request, queryset, view)
+        reverse, position = self.decode_cursor(request)
+
+        if position is not None:
+            try:
+                queryset = queryset.filter(self.following(position, reverse))
+            except (ValidationError, ValueError, TypeError):
+                raise NotFound(self.invalid_cursor_message)
+        ordering = [field[1:] if field.startswith('-') else f"-{field}" for field in self.ordering] if reverse else self.ordering
+        results = list(queryset.order_by(*ordering)[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+        return self.page
+
+    def following(self, position, reverse):
+        """Condition of the rows after the position in the reading direction"""
+        conditions = []
+        equal = Q()
+        for field, value in zip(self.ordering, position):
+            name = field.lstrip('-')
+            descending = field.startswith('-') != reverse
+            conditions.append(equal & Q(**{f"{name}__{'lt' if descending else 'gt'}": value}))
+            equal &= Q(**{name: value})
+        return reduce(operator.or_, conditions)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def decode_cursor(self, request):
+        """(reverse, values of the ordering fields) of the cursor, (False, None) on the first page"""
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return False, None
+        try:
+            direction, ordering, position = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+        except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+            raise NotFound(self.invalid_cursor_message)
+        # a cursor is only valid for the ordering it was read with
+        if direction not in ('n', 'p') or ordering != self.ordering or not isinstance(position, list):
+            raise NotFound(self.invalid_cursor_message)
+        if len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return direction == 'p', position
+
+    def encode_cursor(self, reverse, row):
+        position = [_cursor_value(getattr(row, field.lstrip('-'))) for field in self.ordering]
+        encoded = base64.urlsafe_b64encode(json.dumps(['p' if reverse else 'n', self.ordering, position]).encode()).decode()
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if not self.page:
+            # read backwards past the first row, the next page starts at the first one
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(False, self.page[-1])
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(True, self.page[0])
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+def _cursor_value(value):
+    # datetimes keep their microseconds, rows with equal values up to the millisecond stay apart
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+class ResponseKeysetPagination(KeysetPagination):
+    """
+    Keyset pagination of survey responses, newest first: every page is a range read of
+    the (survey, submitted_at, id) index.
+    """
+    ordering = ('-submitted_at', '-id')
+
+
+class SurveyCursorPagination(KeysetPagination):
+    """
+    Cursor pagination of survey listings, following the ordering selected with the
+    `ordering` filter (newest first by default). Surveys equal on the selected fields,
+    e.g. of the same title, are ordered by id so every survey has a distinct position.
+    """
+    max_page_size = 200
+    ordering = ('-created_at',)
+
+    def get_ordering(self, request, queryset, view):
+        ordering = list(self.ordering)
+        for backend in getattr(view, 'filter_backends', []):
+            if hasattr(backend, 'get_ordering'):
+                ordering = list(backend().get_ordering(request, queryset, view) or ordering)
+                break
+        for index, field in enumerate(ordering):
+            if field.lstrip('-') in ('id', 'pk'):
+                return ordering[:index + 1]
+        return [*ordering, '-id' if ordering[-1].startswith('-') else 'id']
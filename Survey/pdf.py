@@ -0,0 +1,288 @@
+"""
+Minimal PDF writer of the responses table.
+
+reportlab keeps a whole document in memory until it is saved and its table
+splitting gets slower with the table size, so large exports are laid out here
+instead: responses are fixed-height rows, a fixed number per page, with plain
+string cells drawn with the PDF standard fonts. The content of a page only
+depends on its own rows, so pages can be serialized one at a time or rendered
+by several processes and concatenated.
+
+This module does not use Django, worker processes import it without setting it up.
+"""
+import time
+import zlib
+from functools import lru_cache
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import landscape, letter
+from reportlab.lib.units import inch
+from reportlab.pdfbase.pdfmetrics import getFont
+
+PAGE_WIDTH, PAGE_HEIGHT = landscape(letter)
+MARGIN = 0.5 * inch
+TITLE_FONT_SIZE = 16
+SUBTITLE_FONT_SIZE = 10
+HEADER_FONT_SIZE = 9
+CELL_FONT_SIZE = 8
+FOOTER_FONT_SIZE = 8
+HEADER_ROW_HEIGHT = 26
+ROW_HEIGHT = 14
+CELL_PADDING = 4
+TITLE_BLOCK_HEIGHT = 46
+FOOTER_BLOCK_HEIGHT = 16
+ROWS_PER_PAGE = int(
+    (PAGE_HEIGHT - 2 * MARGIN - TITLE_BLOCK_HEIGHT - FOOTER_BLOCK_HEIGHT - HEADER_ROW_HEIGHT) // ROW_HEIGHT
+)
+
+# fixed widths of the ID, Submitted and Respondent columns, questions share the rest
+FIXED_COLUMN_WIDTHS = [0.8 * inch, 1.2 * inch, 1.5 * inch]
+
+REGULAR_FONT = ('F1', 'Helvetica')
+BOLD_FONT = ('F2', 'Helvetica-Bold')
+
+
+def _rgb(color):
+    return ' '.join(f"{component:.3f}" for component in color.rgb()).encode()
+
+
+HEADER_FILL = _rgb(colors.grey)
+HEADER_TEXT = _rgb(colors.whitesmoke)
+# alternating row backgrounds
+ROW_FILLS = [_rgb(colors.beige), _rgb(colors.lightgrey)]
+
+
+def _pdf_string(text):
+    """PDF literal string of a text in the WinAnsi encoding of the standard fonts"""
+    encoded = text.encode('cp1252', errors='replace')
+    return b'(' + encoded.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+
+def _plain_text(text):
+    """Text restricted to what the standard fonts can draw, on a single line"""
+    return ' '.join(str(text).split()).encode('cp1252', errors='replace').decode('cp1252')
+
+
+@lru_cache(maxsize=None)
+def _glyph_widths(font_name):
+    """Widths of the WinAnsi characters of a standard font, in thousandths of the font size"""
+    return getFont(font_name).widths
+
+
+def stringWidth(text, font_name, font_size):
+    """Same as reportlab's stringWidth for the standard fonts, without its per call overhead"""
+    return sum(map(_glyph_widths(font_name).__getitem__, text.encode('cp1252', errors='replace'))) * font_size / 1000
+
+
+def _fit(text, font_name, font_size, width):
+    """Truncate the text with an ellipsis so it fits the width"""
+    if stringWidth(text, font_name, font_size) <= width:
+        return text
+    ellipsis_width = stringWidth('...', font_name, font_size)
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if stringWidth(text[:middle], font_name, font_size) + ellipsis_width <= width:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low].rstrip() + '...'
+
+
+def _fit_with_width(text, font_name, font_size, width):
+    text = _fit(text, font_name, font_size, width)
+    return text, stringWidth(text, font_name, font_size)
+
+
+# answers repeat a lot (choices, ratings), their layout is only computed once
+_cached_fit_with_width = lru_cache(maxsize=65536)(_fit_with_width)
+
+
+def _wrap_two_lines(text, font_name, font_size, width):
+    """Word wrap the text on at most two lines, truncating the second one"""
+    if stringWidth(text, font_name, font_size) <= width:
+        return [text]
+    words = text.split(' ')
+    first_line = ''
+    for index, word in enumerate(words):
+        candidate = f"{first_line} {word}" if first_line else word
+        if stringWidth(candidate, font_name, font_size) > width:
+            if not first_line:
+                return [_fit(text, font_name, font_size, width)]
+            return [first_line, _fit(' '.join(words[index:]), font_name, font_size, width)]
+        first_line = candidate
+    return [first_line]
+
+
+class ResponsesPDFLayout:
+    """
+    Fixed layout of the responses table: every page has the title block, the header row
+    and up to ROWS_PER_PAGE single line rows, so the content of any page only depends on
+    its own rows. Styles, column widths and the header are computed once.
+    """
+
+    def __init__(self, title, question_texts, total_responses, statistics=None):
+        self.title = _plain_text(title)
+        self.statistics = statistics
+        self.page_count = max(1, -(-total_responses // ROWS_PER_PAGE))
+
+        available_width = PAGE_WIDTH - 2 * MARGIN
+        fixed_width = sum(FIXED_COLUMN_WIDTHS)
+        question_width = (available_width - fixed_width) / max(1, len(question_texts))
+        self.column_widths = FIXED_COLUMN_WIDTHS + [question_width] * len(question_texts)
+        self.column_offsets = [MARGIN]
+        for width in self.column_widths[:-1]:
+            self.column_offsets.append(self.column_offsets[-1] + width)
+        self.table_width = sum(self.column_widths)
+
+        headers = ['ID', 'Submitted', 'Respondent'] + [_plain_text(text) for text in question_texts]
+        self.header_content = self._header_content(headers)
+
+    @property
+    def table_top(self):
+        return PAGE_HEIGHT - MARGIN - TITLE_BLOCK_HEIGHT
+
+    def _text(self, text, font, font_size, x, y, color=b'0 0 0'):
+        return b'BT /%s %d Tf %s rg %.2f %.2f Td %s Tj ET\n' % (
+            font[0].encode(), font_size, color, x, y, _pdf_string(text)
+        )
+
+    def _centered_text(self, text, font, font_size, column, y, color=b'0 0 0'):
+        fit = _fit_with_width if column < len(FIXED_COLUMN_WIDTHS) else _cached_fit_with_width
+        text, text_width = fit(text, font[1], font_size, self.column_widths[column] - 2 * CELL_PADDING)
+        x = self.column_offsets[column] + (self.column_widths[column] - text_width) / 2
+        return self._text(text, font, font_size, x, y, color)
+
+    def _header_content(self, headers):
+        top = self.table_top
+        parts = [b'%s rg %.2f %.2f %.2f %.2f re f\n' % (
+            HEADER_FILL, MARGIN, top - HEADER_ROW_HEIGHT, self.table_width, HEADER_ROW_HEIGHT
+        )]
+        for column, header in enumerate(headers):
+            lines = _wrap_two_lines(header, BOLD_FONT[1], HEADER_FONT_SIZE, self.column_widths[column] - 2 * CELL_PADDING)
+            baseline = top - HEADER_ROW_HEIGHT / 2 + (len(lines) - 1) * HEADER_FONT_SIZE / 2 - HEADER_FONT_SIZE / 3
+            for line in lines:
+                parts.append(self._centered_text(line, BOLD_FONT, HEADER_FONT_SIZE, column, baseline, HEADER_TEXT))
+                baseline -= HEADER_FONT_SIZE
+        return b''.join(parts)
+
+    def page_content(self, page_number, rows):
+        """Drawing operators of one page showing the rows, lists of cell texts"""
+        parts = []
+        title_baseline = PAGE_HEIGHT - MARGIN - TITLE_FONT_SIZE
+        parts.append(self._text(
+            _fit(self.title, BOLD_FONT[1], TITLE_FONT_SIZE, PAGE_WIDTH - 2 * MARGIN),
+            BOLD_FONT, TITLE_FONT_SIZE, MARGIN, title_baseline
+        ))
+        if self.statistics and page_number == 1:
+            parts.append(self._text(
+                f"Total Responses: {self.statistics['total_responses']}    "
+                f"Average Completion Time: {self.statistics['avg_completion_time']}",
+                REGULAR_FONT, SUBTITLE_FONT_SIZE, MARGIN, title_baseline - 20
+            ))
+
+        top = self.table_top
+        bottom = top - HEADER_ROW_HEIGHT - ROW_HEIGHT * len(rows)
+        for index in range(len(rows)):
+            row_top = top - HEADER_ROW_HEIGHT - ROW_HEIGHT * index
+            parts.append(b'%s rg %.2f %.2f %.2f %.2f re f\n' % (
+                ROW_FILLS[index % 2], MARGIN, row_top - ROW_HEIGHT, self.table_width, ROW_HEIGHT
+            ))
+        parts.append(self.header_content)
+        # cells
+        for index, row in enumerate(rows):
+            baseline = top - HEADER_ROW_HEIGHT - ROW_HEIGHT * index - ROW_HEIGHT + CELL_PADDING
+            for column, cell in enumerate(row):
+                parts.append(self._centered_text(_plain_text(cell), REGULAR_FONT, CELL_FONT_SIZE, column, baseline))
+        # grid
+        parts.append(b'0.5 w 0 0 0 RG\n')
+        for line_y in [top] + [top - HEADER_ROW_HEIGHT - ROW_HEIGHT * index for index in range(len(rows) + 1)]:
+            parts.append(b'%.2f %.2f m %.2f %.2f l\n' % (MARGIN, line_y, MARGIN + self.table_width, line_y))
+        for line_x in self.column_offsets + [MARGIN + self.table_width]:
+            parts.append(b'%.2f %.2f m %.2f %.2f l\n' % (line_x, top, line_x, bottom))
+        parts.append(b'S\n')
+
+        parts.append(self._text(
+            f"Page {page_number} of {self.page_count}", REGULAR_FONT, FOOTER_FONT_SIZE,
+            PAGE_WIDTH - MARGIN - 60, MARGIN
+        ))
+        return b''.join(parts)
+
+
+class StreamingPDFWriter:
+    """
+    Serializes a PDF one page at a time. Every method returns the bytes to send next,
+    objects are numbered as they are written and the page tree comes last.
+    """
+    CATALOG, PAGES, REGULAR, BOLD, INFO = 1, 2, 3, 4, 5
+
+    def __init__(self, title=''):
+        self.title = title
+        self.offset = 0
+        self.object_offsets = {}
+        self.page_ids = []
+        self.next_id = self.INFO + 1
+
+    def _object(self, object_id, body):
+        self.object_offsets[object_id] = self.offset
+        data = b'%d 0 obj\n%s\nendobj\n' % (object_id, body)
+        self.offset += len(data)
+        return data
+
+    def _stream_object(self, object_id, compressed):
+        return self._object(
+            object_id,
+            b'<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream' % (len(compressed), compressed)
+        )
+
+    def begin(self):
+        header = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+        self.offset = len(header)
+        return header + b''.join([
+            self._object(self.CATALOG, b'<< /Type /Catalog /Pages %d 0 R >>' % self.PAGES),
+            self._object(self.REGULAR, b'<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>' % REGULAR_FONT[1].encode()),
+            self._object(self.BOLD, b'<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>' % BOLD_FONT[1].encode()),
+            self._object(self.INFO, b'<< /Title %s /Producer (SurveyPlane) >>' % _pdf_string(self.title)),
+        ])
+
+    def page(self, content):
+        return self.compressed_page(zlib.compress(content))
+
+    def compressed_page(self, compressed):
+        """Page drawn by content already compressed with zlib"""
+        content_id, page_id = self.next_id, self.next_id + 1
+        self.next_id += 2
+        self.page_ids.append(page_id)
+        return self._stream_object(content_id, compressed) + self._object(page_id, (
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %.2f %.2f] '
+            b'/Resources << /Font << /%s %d 0 R /%s %d 0 R >> >> /Contents %d 0 R >>'
+        ) % (
+            self.PAGES, PAGE_WIDTH, PAGE_HEIGHT,
+            REGULAR_FONT[0].encode(), self.REGULAR, BOLD_FONT[0].encode(), self.BOLD, content_id
+        ))
+
+    def end(self):
+        kids = b' '.join(b'%d 0 R' % page_id for page_id in self.page_ids)
+        data = self._object(self.PAGES, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self.page_ids)))
+        xref_offset = self.offset
+        size = self.next_id
+        xref = [b'xref\n0 %d\n' % size, b'0000000000 65535 f \n']
+        for object_id in range(1, size):
+            xref.append(b'%010d 00000 n \n' % self.object_offsets[object_id])
+        trailer = b'trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (
+            size, self.CATALOG, self.INFO, xref_offset
+        )
+        return data + b''.join(xref) + trailer
+
+
+def render_pages(layout, first_page_number, pages):
+    """
+    Compressed content of consecutive pages, each a list of rows of cell texts, and the
+    CPU seconds it took. Run by the worker processes of parallel exports.
+    """
+    started = time.process_time()
+    contents = [
+        zlib.compress(layout.page_content(page_number, rows))
+        for page_number, rows in enumerate(pages, start=first_page_number)
+    ]
+    return contents, time.process_time() - started
@@ -1,5 +1,6 @@
 from rest_framework.permissions import BasePermission, SAFE_METHODS
 from .models import Survey, Response
+from .loaders import get_survey_loader
 class IsVerified(BasePermission):
     """
     Allows access only to authenticated users.
@@ -28,12 +29,12 @@ class SurveyAccessPermission(BasePermission):
         if view.action == 'retrieve':
             # If user is authenticated and verified, check if they own the survey
             if request.user.is_authenticated and request.user.is_verified:
-                return obj.creator == request.user
+                return obj.creator_id == request.user.id
             # For other users, only allow access to active surveys
             return obj.is_active
         
         # For other actions (update, delete, etc.)
-        return request.user.is_authenticated and request.user.is_verified and obj.creator == request.user
+        return request.user.is_authenticated and request.user.is_verified and obj.creator_id == request.user.id
 
 
 
@@ -58,15 +59,26 @@ class QuestionAccessPermission(BasePermission):
         if view.action == 'retrieve':
             # If user is authenticated and verified, check if they own the survey
             if request.user.is_authenticated and request.user.is_verified:
-                return obj.survey.creator == request.user
+                return obj.survey.creator_id == request.user.id
             # For other users, only allow access to questions of active surveys
             return obj.survey.is_active
         
         # For other actions (update, delete, etc.)
-        return request.user.is_authenticated and request.user.is_verified and obj.survey.creator == request.user
+        return request.user.is_authenticated and request.user.is_verified and obj.survey.creator_id == request.user.id
 
 
 
+def can_respond(user, survey):
+    """Whether the user meets the authentication requirement of the survey to respond to it"""
+    if survey.respondent_auth_requirement == Survey.AuthRequirement.NONE:
+        return True
+    elif survey.respondent_auth_requirement == Survey.AuthRequirement.QUICK:
+        return bool(user and user.is_authenticated)
+    elif survey.respondent_auth_requirement == Survey.AuthRequirement.FULL:
+        return bool(user and user.is_authenticated and user.is_verified)
+    return False
+
+
 class ResponseAccessPermission(BasePermission):
     """
     Custom permission for Response access based on survey's auth requirement:
@@ -82,19 +94,17 @@ class ResponseAccessPermission(BasePermission):
             
         # For POST/PUT/PATCH/DELETE, check survey auth requirement
         if view.action == 'create':
-            survey_id = request.data.get('survey')
-            try:
-                survey = Survey.objects.get(pk=survey_id)
-            except Survey.DoesNotExist:
+            # loaded once for the request, the view and the serializer use the same survey
+            survey = get_survey_loader(request).get(request.data.get('survey'))
+            if survey is None:
                 return False
                 
             # Check auth requirements
-            if survey.respondent_auth_requirement == Survey.AuthRequirement.NONE:
-                return True
-            elif survey.respondent_auth_requirement == Survey.AuthRequirement.QUICK:
-                return request.user and request.user.is_authenticated
-            elif survey.respondent_auth_requirement == Survey.AuthRequirement.FULL:
-                return request.user and request.user.is_authenticated and request.user.is_verified
+            return can_respond(request.user, survey)
+
+        # the auth requirement of the survey of every item is checked by the view
+        if view.action == 'batch':
+            return True
         
         return False
     
@@ -103,17 +113,17 @@ class ResponseAccessPermission(BasePermission):
         if request.method in SAFE_METHODS:
             # Allow survey creator to view responses
             if request.user and request.user.is_authenticated:
-                if obj.survey.creator == request.user:
+                if obj.survey.creator_id == request.user.id:
                     return True
             # Allow respondent to view their own responses
-            if request.user and request.user.is_authenticated and obj.respondent == request.user:
+            if request.user and request.user.is_authenticated and obj.respondent_id == request.user.id:
                 return True
             return False
         
         # For modification requests
         # Only allow respondent to modify their own responses if survey is still active
         return (request.user and request.user.is_authenticated and 
-                obj.respondent == request.user and not obj.survey.is_closed)
+                obj.respondent_id == request.user.id and not obj.survey.is_closed)
 
 
 
@@ -137,7 +147,7 @@ class ResponseAnswerAccessPermission(BasePermission):
                 
             try:
                 response = Response.objects.get(pk=response_id)
-                return response.respondent == request.user
+                return response.respondent_id == request.user.id
             except Response.DoesNotExist:
                 return False
                 
@@ -149,7 +159,7 @@ class ResponseAnswerAccessPermission(BasePermission):
                 
             try:
                 response = Response.objects.get(pk=response_id)
-                return response.respondent == request.user
+                return response.respondent_id == request.user.id
             except Response.DoesNotExist:
                 return False
         
@@ -157,11 +167,11 @@ class ResponseAnswerAccessPermission(BasePermission):
     
     def has_object_permission(self, request, view, obj):
         # Allow survey creator to view answers
-        if obj.response.survey.creator == request.user:
+        if obj.response.survey.creator_id == request.user.id:
             return True
             
         # Allow respondent to view/modify their own answers
-        if obj.response.respondent == request.user:
+        if obj.response.respondent_id == request.user.id:
             # For modification requests, check if survey is still active
             if request.method not in SAFE_METHODS:
                 return not obj.response.survey.is_closed
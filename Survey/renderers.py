@@ -0,0 +1,32 @@
+import json
+
+from rest_framework.renderers import BaseRenderer
+
+
+class StreamedExportRenderer(BaseRenderer):
+    """
+    Lets `?format=` select the export format of a view streaming its own content.
+    Content rendered through DRF (error messages) is rendered as JSON.
+    """
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, (bytes, str)):
+            return data
+        return json.dumps(data)
+
+
+class PDFRenderer(StreamedExportRenderer):
+    media_type = 'application/pdf'
+    format = 'pdf'
+    charset = None
+
+
+class CSVRenderer(StreamedExportRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class NDJSONRenderer(StreamedExportRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
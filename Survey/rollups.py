@@ -0,0 +1,172 @@
+"""
+Incremental per question aggregates of the answers.
+
+Every code path creating, changing or deleting answers records what it did in a
+RollupDelta and applies it inside its own transaction, so the statistics of all
+the responses of a survey are read from its QuestionRollup rows without scanning
+the answers. Rollups are only trusted when every question of a survey has one:
+questions created before rollups existed get theirs from `manage.py rebuild_rollups`.
+"""
+from collections import Counter
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Answer, Question, QuestionRollup
+
+ROLLUP_FIELDS = ['answer_count', 'option_counts', 'rating_count', 'rating_sum',
+                 'rating_sum_squares', 'rating_counts', 'updated_at']
+
+
+def rating_key(value):
+    return str(float(value))
+
+
+def answer_options(question_type, value):
+    """The options selected by a choice answer"""
+    if not isinstance(value, dict):
+        return []
+    if question_type == Question.QUESTION_TYPES.SINGLE:
+        choice = value.get('choice')
+        return [choice] if isinstance(choice, str) else []
+    if question_type == Question.QUESTION_TYPES.MULTIPLE:
+        choices = value.get('choices')
+        if not isinstance(choices, list):
+            return []
+        return list(dict.fromkeys(choice for choice in choices if isinstance(choice, str)))
+    return []
+
+
+def answer_rating(question_type, value):
+    """The value of a rating answer, None if it is not one"""
+    if question_type != Question.QUESTION_TYPES.RATING:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return float(value)
+
+
+class QuestionDelta:
+    """Change of the aggregates of one question"""
+
+    def __init__(self):
+        self.answer_count = 0
+        self.option_counts = Counter()
+        self.rating_count = 0
+        self.rating_sum = 0.0
+        self.rating_sum_squares = 0.0
+        self.rating_counts = Counter()
+
+    def add(self, question_type, value, sign=1):
+        self.answer_count += sign
+        for option in answer_options(question_type, value):
+            self.option_counts[option] += sign
+        rating = answer_rating(question_type, value)
+        if rating is not None:
+            self.rating_count += sign
+            self.rating_sum += sign * rating
+            self.rating_sum_squares += sign * rating * rating
+            self.rating_counts[rating_key(rating)] += sign
+
+    def apply_to(self, rollup):
+        rollup.answer_count = max(rollup.answer_count + self.answer_count, 0)
+        rollup.option_counts = _merge_counts(rollup.option_counts, self.option_counts)
+        rollup.rating_count = max(rollup.rating_count + self.rating_count, 0)
+        rollup.rating_sum += self.rating_sum
+        rollup.rating_sum_squares += self.rating_sum_squares
+        rollup.rating_counts = _merge_counts(rollup.rating_counts, self.rating_counts)
+        if rollup.rating_count == 0:
+            # do not keep floating point leftovers around
+            rollup.rating_sum = rollup.rating_sum_squares = 0.0
+        # bulk_update does not fill auto_now fields
+        rollup.updated_at = timezone.now()
+
+
+def _merge_counts(counts, changes):
+    merged = Counter(counts)
+    merged.update(changes)
+    return {key: count for key, count in merged.items() if count > 0}
+
+
+class RollupDelta:
+    """
+    Changes of the question rollups made by a write, applied all at once with `apply()`.
+    """
+
+    def __init__(self):
+        self.questions = {}  # question_id -> QuestionDelta
+
+    def __bool__(self):
+        return bool(self.questions)
+
+    def add(self, question, value, sign=1):
+        self.questions.setdefault(question.id, QuestionDelta()).add(question.question_type, value, sign)
+
+    def remove(self, question, value):
+        self.add(question, value, sign=-1)
+
+    def add_answers(self, answers):
+        for answer in answers:
+            self.add(answer.question, answer.value)
+
+    def remove_answers(self, answers):
+        for answer in answers:
+            self.remove(answer.question, answer.value)
+
+    def apply(self):
+        """
+        Apply the changes to the existing rollups, locking them until the end of the
+        current transaction. Questions without a rollup are left to `rebuild_rollups`.
+        """
+        if not self.questions:
+            return
+        with transaction.atomic():
+            rollups = list(
+                QuestionRollup.objects.select_for_update()
+                .filter(question_id__in=self.questions)
+                .order_by('question_id')
+            )
+            for rollup in rollups:
+                self.questions[rollup.question_id].apply_to(rollup)
+            QuestionRollup.objects.bulk_update(rollups, ROLLUP_FIELDS)
+        self.questions = {}
+
+
+def build_survey_rollups(survey):
+    """Aggregate all the answers of the survey from scratch, as unsaved rollups by question id"""
+    questions = {question.id: question for question in survey.questions.all()}
+    deltas = {question_id: QuestionDelta() for question_id in questions}
+    answers = Answer.objects.filter(question__survey=survey).values_list('question_id', 'value')
+    for question_id, value in answers.iterator(chunk_size=5000):
+        deltas[question_id].add(questions[question_id].question_type, value)
+
+    rollups = {}
+    for question_id, question in questions.items():
+        rollup = QuestionRollup(question=question)
+        deltas[question_id].apply_to(rollup)
+        rollups[question_id] = rollup
+    return rollups
+
+
+def rebuild_survey_rollups(survey):
+    """
+    Replace the rollups of the survey by aggregates computed from its answers.
+    The existing rollups are updated in place while locked so concurrent writers
+    apply their changes on top of the rebuilt values.
+    """
+    with transaction.atomic():
+        existing = {
+            rollup.question_id: rollup
+            for rollup in QuestionRollup.objects.select_for_update().filter(question__survey=survey)
+        }
+        rollups = build_survey_rollups(survey)
+        updated, created = [], []
+        for question_id, rollup in rollups.items():
+            if question_id in existing:
+                rollup.pk = existing[question_id].pk
+                updated.append(rollup)
+            else:
+                created.append(rollup)
+        QuestionRollup.objects.bulk_update(updated, ROLLUP_FIELDS)
+        QuestionRollup.objects.bulk_create(created)
+    return rollups
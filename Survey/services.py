@@ -1,123 +1,436 @@
-from .models import Answer,Question
+from .models import Answer,AnswerFact,Question,QuestionRollup
+import operator
 import numpy as np
 from collections import defaultdict
+from functools import reduce
+from django.db.models import Count, Avg, Max, Min, StdDev, F, Q
+from .matrix import build_answer_matrix
 
 ACCEPTED_Q_TYPES = [Question.QUESTION_TYPES.RATING, Question.QUESTION_TYPES.SINGLE, Question.QUESTION_TYPES.MULTIPLE]
+CORRELATION_CHUNK_SIZE = 10000
 
-def _calculate_general_correlation(survey, responses):
-        """Calculate correlations between different questions in the survey"""
-        correlations = {}
-        questions = survey.questions.all()
-        
-        for i, q1 in enumerate(questions):
-            for j, q2 in enumerate(questions):
-                if j <= i:  # Avoid duplicate pairs and self-correlation
-                    continue
-                
-                # Get answers for both questions
-                answers1 = Answer.objects.filter(question=q1, response__in=responses)
-                answers2 = Answer.objects.filter(question=q2, response__in=responses)
-                
-                # Skip if either question has no answers
-                if not answers1.exists() or not answers2.exists():
-                    continue
-                
-                # Create a mapping of response_id to answer for each question
-                answers1_map = {a.response_id: a for a in answers1}
-                answers2_map = {a.response_id: a for a in answers2}
-                
-                # Find common responses
-                common_responses = set(answers1_map.keys()) & set(answers2_map.keys())
-                
-                if not common_responses:
-                    continue
-                
-                joint_distribution = {}
-                correlation_strength = None
-                
-                # Handle different question type combinations
-                if q1.question_type not in ACCEPTED_Q_TYPES or q2.question_type not in ACCEPTED_Q_TYPES:
-                    continue
-                if q1.question_type == Question.QUESTION_TYPES.RATING and q2.question_type == Question.QUESTION_TYPES.RATING:
-                    # Rating-Rating correlation
-                    values1 = []
-                    values2 = []
-                    for response_id in common_responses:
-                        val1 = float(answers1_map[response_id].value)
-                        val2 = float(answers2_map[response_id].value)
-                        values1.append(val1)
-                        values2.append(val2)
-                        key = f"{val1}_{val2}"
-                        joint_distribution[key] = joint_distribution.get(key, 0) + 1
-                    
-                    if len(values1) > 1:  # Need at least 2 points for correlation
-                        correlation_strength = float(np.corrcoef(values1, values2)[0, 1])
-                
-                elif q1.question_type in [Question.QUESTION_TYPES.SINGLE, Question.QUESTION_TYPES.MULTIPLE] and \
-                     q2.question_type == Question.QUESTION_TYPES.RATING:
-                    # Choice-Rating correlation
-                    choice_ratings = defaultdict(list)
-                    for response_id in common_responses:
-                        choices = answers1_map[response_id].value.get('choices', [answers1_map[response_id].value.get('choice')])
-                        rating = float(answers2_map[response_id].value)
-                        
-                        for choice in choices:
-                            key = f"{choice}_{rating}"
-                            joint_distribution[key] = joint_distribution.get(key, 0) + 1
-                            choice_ratings[choice].append(rating)
-                    
-                    # Calculate average rating for each choice
-                    avg_ratings = {
-                        choice: {
-                            'mean': float(np.mean(ratings)),
-                            'std': float(np.std(ratings)) if len(ratings) > 1 else 0
-                        }
-                        for choice, ratings in choice_ratings.items()
-                    }
-                    correlation_strength = avg_ratings
-                
-                elif q2.question_type in [Question.QUESTION_TYPES.SINGLE, Question.QUESTION_TYPES.MULTIPLE] and \
-                     q1.question_type == Question.QUESTION_TYPES.RATING:
-                    # Rating-Choice correlation (swap order)
-                    choice_ratings = defaultdict(list)
-                    for response_id in common_responses:
-                        choices = answers2_map[response_id].value.get('choices', [answers2_map[response_id].value.get('choice')])
-                        rating = float(answers1_map[response_id].value)
-                        
-                        for choice in choices:
-                            key = f"{rating}_{choice}"
-                            joint_distribution[key] = joint_distribution.get(key, 0) + 1
-                            choice_ratings[choice].append(rating)
-                    
-                    # Calculate average rating for each choice
-                    avg_ratings = {
-                        choice: {
-                            'mean': float(np.mean(ratings)),
-                            'std': float(np.std(ratings)) if len(ratings) > 1 else 0
-                        }
-                        for choice, ratings in choice_ratings.items()
-                    }
-                    correlation_strength = avg_ratings
-                
-                else:
-                    # Choice-Choice correlation
-                    for response_id in common_responses:
-                        choices1 = answers1_map[response_id].value.get('choices', [answers1_map[response_id].value.get('choice')])
-                        choices2 = answers2_map[response_id].value.get('choices', [answers2_map[response_id].value.get('choice')])
-                        
-                        for c1 in choices1:
-                            for c2 in choices2:
-                                key = f"{c1}_{c2}"
-                                joint_distribution[key] = joint_distribution.get(key, 0) + 1
-                
-                pair_key = f"{q1.id}_{q2.id}"
-                correlations[pair_key] = {
-                    "questions": [q1.question_text, q2.question_text],
-                    "question_types": [q1.question_type, q2.question_type],
-                    "data": {
-                        "joint_distribution": joint_distribution,
-                        "correlation_strength": correlation_strength
-                    }
+def _answer_values(question, responses, matrix=None, rows=None):
+    """
+    Map response id -> answer value of a question.
+    Encoded questions are read from the answer matrix, rating and choice questions
+    otherwise from their answer facts, the others from their Answer rows.
+    """
+    if matrix is not None and matrix.is_encoded(question.id):
+        answered_rows = rows & matrix.answered_rows(question.id)
+        return dict(zip(matrix.response_ids[answered_rows].tolist(), matrix.raw_values(question.id, answered_rows)))
+    if matrix is not None:
+        response_ids = set(matrix.response_ids[rows].tolist())
+        answers = Answer.objects.filter(question=question).values_list('response_id', 'value')
+        return {response_id: value for response_id, value in answers if response_id in response_ids}
+    if question.question_type in ACCEPTED_Q_TYPES:
+        return _fact_values(question, responses)
+    return dict(Answer.objects.filter(question=question, response__in=responses).values_list('response_id', 'value'))
+
+
+def _fact_values(question, responses):
+    """The answer values of a rating or choice question rebuilt from its facts, choices in option order"""
+    facts = AnswerFact.objects.filter(question=question, response__in=responses)
+    if question.question_type == Question.QUESTION_TYPES.RATING:
+        return dict(facts.values_list('response_id', 'rating'))
+    choices = defaultdict(list)
+    for response_id, choice in facts.order_by(F('option_index').asc(nulls_last=True), 'id').values_list('response_id', 'choice'):
+        choices[response_id].append(choice)
+    if question.question_type == Question.QUESTION_TYPES.SINGLE:
+        return {response_id: {'choice': values[0]} for response_id, values in choices.items()}
+    return {response_id: {'choices': values} for response_id, values in choices.items()}
+
+
+def _condition_facts(question, value):
+    """
+    The facts of the answers to the question matching the value, the chosen option for
+    choice questions or the exact rating for rating questions (as AnswerMatrix.match_rows).
+    None when the value cannot match.
+    """
+    if question.question_type == Question.QUESTION_TYPES.RATING:
+        try:
+            return AnswerFact.objects.filter(question=question, rating=float(value))
+        except (TypeError, ValueError):
+            return None
+    return AnswerFact.objects.filter(question=question, choice=str(value))
+
+
+def _filter_responses(question, value, responses):
+    """The responses whose answer to the question matches the value, read from the indexed answer facts"""
+    if question.question_type not in ACCEPTED_Q_TYPES:
+        raise ValueError(f'Responses cannot be filtered on the {question.question_type} question {question.id}')
+    facts = _condition_facts(question, value)
+    if facts is None:
+        return responses.none()
+    return responses.filter(id__in=facts.values('response_id'))
+
+
+def _filter_expression_responses(expression, questions, responses):
+    """
+    The responses matching a parsed filter expression (see bitmaps.py) when the survey has
+    no answer matrix, as one query with a fact subquery per condition.
+    `questions` maps the ids of the questions of the conditions to the questions.
+    """
+    def condition(node):
+        if 'question' in node:
+            facts = _condition_facts(questions[node['question']], node['value'])
+            return Q(id__in=facts.values('response_id')) if facts is not None else Q(pk__in=[])
+        if 'not' in node:
+            return ~condition(node['not'])
+        children = [condition(child) for child in next(iter(node.values()))]
+        return reduce(operator.and_ if 'and' in node else operator.or_, children)
+
+    return responses.filter(condition(expression))
+
+
+def _calculate_general_correlation(survey, responses, matrix=None, rows=None):
+    """
+    Calculate correlations between all the rating and choice questions of the survey at once.
+
+    Every answer is one-hot encoded into a responses x labels indicator matrix (the options of
+    choice questions, the distinct values of rating questions), so a single cross product gives
+    the contingency tables of all question pairs. Rating questions additionally get a pairwise
+    Pearson matrix and the mean/std rating of every choice.
+
+    Returns a labelled-matrix payload:
+    {
+        "questions": {"<id>": {"question_text", "question_type", "labels"}},
+        "pearson": {"questions": [ids], "matrix": [[r or null]]},
+        "pairs": {"<id1>_<id2>": {"counts": [[...]], "rating_by_choice": {"mean": [...], "std": [...]}}}
+    }
+    where the rows/columns of "counts" follow the labels of the first/second question and
+    "rating_by_choice" (choice-rating pairs only) follows the labels of the choice question.
+    """
+    if matrix is None:
+        # one fetch of all the answers into an in-memory matrix
+        matrix = build_answer_matrix(survey)
+        rows = matrix.rows_for_responses(responses.values_list('id', flat=True))
+
+    questions = [
+        q for q in survey.questions.all()
+        if q.question_type in ACCEPTED_Q_TYPES and matrix.is_encoded(q.id)
+    ]
+    ratings = {
+        q.id: np.where(matrix.answered_rows(q.id)[rows], matrix.ratings(q.id)[rows], np.nan)
+        for q in questions if q.question_type == Question.QUESTION_TYPES.RATING
+    }
+
+    choice_selections = {
+        q.id: matrix.selections(q.id)[rows] & matrix.answered_rows(q.id)[rows][:, None]
+        for q in questions if q.question_type != Question.QUESTION_TYPES.RATING
+    }
+
+    # labels of every question: the options of choice questions, the distinct values of rating questions
+    labels = {}
+    for q in questions:
+        if q.question_type == Question.QUESTION_TYPES.RATING:
+            values = ratings[q.id]
+            labels[q.id] = np.unique(values[~np.isnan(values)]).tolist()
+        else:
+            labels[q.id] = list(matrix.options(q.id))
+    offsets = {}
+    label_count = 0
+    for q in questions:
+        offsets[q.id] = label_count
+        label_count += len(labels[q.id])
+
+    def one_hot(chunk):
+        indicators = np.zeros((chunk.stop - chunk.start, label_count), dtype=np.float32)
+        for q in questions:
+            start = offsets[q.id]
+            if q.question_type == Question.QUESTION_TYPES.RATING:
+                values = ratings[q.id][chunk]
+                known = ~np.isnan(values)
+                codes = np.searchsorted(labels[q.id], values[known])
+                indicators[np.flatnonzero(known), start + codes] = 1
+            else:
+                indicators[:, start:start + len(labels[q.id])] = choice_selections[q.id][chunk]
+        return indicators
+
+    rating_ids = list(ratings)
+    rating_count = len(rating_ids)
+    rating_values = np.column_stack([ratings[q_id] for q_id in rating_ids]) if rating_ids else np.empty((int(np.count_nonzero(rows)), 0))
+    rating_known = ~np.isnan(rating_values)
+    rating_filled = np.where(rating_known, rating_values, 0.0)
+    # per rating question: value, squared value and answered flag, to get sums, squares and counts in one product
+    rating_features = np.hstack([rating_filled, rating_filled ** 2, rating_known])
+
+    # accumulate the cross products over row chunks to bound the memory of the indicator matrix
+    co_counts = np.zeros((label_count, label_count))
+    label_rating_features = np.zeros((label_count, 3 * rating_count))
+    row_count = rating_values.shape[0]
+    for start in range(0, row_count, CORRELATION_CHUNK_SIZE):
+        chunk = slice(start, min(start + CORRELATION_CHUNK_SIZE, row_count))
+        indicators = one_hot(chunk)
+        # float32 products are exact for counts of a chunk's size
+        co_counts += indicators.T @ indicators
+        label_rating_features += indicators.T.astype(np.float64) @ rating_features[chunk]
+    label_rating_sums = label_rating_features[:, :rating_count]
+    label_rating_squares = label_rating_features[:, rating_count:2 * rating_count]
+    label_rating_counts = label_rating_features[:, 2 * rating_count:]
+
+    result = {
+        'questions': {
+            str(q.id): {
+                'question_text': q.question_text,
+                'question_type': q.question_type,
+                'labels': labels[q.id],
+            }
+            for q in questions
+        },
+        'pearson': {
+            'questions': rating_ids,
+            'matrix': _nan_to_none(_pearson_matrix(rating_values, rating_known)),
+        },
+        'pairs': {},
+    }
+
+    rating_column = {q_id: j for j, q_id in enumerate(rating_ids)}
+    for i, q1 in enumerate(questions):
+        rows1 = slice(offsets[q1.id], offsets[q1.id] + len(labels[q1.id]))
+        for q2 in questions[i + 1:]:
+            rows2 = slice(offsets[q2.id], offsets[q2.id] + len(labels[q2.id]))
+            counts = co_counts[rows1, rows2]
+            if not counts.any():
+                continue
+            pair = {'counts': counts.astype(np.int64).tolist()}
+
+            choice_q, rating_q = None, None
+            if q1.question_type != Question.QUESTION_TYPES.RATING and q2.question_type == Question.QUESTION_TYPES.RATING:
+                choice_q, rating_q = q1, q2
+            elif q2.question_type != Question.QUESTION_TYPES.RATING and q1.question_type == Question.QUESTION_TYPES.RATING:
+                choice_q, rating_q = q2, q1
+            if choice_q is not None:
+                choice_rows = rows1 if choice_q is q1 else rows2
+                column = rating_column[rating_q.id]
+                n = label_rating_counts[choice_rows, column]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    mean = label_rating_sums[choice_rows, column] / n
+                    std = np.sqrt(np.maximum(label_rating_squares[choice_rows, column] / n - mean ** 2, 0))
+                std = np.where(n > 1, std, 0)
+                pair['rating_by_choice'] = {
+                    'mean': _nan_to_none(mean),
+                    'std': [float(value) if count else None for value, count in zip(std, n)],
                 }
-        
-        return {"correlations": correlations}
\ No newline at end of file
+
+            result['pairs'][f"{q1.id}_{q2.id}"] = pair
+
+    return result
+
+
+def _pearson_matrix(values, known):
+    """
+    Pairwise-complete Pearson correlations of the columns of values.
+    Uses np.corrcoef when no value is missing, otherwise the same formula over
+    the rows where both columns are known, computed with cross products.
+    """
+    column_count = values.shape[1]
+    if column_count == 0:
+        return np.empty((0, 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if known.all():
+            if values.shape[0] < 2:
+                return np.full((column_count, column_count), np.nan)
+            return np.atleast_2d(np.corrcoef(values, rowvar=False))
+        filled = np.where(known, values, 0.0)
+        known = known.astype(np.float64)
+        n = known.T @ known
+        sum_x = filled.T @ known  # sum of column i over the rows where column j is known
+        sum_xx = (filled ** 2).T @ known
+        sum_xy = filled.T @ filled
+        covariance = n * sum_xy - sum_x * sum_x.T
+        variance = (n * sum_xx - sum_x ** 2) * (n * sum_xx - sum_x ** 2).T
+        correlation = covariance / np.sqrt(variance)
+    correlation[n < 2] = np.nan
+    return correlation
+
+
+def _nan_to_none(array):
+    """Convert a numpy array to (nested) lists of floats, with None instead of NaN"""
+    array = np.asarray(array, dtype=np.float64)
+    if array.ndim > 1:
+        return [_nan_to_none(row) for row in array]
+    return [None if np.isnan(value) else float(value) for value in array]
+
+
+def _calculate_question_statistics(survey, responses, total_responses):
+    """
+    Calculate the per question statistics of the survey for the given responses.
+    All questions are computed together with a few grouped queries over the indexed
+    answer facts instead of querying and iterating the answers of each question.
+    """
+    questions = list(survey.questions.all())
+    answer_counts = dict(
+        Answer.objects.filter(question__survey=survey, response__in=responses)
+        .values('question_id').annotate(total=Count('id')).values_list('question_id', 'total')
+    )
+    facts = AnswerFact.objects.filter(survey=survey, response__in=responses)
+
+    option_counts = defaultdict(dict)
+    choice_rows = facts.filter(choice__isnull=False).values('question_id', 'choice').annotate(
+        count=Count('id')
+    ).order_by('question_id', 'option_index', 'choice')
+    for row in choice_rows:
+        option_counts[row['question_id']][row['choice']] = row['count']
+
+    rating_facts = facts.filter(rating__isnull=False)
+    rating_stats = {
+        row['question_id']: row
+        for row in rating_facts.values('question_id').annotate(
+            avg_rating=Avg('rating'),
+            max_rating=Max('rating'),
+            min_rating=Min('rating'),
+            stddev_rating=StdDev('rating')
+        ).order_by()
+    }
+    rating_distributions = defaultdict(list)
+    for row in rating_facts.values('question_id', 'rating').annotate(count=Count('id')).order_by('question_id', 'rating'):
+        rating_distributions[row['question_id']].append({'value': row['rating'], 'count': row['count']})
+
+    questions_stats = []
+    for question in questions:
+        total_answers = answer_counts.get(question.id, 0)
+        question_stats = {
+            'id': question.id,
+            'question_text': question.question_text,
+            'question_type': question.question_type,
+            'response_rate': (total_answers / total_responses) * 100 if total_responses > 0 else 0,
+        }
+
+        if question.question_type in [Question.QUESTION_TYPES.SINGLE, Question.QUESTION_TYPES.MULTIPLE]:
+            counts = option_counts.get(question.id, {})
+            question_stats.update({
+                'option_distribution': counts,
+                'percentage_distribution': {
+                    option: (count / total_answers * 100) if total_answers > 0 else 0
+                    for option, count in counts.items()
+                },
+                'most_common_answer': max(counts.items(), key=lambda x: x[1])[0] if counts else None,
+            })
+
+        elif question.question_type == Question.QUESTION_TYPES.RATING:
+            stats = rating_stats.get(question.id, {})
+            question_stats.update({
+                'average_rating': _float_or_none(stats.get('avg_rating')),
+                'max_rating': _float_or_none(stats.get('max_rating')),
+                'min_rating': _float_or_none(stats.get('min_rating')),
+                'total_ratings': total_answers,
+                'standard_deviation': _float_or_none(stats.get('stddev_rating')),
+                'rating_distribution': rating_distributions.get(question.id, [])
+            })
+
+        questions_stats.append(question_stats)
+
+    return questions_stats
+
+
+def _float_or_none(value):
+    return float(value) if value is not None else None
+
+
+def _calculate_matrix_question_statistics(matrix, questions, rows, total_responses):
+    """
+    Same statistics as _calculate_question_statistics, computed from the answer matrix rows
+    instead of querying the answers.
+    """
+    questions_stats = []
+    for question in questions:
+        answered_rows = rows & matrix.answered_rows(question.id)
+        total_answers = int(np.count_nonzero(answered_rows))
+        question_stats = {
+            'id': question.id,
+            'question_text': question.question_text,
+            'question_type': question.question_type,
+            'response_rate': (total_answers / total_responses) * 100 if total_responses > 0 else 0,
+        }
+
+        if question.question_type in [Question.QUESTION_TYPES.SINGLE, Question.QUESTION_TYPES.MULTIPLE]:
+            counts = {}
+            if matrix.is_encoded(question.id):
+                selected = matrix.selections(question.id)[answered_rows].sum(axis=0)
+                options = matrix.options(question.id)
+                counts = {options[j]: int(count) for j, count in enumerate(selected) if count}
+            question_stats.update({
+                'option_distribution': counts,
+                'percentage_distribution': {
+                    option: (count / total_answers * 100) if total_answers > 0 else 0
+                    for option, count in counts.items()
+                },
+                'most_common_answer': max(counts.items(), key=lambda x: x[1])[0] if counts else None,
+            })
+
+        elif question.question_type == Question.QUESTION_TYPES.RATING:
+            ratings = np.empty(0)
+            if matrix.is_encoded(question.id):
+                ratings = matrix.ratings(question.id)[answered_rows]
+                ratings = ratings[~np.isnan(ratings)]
+            has_ratings = ratings.size > 0
+            values, counts = np.unique(ratings, return_counts=True)
+            question_stats.update({
+                'average_rating': float(np.mean(ratings)) if has_ratings else None,
+                'max_rating': float(np.max(ratings)) if has_ratings else None,
+                'min_rating': float(np.min(ratings)) if has_ratings else None,
+                'total_ratings': total_answers,
+                'standard_deviation': float(np.std(ratings)) if has_ratings else None,
+                'rating_distribution': [
+                    {'value': float(value), 'count': int(count)} for value, count in zip(values, counts)
+                ]
+            })
+
+        questions_stats.append(question_stats)
+
+    return questions_stats
+
+
+def _calculate_rollup_question_statistics(questions, total_responses):
+    """
+    Same statistics as _calculate_question_statistics for all the responses of the survey,
+    read from the question rollups in a single query. Returns None when a question has
+    no rollup yet (not backfilled by `manage.py rebuild_rollups`).
+    """
+    rollups = {
+        rollup.question_id: rollup
+        for rollup in QuestionRollup.objects.filter(question_id__in=[question.id for question in questions])
+    }
+    if len(rollups) < len(questions):
+        return None
+
+    questions_stats = []
+    for question in questions:
+        rollup = rollups[question.id]
+        total_answers = rollup.answer_count
+        question_stats = {
+            'id': question.id,
+            'question_text': question.question_text,
+            'question_type': question.question_type,
+            'response_rate': (total_answers / total_responses) * 100 if total_responses > 0 else 0,
+        }
+
+        if question.question_type in [Question.QUESTION_TYPES.SINGLE, Question.QUESTION_TYPES.MULTIPLE]:
+            # options in the order of the question settings, answers to flexable questions last
+            options = list(dict.fromkeys(list(question.settings.get('options') or []) + list(rollup.option_counts)))
+            counts = {option: rollup.option_counts[option] for option in options if option in rollup.option_counts}
+            question_stats.update({
+                'option_distribution': counts,
+                'percentage_distribution': {
+                    option: (count / total_answers * 100) if total_answers > 0 else 0
+                    for option, count in counts.items()
+                },
+                'most_common_answer': max(counts.items(), key=lambda x: x[1])[0] if counts else None,
+            })
+
+        elif question.question_type == Question.QUESTION_TYPES.RATING:
+            rating_count = rollup.rating_count
+            mean = rollup.rating_sum / rating_count if rating_count else None
+            ratings = sorted((float(value), count) for value, count in rollup.rating_counts.items())
+            question_stats.update({
+                'average_rating': mean,
+                'max_rating': ratings[-1][0] if ratings else None,
+                'min_rating': ratings[0][0] if ratings else None,
+                'total_ratings': total_answers,
+                'standard_deviation': float(np.sqrt(max(rollup.rating_sum_squares / rating_count - mean * mean, 0.0))) if rating_count else None,
+                'rating_distribution': [{'value': value, 'count': count} for value, count in ratings]
+            })
+
+        questions_stats.append(question_stats)
+
+    return questions_stats
@@ -1,20 +1,119 @@
-from django.db.models.signals import pre_delete
+from django.contrib.auth import get_user_model
+from django.db.models.signals import pre_delete, pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.core.files.storage import default_storage
-from .models import Question, Answer
-from .config import QUESTION_ATTACHEMENT_FILE_PATH_KEY, ANSWER_FILE_PATH_KEY
+from django.db import transaction
+from .models import Survey, Question, Response, Answer, QuestionRollup, ExportJob
+from .config import QUESTION_ATTACHEMENT_FILE_PATH_KEY
+from .definitions import publish_definition_version
+from .deletion import release_answer_files, release_file
+from .facts import add_answer_facts, reindex_question_facts, replace_answer_facts
+from .matrix import delete_answer_matrices
+from .uploads import discard_question_uploads
+
+User = get_user_model()
+# the respondent fields the statistics group responses by
+RESPONDENT_GROUP_FIELDS = ['gender', 'location', 'date_of_birth']
+# responses and answers have no delete receivers so their deletions stay set-based,
+# deleting them through deletion.py releases their files and bumps the data versions
 @receiver(pre_delete, sender=Question)
 def delete_question_file(sender, instance, **kwargs):
-    """Delete the attached file when a question is deleted if it exists"""
+    """Release the attached file and the files of the answers and uploads when a question is deleted"""
     if instance.settings and instance.settings.get(QUESTION_ATTACHEMENT_FILE_PATH_KEY):
-        file_path = instance.settings.get(QUESTION_ATTACHEMENT_FILE_PATH_KEY)
-        if default_storage.exists(file_path):
-            default_storage.delete(file_path)
-
-@receiver(pre_delete, sender=Answer)
-def delete_answer_file(sender, instance, **kwargs):
-    """Delete the file when an answer to a file question is deleted"""
-    if instance.question.question_type == Question.QUESTION_TYPES.FILE and instance.value and instance.value.get(ANSWER_FILE_PATH_KEY):
-        file_path = instance.value.get(ANSWER_FILE_PATH_KEY)
-        if default_storage.exists(file_path):
-            default_storage.delete(file_path)
\ No newline at end of file
+        release_file(instance.settings.get(QUESTION_ATTACHEMENT_FILE_PATH_KEY))
+    if instance.question_type == Question.QUESTION_TYPES.FILE:
+        release_answer_files(Answer.objects.filter(question=instance))
+    # the uploads are deleted with the question, completed ones hold a reference to their file
+    discard_question_uploads(instance)
+
+@receiver(post_save, sender=Response)
+def bump_response_survey_data_version(sender, instance, **kwargs):
+    """Invalidate the survey's derived analytics data when one of its responses changes"""
+    Survey.bump_data_version(pk=instance.survey_id)
+
+@receiver(post_save, sender=Answer)
+def bump_answer_survey_data_version(sender, instance, **kwargs):
+    """Invalidate the survey's derived analytics data when one of its answers changes"""
+    Survey.bump_data_version(questions=instance.question_id)
+
+@receiver(post_save, sender=Answer)
+def write_answer_facts(sender, instance, created, raw=False, **kwargs):
+    """Keep the analytics facts of a saved answer in step with its value (bulk inserts write theirs)"""
+    if raw:
+        return
+    if created:
+        add_answer_facts([instance])
+    else:
+        replace_answer_facts([instance])
+
+@receiver(pre_save, sender=User)
+def detect_respondent_group_change(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Note whether the fields a respondent's responses are grouped by are being changed"""
+    instance._respondent_groups_changed = False
+    if raw or instance.pk is None:
+        return
+    if update_fields is not None and not set(update_fields) & set(RESPONDENT_GROUP_FIELDS):
+        return
+    previous = sender.objects.filter(pk=instance.pk).values(*RESPONDENT_GROUP_FIELDS).first()
+    instance._respondent_groups_changed = previous is not None and any(
+        previous[field] != getattr(instance, field) for field in RESPONDENT_GROUP_FIELDS
+    )
+
+@receiver(post_save, sender=User)
+def bump_respondent_survey_data_version(sender, instance, **kwargs):
+    """Invalidate the derived analytics data of the surveys a respondent whose groups changed answered"""
+    if getattr(instance, '_respondent_groups_changed', False):
+        Survey.bump_data_version(pk__in=Response.objects.filter(respondent=instance).values('survey_id'))
+
+@receiver(pre_delete, sender=User)
+def bump_deleted_respondent_survey_data_version(sender, instance, **kwargs):
+    """The responses of a deleted respondent become anonymous and leave their groups"""
+    Survey.bump_data_version(pk__in=Response.objects.filter(respondent=instance).values('survey_id'))
+
+@receiver([post_save, post_delete], sender=Question)
+def bump_question_survey_data_version(sender, instance, **kwargs):
+    """Invalidate the survey's derived analytics data when one of its questions changes"""
+    Survey.bump_data_version(pk=instance.survey_id)
+
+@receiver([post_save, post_delete], sender=Question)
+def bump_question_survey_schema_version(sender, instance, **kwargs):
+    """Invalidate the answer validators compiled from the survey's questions when one of them changes"""
+    Survey.bump_schema_version(pk=instance.survey_id)
+
+@receiver(post_save, sender=Survey)
+def bump_survey_schema_version(sender, instance, raw=False, **kwargs):
+    """Invalidate the definition of an edited survey"""
+    if not raw:
+        Survey.bump_schema_version(pk=instance.pk)
+
+@receiver([post_save, post_delete], sender=Survey)
+@receiver([post_save, post_delete], sender=Question)
+def publish_survey_definition_version(sender, instance, **kwargs):
+    """Let the cached definitions know about the new version once the change is committed"""
+    survey_id = instance.pk if sender is Survey else instance.survey_id
+    transaction.on_commit(lambda: publish_definition_version(survey_id))
+
+@receiver(post_save, sender=Question)
+def create_question_rollup(sender, instance, created, raw=False, **kwargs):
+    """New questions have no answers yet, their rollup starts empty and is kept up to date by the answer writes"""
+    if created and not raw:
+        QuestionRollup.objects.get_or_create(question=instance)
+
+@receiver(post_save, sender=Question)
+def reindex_question_answer_facts(sender, instance, created, raw=False, **kwargs):
+    """The options of an edited choice question may have changed, and the option indices of its facts with them"""
+    if not created and not raw and instance.question_type in [Question.QUESTION_TYPES.SINGLE, Question.QUESTION_TYPES.MULTIPLE]:
+        reindex_question_facts(instance)
+
+@receiver(post_delete, sender=Survey)
+def delete_survey_answer_matrices(sender, instance, **kwargs):
+    """Delete the materialized analytics of a deleted survey once the deletion is committed"""
+    survey = Survey(pk=instance.pk)
+    transaction.on_commit(lambda: delete_answer_matrices(survey))
+
+@receiver(post_delete, sender=ExportJob)
+def delete_export_artifact(sender, instance, **kwargs):
+    """Delete the artifact of a deleted export job unless another job shares it"""
+    if instance.artifact_path and not ExportJob.objects.filter(artifact_path=instance.artifact_path).exists():
+        if default_storage.exists(instance.artifact_path):
+            default_storage.delete(instance.artifact_path)
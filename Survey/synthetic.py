@@ -0,0 +1,267 @@
+"""
+Reproducible synthetic surveys, for benchmarks and load tests.
+
+A dataset is a function of its seed and its shape only: the respondents and their
+demographics, the questions and every answer are drawn from numpy generators seeded
+with the seed, the index of the survey and the block of responses, so the same
+options give the same rows on any machine and two commits are benchmarked against
+identical surveys. The answers follow a latent satisfaction of the response,
+shifted by the gender and age of its respondent and drifting over time, so the
+correlations, group patterns and trends have something to find.
+
+Rows are written with bulk inserts, by blocks of responses each in a transaction,
+with the answer facts, rollups, stored file references and data version the
+regular write path maintains.
+"""
+import datetime
+import hashlib
+from collections import Counter
+
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import F
+
+from .config import ANSWER_FILE_PATH_KEY
+from .deletion import release_files
+from .facts import add_answer_facts
+from .files import store_file
+from .models import Answer, Question, Response, StoredFile, Survey
+from .rollups import rebuild_survey_rollups
+
+User = get_user_model()
+
+DEFAULT_QUESTION_COUNTS = {
+    Question.QUESTION_TYPES.RATING: 3,
+    Question.QUESTION_TYPES.SINGLE: 2,
+    Question.QUESTION_TYPES.MULTIPLE: 2,
+    Question.QUESTION_TYPES.TEXT: 1,
+    Question.QUESTION_TYPES.FILE: 0,
+}
+LOCATIONS = ['Amsterdam', 'Berlin', 'Lisbon', 'Madrid', 'Paris', 'Rome', 'Vienna', 'Warsaw']
+TEXT_ANSWERS = [
+    'Works as expected.',
+    'Too slow at peak hours.',
+    'The new layout is much clearer.',
+    'I could not find the export button.',
+    'Great support, quick answers.',
+    'Pricing is confusing.',
+]
+# distinct files referenced by the file answers, each stored once
+FILE_COUNT = 8
+# responses drawn from one generator, fixed so the data does not depend on how it is written
+BLOCK_SIZE = 1000
+# the submissions of every survey end at this date, so trends are the same whenever generated
+SUBMISSIONS_END = datetime.datetime(2024, 6, 30, tzinfo=datetime.timezone.utc)
+
+
+def _email_domain(seed):
+    return f's{seed}.synthetic.invalid'
+
+
+def synthetic_email(seed, index=None):
+    """Email of the respondent at the index of the dataset of the seed, of its creator without index"""
+    local = 'creator' if index is None else f'respondent-{index}'
+    return f'{local}@{_email_domain(seed)}'
+
+
+def _generator(seed, *stream):
+    return np.random.default_rng([seed, *stream])
+
+
+def get_respondents(seed, count):
+    """
+    The respondents of the seed with their demographics, created when missing.
+    Returns their ids, genders ('M'/'F') and ages as arrays ordered by index.
+    """
+    genders, ages, locations, birthdays = [], [], [], []
+    # by blocks, so the respondents of a smaller dataset of the seed are the first ones of a larger one
+    for block_start in range(0, count, BLOCK_SIZE):
+        rng = _generator(seed, 0, block_start // BLOCK_SIZE)
+        genders.append(np.where(rng.random(BLOCK_SIZE) < 0.5, User.Gender.MALE, User.Gender.FEMALE))
+        ages.append(rng.integers(18, 80, BLOCK_SIZE))
+        locations.append(rng.integers(0, len(LOCATIONS), BLOCK_SIZE))
+        birthdays.append(rng.integers(0, 365, BLOCK_SIZE))
+    genders, ages, locations, birthdays = (
+        np.concatenate(values)[:count] if values else np.zeros(0, dtype=np.int64)
+        for values in (genders, ages, locations, birthdays)
+    )
+
+    emails = [synthetic_email(seed, index) for index in range(count)]
+    synthetic_users = User.objects.filter(email__endswith=f'@{_email_domain(seed)}')
+    existing = dict(synthetic_users.values_list('email', 'id'))
+    users = []
+    for index, email in enumerate(emails):
+        if email in existing:
+            continue
+        user = User(
+            email=email,
+            is_verified=True,
+            gender=str(genders[index]),
+            location=LOCATIONS[locations[index]],
+            date_of_birth=(SUBMISSIONS_END - datetime.timedelta(days=int(ages[index]) * 365 + int(birthdays[index]))).date(),
+        )
+        user.set_unusable_password()
+        users.append(user)
+    User.objects.bulk_create(users, batch_size=BLOCK_SIZE)
+    if users:
+        existing = dict(synthetic_users.values_list('email', 'id'))
+    return np.array([existing[email] for email in emails], dtype=np.int64), genders, ages
+
+
+def _store_files(seed):
+    """Store the files of the file answers, with one reference each, and return their paths and hashes"""
+    files = []
+    for index in range(FILE_COUNT):
+        content = f'%PDF-1.4\n% synthetic file {index} of seed {seed}\n'.encode() * (64 * (index + 1))
+        sha256 = hashlib.sha256(content).hexdigest()
+        path = store_file(ContentFile(content, name=f'synthetic-{index}.pdf'), sha256=sha256)
+        files.append((path, sha256))
+    return files
+
+
+def _create_questions(survey, question_counts, rng):
+    """The questions of the survey with their hidden parameters: how their answers follow the latent satisfaction"""
+    questions = []
+    order = 0
+    for question_type, count in question_counts.items():
+        for index in range(count):
+            settings = {}
+            model = {'loading': rng.uniform(0.3, 1.0)}
+            if question_type == Question.QUESTION_TYPES.RATING:
+                settings = {'min_value': 1, 'max_value': 5 if index % 2 == 0 else 10, 'step': 1.0}
+            elif question_type in (Question.QUESTION_TYPES.SINGLE, Question.QUESTION_TYPES.MULTIPLE):
+                option_count = 3 + index % 3 if question_type == Question.QUESTION_TYPES.SINGLE else 5
+                settings = {'options': [f'Option {option + 1}' for option in range(option_count)]}
+                model['base'] = rng.normal(0, 0.7, option_count)
+                model['slopes'] = np.linspace(-1, 1, option_count) * model['loading']
+            order += 1
+            questions.append((Question(
+                survey=survey,
+                question_text=f'{question_type.replace("_", " ").capitalize()} question {index + 1}',
+                question_type=question_type,
+                # one required question, the others are skipped by some respondents
+                required=order == 1,
+                order=order,
+                settings=settings,
+            ), model))
+    Question.objects.bulk_create([question for question, _ in questions])
+    return questions
+
+
+def _answer_values(question, model, latent, rng, files):
+    """The values of the answers of a block of responses to the question"""
+    count = len(latent)
+    question_type = question.question_type
+    if question_type == Question.QUESTION_TYPES.RATING:
+        low, high = question.settings['min_value'], question.settings['max_value']
+        middle, spread = (low + high) / 2, (high - low) / 4
+        ratings = np.clip(np.rint(middle + spread * (model['loading'] * latent + rng.normal(0, 0.6, count))), low, high)
+        return [float(rating) for rating in ratings]
+    if question_type in (Question.QUESTION_TYPES.SINGLE, Question.QUESTION_TYPES.MULTIPLE):
+        options = question.settings['options']
+        logits = model['base'] + latent[:, None] * model['slopes']
+        if question_type == Question.QUESTION_TYPES.SINGLE:
+            # Gumbel-max, a draw of the softmax of the logits of every response
+            chosen = np.argmax(logits + rng.gumbel(size=logits.shape), axis=1)
+            return [{'choice': options[option]} for option in chosen]
+        selected = rng.random(logits.shape) < 1 / (1 + np.exp(1 - logits))
+        # at least one option, the most likely one
+        selected[np.arange(count), np.argmax(logits, axis=1)] |= ~selected.any(axis=1)
+        return [{'choices': [options[option] for option in np.flatnonzero(row)]} for row in selected]
+    if question_type == Question.QUESTION_TYPES.FILE:
+        return [{ANSWER_FILE_PATH_KEY: files[index][0]} for index in rng.integers(0, len(files), count)]
+    return [TEXT_ANSWERS[index] for index in rng.integers(0, len(TEXT_ANSWERS), count)]
+
+
+def generate_survey(
+        seed, index, creator, respondents, responses, question_counts=None,
+        answer_rate=0.9, anonymous_rate=0.1, days=90, closed=True, files=None):
+    """
+    Create the survey at the index of the dataset of the seed with its responses.
+    `respondents` are the ids, genders and ages returned by get_respondents, `files`
+    the stored files of the file answers, which get a reference per answer.
+    """
+    question_counts = DEFAULT_QUESTION_COUNTS if question_counts is None else question_counts
+    respondent_ids, genders, ages = respondents
+    rng = _generator(seed, 1, index)
+    start = SUBMISSIONS_END - datetime.timedelta(days=days)
+    with transaction.atomic():
+        survey = Survey.objects.create(
+            title=f'Synthetic survey {index + 1} (seed {seed})',
+            description=f'{responses} synthetic responses',
+            creator=creator,
+            closes_at=SUBMISSIONS_END if closed else SUBMISSIONS_END + datetime.timedelta(days=365 * 100),
+            respondent_auth_requirement=Survey.AuthRequirement.NONE,
+        )
+        questions = _create_questions(survey, question_counts, rng)
+
+    for block_start in range(0, responses, BLOCK_SIZE):
+        count = min(BLOCK_SIZE, responses - block_start)
+        rng = _generator(seed, 2, index, block_start // BLOCK_SIZE)
+        respondent_indices = rng.integers(0, max(len(respondent_ids), 1), count)
+        anonymous = (rng.random(count) < anonymous_rate) | (len(respondent_ids) == 0)
+        # submissions in id order over the period, satisfaction drifting upwards
+        progress = (block_start + np.arange(count) + rng.random(count)) / responses
+        latent = rng.normal(0, 1, count) + 0.8 * progress - 0.4
+        if len(respondent_ids):
+            shift = np.where(genders[respondent_indices] == User.Gender.FEMALE, 0.3, -0.3) - (ages[respondent_indices] - 45) / 40
+            latent += np.where(anonymous, 0, shift)
+        completion_seconds = rng.lognormal(5.5, 0.5, count)
+
+        response_rows = [
+            Response(
+                survey=survey,
+                respondent_id=None if anonymous[i] else int(respondent_ids[respondent_indices[i]]),
+                completion_time=datetime.timedelta(seconds=int(completion_seconds[i])),
+            )
+            for i in range(count)
+        ]
+        answers = []
+        file_references = Counter()
+        for question, model in questions:
+            answered = np.ones(count, dtype=bool) if question.required else rng.random(count) < answer_rate
+            values = _answer_values(question, model, latent, rng, files)
+            for i in np.flatnonzero(answered):
+                answers.append(Answer(response=response_rows[i], question=question, value=values[i]))
+            if question.question_type == Question.QUESTION_TYPES.FILE:
+                file_references.update(values[i][ANSWER_FILE_PATH_KEY] for i in np.flatnonzero(answered))
+        with transaction.atomic():
+            Response.objects.bulk_create(response_rows)
+            # submitted_at is set on insert, spread the submissions over the period afterwards
+            for response, position in zip(response_rows, progress):
+                response.submitted_at = start + (SUBMISSIONS_END - start) * float(position)
+            Response.objects.bulk_update(response_rows, ['submitted_at'], batch_size=BLOCK_SIZE)
+            Answer.objects.bulk_create(answers, batch_size=BLOCK_SIZE)
+            add_answer_facts(answers)
+            for path, sha256 in files or []:
+                if file_references[path]:
+                    StoredFile.objects.filter(sha256=sha256).update(ref_count=F('ref_count') + file_references[path])
+
+    rebuild_survey_rollups(survey)
+    Survey.bump_data_version(pk=survey.pk)
+    survey.refresh_from_db()
+    return survey
+
+
+def generate_dataset(seed, surveys=1, responses=1000, respondents=200, creator=None, **survey_options):
+    """
+    Create the surveys of the dataset of the seed, yielding each once written. The
+    respondents of the seed are shared by its surveys, the creator defaults to the
+    synthetic one of the seed. `survey_options` are passed on to generate_survey.
+    """
+    if creator is None:
+        creator, created = User.objects.get_or_create(email=synthetic_email(seed), defaults={'is_verified': True})
+        if created:
+            creator.set_unusable_password()
+            creator.save(update_fields=['password'])
+    respondents = get_respondents(seed, respondents)
+    question_counts = survey_options.get('question_counts') or DEFAULT_QUESTION_COUNTS
+    files = _store_files(seed) if question_counts.get(Question.QUESTION_TYPES.FILE) else []
+    try:
+        for index in range(surveys):
+            yield generate_survey(seed, index, creator, respondents, responses, files=files, **survey_options)
+    finally:
+        # the answers hold their own references now
+        release_files(path for path, _ in files)
@@ -1,3 +1,1418 @@
-from django.test import TestCase
+import base64
+import csv
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import tempfile
+import zlib
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models import Count
+from django.http import QueryDict
+from django.test import Client, LiveServerTestCase, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from . import exports
+from .cache import local_cache, normalize_statistics_params, statistics_cache_key
+from .deletion import delete_survey_in_batches, drain_file_deletions, release_files
+from .facts import answer_facts
+from .exports import answer_display_value, stream_responses_csv, stream_responses_ndjson, stream_responses_pdf
+from .files import store_file, stored_file_path
+from .loaders import SurveyLoader, parse_survey_id
+from .bitmaps import Bitmap, get_bitmap_index, parse_filter_expression
+from .loadtest import Budget, Recorder, create_fixture, run_load_test
+from .jobs import delete_superseded_jobs, export_artifact_path, export_fingerprint
+from .live import live_statistics_events
+from .matrix import answer_matrix_directory, get_answer_matrix
+from .pdf import ROWS_PER_PAGE
+from .models import Answer, AnswerFact, ExportJob, Question, QuestionRollup, Response, StoredFile, Survey, Upload
+from .rollups import build_survey_rollups, rebuild_survey_rollups
+from .services import (
+    ACCEPTED_Q_TYPES, _calculate_general_correlation, _calculate_question_statistics, _calculate_rollup_question_statistics,
+    _filter_expression_responses,
+)
+from .synthetic import generate_dataset, get_respondents
+from .uploads import partial_path
+from .validators import _validators_cache, compile_answer_validator, get_survey_validators
+from .views import ResponseAnswerViewSet, ResponseViewSet, SurveyViewSet
+
+User = get_user_model()
+
+QUESTION_COUNTS = {
+    Question.QUESTION_TYPES.RATING: 2,
+    Question.QUESTION_TYPES.SINGLE: 1,
+    Question.QUESTION_TYPES.MULTIPLE: 1,
+    Question.QUESTION_TYPES.TEXT: 1,
+    Question.QUESTION_TYPES.FILE: 1,
+}
+LOCAL_CACHES = {
+    alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': f'survey-tests-{alias}'}
+    for alias in ('default', 'analytics', 'definitions')
+}
+
+
+class SurveyTestCase(TestCase):
+    """
+    An open synthetic survey with a few responses, its files stored in a temporary
+    MEDIA_ROOT. Queued file releases are drained by the tests, not in the background.
+    """
+    seed = 7
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        overridden = override_settings(
+            MEDIA_ROOT=media_root,
+            UPLOAD_PARTIAL_DIR=os.path.join(media_root, 'partial'),
+            CACHES=LOCAL_CACHES,
+        )
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        schedule_drain = mock.patch('Survey.deletion.schedule_drain')
+        schedule_drain.start()
+        self.addCleanup(schedule_drain.stop)
+        # survey ids are reused once a test is rolled back
+        _validators_cache.clear()
+        local_cache.clear()
+        for alias in LOCAL_CACHES:
+            caches[alias].clear()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.survey, = generate_dataset(
+                self.seed, responses=20, respondents=3, question_counts=QUESTION_COUNTS, closed=False
+            )
+        drain_file_deletions()
+        respondent_ids, _, _ = get_respondents(self.seed, 3)
+        self.respondent = User.objects.get(pk=int(respondent_ids[0]))
+        self.client = APIClient()
+        self.client.force_authenticate(self.respondent)
+        self.questions = {question.question_type: question for question in self.survey.questions.order_by('-order')}
+        self.rng = random.Random(self.seed)
+
+    def answer_value(self, question):
+        if question.question_type == Question.QUESTION_TYPES.RATING:
+            return float(self.rng.randint(question.settings['min_value'], question.settings['max_value']))
+        if question.question_type == Question.QUESTION_TYPES.SINGLE:
+            return {'choice': self.rng.choice(question.settings['options'])}
+        if question.question_type == Question.QUESTION_TYPES.MULTIPLE:
+            options = question.settings['options']
+            return {'choices': self.rng.sample(options, self.rng.randint(1, len(options)))}
+        return f'Answer {self.rng.randint(0, 999)}'
+
+    def submit(self, skip=(), **file_answer):
+        """Submit a response of the respondent answering every question but the skipped ones"""
+        answers = []
+        for question in self.survey.questions.order_by('order'):
+            if question.id in skip:
+                continue
+            if question.question_type == Question.QUESTION_TYPES.FILE:
+                if file_answer:
+                    answers.append({'question': question.id, **file_answer})
+            else:
+                answers.append({'question': question.id, 'value': self.answer_value(question)})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('survey-responses-list'), {'survey': self.survey.id, 'answers': answers}, format='json'
+            )
+        self.assertEqual(response.status_code, 201, response.data)
+        return Response.objects.get(pk=response.data['id'])
+
+
+class SyntheticDatasetTests(SurveyTestCase):
+    """The generated survey has the requested shape"""
+
+    def test_generated(self):
+        counts = {}
+        for question in self.survey.questions.all():
+            counts[question.question_type] = counts.get(question.question_type, 0) + 1
+        self.assertEqual(counts, QUESTION_COUNTS)
+        self.assertEqual(self.survey.responses.count(), 20)
+        respondent_ids, _, _ = get_respondents(self.seed, 3)
+        self.assertLessEqual(
+            set(self.survey.responses.exclude(respondent=None).values_list('respondent_id', flat=True)), {int(pk) for pk in respondent_ids}
+        )
+        # the file question is left unanswered
+        self.assertEqual(self.submit().answers.count(), self.survey.questions.count() - 1)
+
+
+class AnalyticsConsistencyTests(SurveyTestCase):
+    """The rollups and facts kept up to date with the answers are those computed from the answers"""
+
+    def assertAnalyticsMatchAnswers(self):
+        expected = build_survey_rollups(self.survey)
+        rollups = {rollup.question_id: rollup for rollup in QuestionRollup.objects.filter(question__survey=self.survey)}
+        self.assertEqual(set(rollups), set(expected))
+        for question_id, rollup in rollups.items():
+            with self.subTest(question=question_id):
+                self.assertEqual(rollup.answer_count, expected[question_id].answer_count)
+                self.assertEqual(rollup.option_counts, expected[question_id].option_counts)
+                self.assertEqual(rollup.rating_count, expected[question_id].rating_count)
+                self.assertEqual(rollup.rating_counts, expected[question_id].rating_counts)
+                self.assertAlmostEqual(rollup.rating_sum, expected[question_id].rating_sum)
+                self.assertAlmostEqual(rollup.rating_sum_squares, expected[question_id].rating_sum_squares)
+
+        fact_fields = ['answer_id', 'question_id', 'response_id', 'rating', 'choice', 'option_index']
+        facts = sorted(AnswerFact.objects.filter(survey=self.survey).values_list(*fact_fields))
+        expected_facts = sorted(
+            tuple(getattr(fact, field) for field in fact_fields)
+            for answer in Answer.objects.filter(response__survey=self.survey).select_related('question')
+            for fact in answer_facts(answer, answer.question)
+        )
+        self.assertEqual(facts, expected_facts)
+
+    def test_generated(self):
+        self.assertAnalyticsMatchAnswers()
+
+    def test_create(self):
+        for _ in range(3):
+            self.submit()
+        self.assertAnalyticsMatchAnswers()
+
+    def test_update(self):
+        added = self.questions[Question.QUESTION_TYPES.TEXT]
+        response = self.submit(skip={added.id})
+        updates = [
+            {'id': answer.id, 'value': self.answer_value(answer.question)}
+            for answer in response.answers.select_related('question')
+            if answer.question.question_type != Question.QUESTION_TYPES.TEXT
+        ]
+        result = self.client.patch(
+            reverse('response-answers-bulk-update', kwargs={'response_pk': response.id}), {'answers': updates}, format='json'
+        )
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual((len(result.data['updated']), result.data['errors']), (len(updates), []))
+        result = self.client.post(
+            reverse('response-answers-add-answers', kwargs={'response_pk': response.id}),
+            {'answers': [{'question': added.id, 'value': 'Added later'}]}, format='json'
+        )
+        self.assertEqual((len(result.data['created']), result.data['errors']), (1, []))
+        self.assertAnalyticsMatchAnswers()
+
+    def test_delete(self):
+        first, second = self.submit(), self.submit()
+        ResponseViewSet().perform_destroy(first)
+        rating = second.answers.get(question=self.questions[Question.QUESTION_TYPES.RATING])
+        choice = second.answers.get(question=self.questions[Question.QUESTION_TYPES.MULTIPLE])
+        ResponseAnswerViewSet().perform_destroy(rating)
+        ResponseAnswerViewSet().perform_destroy(choice)
+        self.assertFalse(AnswerFact.objects.filter(answer_id__in=[rating.id, choice.id]).exists())
+        self.assertAnalyticsMatchAnswers()
+
+        # the materialized analytics of the survey are deleted with it
+        survey_id, analytics_directory = self.survey.id, answer_matrix_directory(self.survey)
+        os.makedirs(os.path.join(answer_matrix_directory(self.survey, self.survey.data_version), 'bitmaps'))
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in delete_survey_in_batches(self.survey):
+                pass
+        self.assertFalse(AnswerFact.objects.filter(survey_id=survey_id).exists())
+        self.assertFalse(QuestionRollup.objects.filter(question__survey_id=survey_id).exists())
+        self.assertFalse(os.path.exists(analytics_directory))
+
+    def test_rollups_follow_a_batched_deletion(self):
+        batches = delete_survey_in_batches(self.survey, batch_size=6)
+        self.assertEqual(next(batches), 6)
+        self.assertEqual(self.survey.responses.count(), 14)
+        self.assertAnalyticsMatchAnswers()
+
+    def test_statistics_paths_agree(self):
+        # an answer to a rating question without a rating still counts as an answer
+        rating = self.survey.questions.filter(question_type=Question.QUESTION_TYPES.RATING, required=False).first()
+        response = self.submit(skip={rating.id})
+        Answer.objects.create(response=response, question=rating, value=None)
+        rebuild_survey_rollups(self.survey)
+
+        questions = list(self.survey.questions.all())
+        total = self.survey.responses.count()
+        from_rollups = {stats['id']: stats for stats in _calculate_rollup_question_statistics(questions, total)}
+        from_facts = {stats['id']: stats for stats in _calculate_question_statistics(self.survey, self.survey.responses.all(), total)}
+        self.assertEqual(from_rollups[rating.id]['total_ratings'], Answer.objects.filter(question=rating).count())
+        for question_id, stats in from_facts.items():
+            with self.subTest(question=question_id):
+                self.assertEqual(from_rollups[question_id].keys(), stats.keys())
+                for key, value in stats.items():
+                    if isinstance(value, float):
+                        self.assertAlmostEqual(from_rollups[question_id][key], value)
+                    else:
+                        self.assertEqual(from_rollups[question_id][key], value)
+
+    def test_answers_to_other_surveys_rejected(self):
+        response = self.submit()
+        with self.captureOnCommitCallbacks(execute=True):
+            other, = generate_dataset(self.seed + 1, responses=0, respondents=1, closed=False)
+        foreign = other.questions.filter(question_type=Question.QUESTION_TYPES.TEXT).first()
+        result = self.client.post(
+            reverse('response-answers-add-answers', kwargs={'response_pk': response.id}),
+            {'answers': [{'question': foreign.id, 'value': 'Elsewhere'}]}, format='json'
+        )
+        self.assertEqual(result.data['created'], [])
+        self.assertEqual(result.data['errors'][0]['question'], foreign.id)
+        self.assertFalse(response.answers.filter(question=foreign).exists())
+
+        answer = response.answers.get(question=self.questions[Question.QUESTION_TYPES.TEXT])
+        result = self.client.patch(
+            reverse('response-answers-bulk-update', kwargs={'response_pk': response.id}),
+            {'answers': [{'id': answer.id, 'question': foreign.id, 'value': 'Elsewhere'}]}, format='json'
+        )
+        self.assertEqual((result.data['updated'], result.data['errors'][0]['id']), ([], answer.id))
+        answer.refresh_from_db()
+        self.assertEqual(answer.question_id, self.questions[Question.QUESTION_TYPES.TEXT].id)
+        self.assertAnalyticsMatchAnswers()
+
+
+
+class SubmissionTests(SurveyTestCase):
+    """Responses are inserted with their answers by a fixed number of bulk queries"""
+
+    def submission_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.submit()
+        return len(queries)
+
+    def test_queries_independent_of_the_answers(self):
+        self.submit()
+        queries = self.submission_queries()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.survey, = generate_dataset(
+                self.seed + 1, responses=1, respondents=3, closed=False,
+                question_counts={question_type: 4 * count for question_type, count in QUESTION_COUNTS.items()},
+            )
+        self.submit()
+        self.assertEqual(self.submission_queries(), queries)
+
+    def test_submission_bumps_the_data_version(self):
+        data_version = self.survey.data_version
+        self.submit()
+        self.survey.refresh_from_db()
+        self.assertEqual(self.survey.data_version, data_version + 1)
+
+    def test_invalid_submission_inserts_nothing(self):
+        rating = self.questions[Question.QUESTION_TYPES.RATING]
+        answers = [
+            {'question': question.id, 'value': self.answer_value(question)}
+            for question in self.survey.questions.exclude(question_type=Question.QUESTION_TYPES.FILE)
+        ]
+        next(answer for answer in answers if answer['question'] == rating.id)['value'] = rating.settings['max_value'] + 1
+        responses, answer_count = self.survey.responses.count(), Answer.objects.count()
+        result = self.client.post(
+            reverse('survey-responses-list'), {'survey': self.survey.id, 'answers': answers}, format='json'
+        )
+        self.assertEqual(result.status_code, 400)
+        self.assertEqual((self.survey.responses.count(), Answer.objects.count()), (responses, answer_count))
+
+
+    def test_survey_read_once(self):
+        answers = [
+            {'question': question.id, 'value': self.answer_value(question)}
+            for question in self.survey.questions.exclude(question_type=Question.QUESTION_TYPES.FILE)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse('survey-responses-list'), {'survey': self.survey.id, 'answers': answers}, format='json'
+            )
+        self.assertEqual(response.status_code, 201, response.data)
+        selects = [query['sql'] for query in queries if query['sql'].startswith('SELECT')]
+        # the permission compares ids instead of loading the creator or the respondent
+        for table, reads in ((Survey, 1), (Question, 1), (User, 0)):
+            with self.subTest(table=table._meta.db_table):
+                self.assertEqual(sum(f'FROM "{table._meta.db_table}"' in sql for sql in selects), reads)
+
+class SurveyLoaderTests(SurveyTestCase):
+    """The surveys of a request and their questions are read once"""
+
+    def test_loaded_once(self):
+        loader = SurveyLoader()
+        with self.assertNumQueries(2):
+            survey = loader.get(str(self.survey.id))
+        with self.assertNumQueries(0):
+            self.assertIs(loader.get(self.survey.id), survey)
+            loader.load([self.survey.id])
+        self.assertEqual(
+            [question.id for question in loader.survey_questions[survey.id]],
+            list(self.survey.questions.values_list('id', flat=True)),
+        )
+        self.assertTrue(all(question.survey is survey for question in loader.questions.values()))
+
+    def test_missing_surveys(self):
+        loader = SurveyLoader()
+        with self.assertNumQueries(1):
+            self.assertIsNone(loader.get(self.survey.id + 1000))
+            self.assertIsNone(loader.get(self.survey.id + 1000))
+        with self.assertNumQueries(0):
+            for value in (None, True, 'x', -1, 0):
+                self.assertIsNone(loader.get(value))
+
+    def test_survey_ids(self):
+        self.assertEqual([parse_survey_id(value) for value in (3, '3', 3.0, '-3', True, [3], None)], [3, 3, 3, None, None, None, None])
+
+class BatchSubmissionTests(SurveyTestCase):
+    """Many responses submitted at once, each item getting its own result"""
+
+    def item(self, survey=None):
+        survey = survey or self.survey
+        return {'survey': survey.id, 'answers': [
+            {'question': question.id, 'value': self.answer_value(question)}
+            for question in survey.questions.exclude(question_type=Question.QUESTION_TYPES.FILE)
+        ]}
+
+    def batch(self, items):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('survey-responses-batch'), {'responses': items}, format='json')
+
+    @mock.patch('Survey.views.RESPONSE_BATCH_CHUNK_SIZE', 2)
+    def test_all_created(self):
+        existing = set(self.survey.responses.values_list('id', flat=True))
+        result = self.batch([self.item() for _ in range(5)])
+        self.assertEqual(result.status_code, 201, result.data)
+        self.assertEqual((result.data['created'], result.data['failed']), (5, 0))
+        self.assertEqual(
+            {item['id'] for item in result.data['results']},
+            set(self.survey.responses.values_list('id', flat=True)) - existing,
+        )
+        expected = build_survey_rollups(self.survey)
+        for rollup in QuestionRollup.objects.filter(question__survey=self.survey):
+            self.assertEqual(rollup.answer_count, expected[rollup.question_id].answer_count)
+
+    def test_per_item_errors(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            closed, = generate_dataset(self.seed + 1, responses=0, respondents=1, closed=True)
+        invalid = self.item()
+        rating = self.questions[Question.QUESTION_TYPES.RATING]
+        next(answer for answer in invalid['answers'] if answer['question'] == rating.id)['value'] = rating.settings['max_value'] + 1
+        responses = self.survey.responses.count()
+        result = self.batch([self.item(), invalid, self.item(closed), {'survey': 0, 'answers': []}, 'not a response', self.item()])
+
+        self.assertEqual(result.status_code, 207)
+        self.assertEqual((result.data['created'], result.data['failed']), (2, 4))
+        self.assertEqual(
+            [(item['index'], item['status']) for item in result.data['results']],
+            [(0, 'created'), (1, 'error'), (2, 'error'), (3, 'error'), (4, 'error'), (5, 'created')],
+        )
+        self.assertEqual(result.data['results'][2]['errors'], {'survey': ['Survey is closed']})
+        self.assertIn('survey', result.data['results'][3]['errors'])
+        self.assertEqual(self.survey.responses.count(), responses + 2)
+        self.assertFalse(closed.responses.exists())
+
+    def test_invalid_batches(self):
+        self.assertEqual(self.batch([]).status_code, 400)
+        with mock.patch('Survey.views.RESPONSE_BATCH_MAX_SIZE', 2):
+            self.assertEqual(self.batch([self.item() for _ in range(3)]).status_code, 400)
+
+
+class AnswerValidatorTests(SurveyTestCase):
+    """The compiled validators give the answers the errors of the rules they replaced"""
+
+    MULTIPLE = {'options': ['a', 'b', 'c'], 'flexable': False, 'min_selections': 2, 'max_selections': 3}
+    RATING = {'min_value': 1, 'max_value': 5, 'step': 0.5}
+    CASES = [
+        (Question.QUESTION_TYPES.TEXT, {}, 'hello', None),
+        (Question.QUESTION_TYPES.TEXT, {}, '', "Text question must have a value"),
+        (Question.QUESTION_TYPES.TEXT, {}, 3.0, "Text question must have a value"),
+        (Question.QUESTION_TYPES.TEXT, {'min_length': 3}, 'ab', "Answer must be at least 3 characters"),
+        (Question.QUESTION_TYPES.TEXT, {'max_length': 3}, 'abcd', "Answer cannot exceed 3 characters"),
+        (Question.QUESTION_TYPES.SINGLE, {'options': ['a', 'b']}, {'choice': 'a'}, None),
+        (Question.QUESTION_TYPES.SINGLE, {'options': ['a', 'b']}, {'choice': 1}, "Single choice question can only have one selected option"),
+        (Question.QUESTION_TYPES.SINGLE, {'options': ['a', 'b']}, {}, "Single choice question can only have one selected option"),
+        (Question.QUESTION_TYPES.SINGLE, {'options': ['a', 'b']}, {'choice': 'z'}, "the choice (z) is not a valid choice for this question"),
+        (Question.QUESTION_TYPES.MULTIPLE, MULTIPLE, {'choices': ['a', 'b']}, None),
+        (Question.QUESTION_TYPES.MULTIPLE, MULTIPLE, {'choices': []},
+         "Muliple choice questions must have `choices` in `value` and have at least one selected option"),
+        (Question.QUESTION_TYPES.MULTIPLE, MULTIPLE, {'choices': 'ab'}, "the `choices` in `value` must be a list"),
+        (Question.QUESTION_TYPES.MULTIPLE, MULTIPLE, {'choices': ['a']}, "Choice questions must have at least 2 selected options"),
+        (Question.QUESTION_TYPES.MULTIPLE, MULTIPLE, {'choices': ['a', 'b', 'c', 'a']}, "Choice questions must have at most 3 selected options"),
+        (Question.QUESTION_TYPES.MULTIPLE, MULTIPLE, {'choices': ['a', 'z']}, "the choice `z` is not a valid choice for this question"),
+        (Question.QUESTION_TYPES.MULTIPLE, {'flexable': True}, {'choices': ['q', 'r']}, None),
+        (Question.QUESTION_TYPES.RATING, RATING, 2.5, None),
+        (Question.QUESTION_TYPES.RATING, RATING, 3, "Rating question must have an float value"),
+        (Question.QUESTION_TYPES.RATING, RATING, 7.0, "Rating question must have an float value between min value and max value"),
+        (Question.QUESTION_TYPES.RATING, RATING, 2.25, "Rating question must have an float value with the correct step 0.5"),
+    ]
+
+    def test_previous_errors(self):
+        for question_type, settings, value, message in self.CASES:
+            with self.subTest(question_type=question_type, settings=settings, value=value):
+                validate = compile_answer_validator(Question(question_type=question_type, settings=settings))
+                if message is None:
+                    validate(value)
+                else:
+                    with self.assertRaisesMessage(ValidationError, message):
+                        validate(value)
+
+    def test_missing_settings(self):
+        with self.assertRaisesMessage(ValidationError, "the choice (a) is not a valid choice for this question"):
+            compile_answer_validator(Question(question_type=Question.QUESTION_TYPES.SINGLE, settings={}))({'choice': 'a'})
+        compile_answer_validator(Question(question_type=Question.QUESTION_TYPES.RATING, settings={}))(3.0)
+
+    def test_compiled_once_per_schema_version(self):
+        validators = get_survey_validators(self.survey)
+        with self.assertNumQueries(0):
+            self.assertIs(get_survey_validators(self.survey), validators)
+
+        text = self.questions[Question.QUESTION_TYPES.TEXT]
+        text.settings = {**(text.settings or {}), 'max_length': 3}
+        text.save()
+        self.survey.refresh_from_db()
+        self.assertIsNot(get_survey_validators(self.survey), validators)
+        answers = [{'question': text.id, 'value': 'abcd'}]
+        result = self.client.post(reverse('survey-responses-list'), {'survey': self.survey.id, 'answers': answers}, format='json')
+        self.assertEqual(result.status_code, 400)
+        self.assertIn("Answer cannot exceed 3 characters", str(result.data))
+
+
+class SurveyDefinitionTests(SurveyTestCase):
+    """Survey definitions served from the cache with an ETag, a 304 to clients holding them"""
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.survey.creator)
+
+    def get(self, url, etag=None):
+        headers = {'If-None-Match': etag} if etag else {}
+        return self.client.get(url, headers=headers)
+
+    def test_not_modified(self):
+        for url in (
+            reverse('survey-detail', kwargs={'pk': self.survey.id}),
+            reverse('survey-questions-survey-questions', kwargs={'survey_pk': self.survey.id}),
+        ):
+            with self.subTest(url=url):
+                first = self.get(url)
+                self.assertEqual(first.status_code, 200)
+                self.assertIn('private', first['Cache-Control'])
+                with self.assertNumQueries(0):
+                    repeat = self.get(url)
+                    not_modified = self.get(url, first['ETag'])
+                self.assertEqual((repeat['ETag'], repeat.content), (first['ETag'], first.content))
+                self.assertEqual(not_modified.status_code, 304)
+                self.assertEqual(not_modified['ETag'], first['ETag'])
+                self.assertEqual(self.get(url, '"other"').status_code, 200)
+
+        anonymous = APIClient().get(reverse('survey-detail', kwargs={'pk': self.survey.id}))
+        self.assertEqual(anonymous.status_code, 200)
+        self.assertIn('public', anonymous['Cache-Control'])
+
+    def test_edits_change_the_etag(self):
+        url = reverse('survey-questions-survey-questions', kwargs={'survey_pk': self.survey.id})
+        etag = self.get(url)['ETag']
+        question = self.questions[Question.QUESTION_TYPES.TEXT]
+        with self.captureOnCommitCallbacks(execute=True):
+            question.question_text = 'Edited'
+            question.save()
+        edited = self.get(url, etag)
+        self.assertEqual(edited.status_code, 200)
+        self.assertNotEqual(edited['ETag'], etag)
+        self.assertIn('Edited', [item['question_text'] for item in edited.json()])
+
+        url = reverse('survey-detail', kwargs={'pk': self.survey.id})
+        etag = self.get(url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.survey.title = 'Edited'
+            self.survey.save()
+        edited = self.get(url, etag)
+        self.assertEqual(edited.status_code, 200)
+        self.assertEqual(edited.json()['title'], 'Edited')
+
+    def test_max_age_until_closing(self):
+        Survey.objects.filter(pk=self.survey.pk).update(closes_at=timezone.now() + timedelta(seconds=30))
+        response = self.get(reverse('survey-detail', kwargs={'pk': self.survey.id}))
+        max_age = int(re.search(r'max-age=(\d+)', response['Cache-Control']).group(1))
+        self.assertLessEqual(max_age, 30)
+
+
+
+class LegacyStatisticsFilterTests(SurveyTestCase):
+    """The filter_question and filter_value pair, read from the answer facts"""
+
+    def setUp(self):
+        super().setUp()
+        Survey.objects.filter(pk=self.survey.pk).update(closes_at=timezone.now() - timedelta(days=1))
+        self.client.force_authenticate(self.survey.creator)
+
+    def statistics(self, question, value):
+        return self.client.get(
+            reverse('survey-statistics', kwargs={'pk': self.survey.pk}), {'filter_question': question.id, 'filter_value': value}
+        )
+
+    @override_settings(SURVEY_ANSWER_MATRIX_ENABLED=False)
+    def test_choice_filter(self):
+        single = self.questions[Question.QUESTION_TYPES.SINGLE]
+        option = single.settings['options'][0]
+        response = self.statistics(single, option)
+        self.assertEqual(response.status_code, 200)
+        stats = next(stats for stats in response.data['questions'] if stats['id'] == single.id)
+        chosen = AnswerFact.objects.filter(question=single, choice=option).count()
+        self.assertEqual(sum(stats['option_distribution'].values()), chosen)
+
+    def test_text_and_file_filters_rejected(self):
+        for question_type in (Question.QUESTION_TYPES.TEXT, Question.QUESTION_TYPES.FILE):
+            with self.subTest(question_type=question_type):
+                self.assertEqual(self.statistics(self.questions[question_type], 'Answer').status_code, 400)
+
+class FilterExpressionTests(SurveyTestCase):
+    """Filter expressions give the same responses on the bitmap index and on the answer facts"""
+
+    def setUp(self):
+        super().setUp()
+        Survey.objects.filter(pk=self.survey.pk).update(closes_at=timezone.now() - timedelta(days=1))
+        self.survey.refresh_from_db()
+        self.client.force_authenticate(self.survey.creator)
+        self.filterable = {
+            question.id: question for question in self.survey.questions.filter(question_type__in=ACCEPTED_Q_TYPES)
+        }
+
+    def random_expression(self, depth=0):
+        if depth == 3 or self.rng.random() < 0.4:
+            question = self.rng.choice(list(self.filterable.values()))
+            if question.question_type == Question.QUESTION_TYPES.RATING:
+                value = self.rng.choice([*Answer.objects.filter(question=question).values_list('value', flat=True)[:5], 0.25])
+            else:
+                value = self.rng.choice([*question.settings['options'], 'None of them'])
+            return {'question': question.id, 'value': value}
+        if self.rng.random() < 0.2:
+            return {'not': self.random_expression(depth + 1)}
+        operator = self.rng.choice(['and', 'or'])
+        return {operator: [self.random_expression(depth + 1) for _ in range(self.rng.randint(1, 3))]}
+
+    def test_bitmaps_match_the_database(self):
+        matrix = get_answer_matrix(self.survey)
+        index = get_bitmap_index(self.survey, matrix)
+        for _ in range(50):
+            expression = parse_filter_expression(json.dumps(self.random_expression()))
+            with self.subTest(expression=expression):
+                from_bitmaps = set(matrix.response_ids[index.evaluate(expression).to_mask()].tolist())
+                from_facts = _filter_expression_responses(expression, self.filterable, self.survey.responses.all())
+                self.assertEqual(from_bitmaps, set(from_facts.values_list('id', flat=True)))
+
+    def test_index_saved_with_the_matrix(self):
+        matrix = get_answer_matrix(self.survey)
+        built = get_bitmap_index(self.survey, matrix)
+        self.assertTrue(os.path.isdir(os.path.join(answer_matrix_directory(self.survey, matrix.data_version), 'bitmaps')))
+        loaded = get_bitmap_index(self.survey, matrix)
+        self.assertEqual(loaded.entries, built.entries)
+        expression = {'or': [{'question': question_id, 'value': str(value)} for question_id, value in (
+            (question.id, question.settings['options'][0]) for question in self.filterable.values()
+            if question.question_type != Question.QUESTION_TYPES.RATING
+        )]}
+        self.assertEqual(loaded.evaluate(expression).to_mask().tolist(), built.evaluate(expression).to_mask().tolist())
+
+    def test_not_ignores_the_padding(self):
+        self.assertEqual(len(~Bitmap.empty(70)), 70)
+        bitmap = Bitmap.from_ordinals([0, 63, 64, 69], 70)
+        self.assertEqual(len(bitmap), 4)
+        self.assertEqual((~bitmap).to_mask().tolist(), [i not in (0, 63, 64, 69) for i in range(70)])
+
+    def statistics(self, filters):
+        for alias in LOCAL_CACHES:
+            caches[alias].clear()
+        local_cache.clear()
+        return self.client.get(reverse('survey-statistics', kwargs={'pk': self.survey.pk}), {'filters': json.dumps(filters)})
+
+    def test_statistics_paths_agree(self):
+        single, rating = self.questions[Question.QUESTION_TYPES.SINGLE], self.questions[Question.QUESTION_TYPES.RATING]
+        filters = {'or': [{'not': {'question': single.id, 'value': single.settings['options'][0]}},
+                          {'question': rating.id, 'value': rating.settings['max_value']}]}
+        from_bitmaps = self.statistics(filters)
+        with override_settings(SURVEY_ANSWER_MATRIX_ENABLED=False):
+            from_facts = self.statistics(filters)
+        self.assertEqual((from_bitmaps.status_code, from_facts.status_code), (200, 200))
+        keys = ('option_distribution', 'total_ratings', 'rating_distribution')
+        self.assertEqual(
+            [{key: stats.get(key) for key in keys} for stats in from_bitmaps.data['questions']],
+            [{key: stats.get(key) for key in keys} for stats in from_facts.data['questions']],
+        )
+
+    def test_invalid_filters(self):
+        text = self.questions[Question.QUESTION_TYPES.TEXT]
+        for filters in ('{', {'xor': []}, {'and': []}, {'question': text.id, 'value': 'Answer'},
+                        {'not': {'question': 'x', 'value': 1}}):
+            with self.subTest(filters=filters):
+                response = self.client.get(
+                    reverse('survey-statistics', kwargs={'pk': self.survey.pk}),
+                    {'filters': filters if isinstance(filters, str) else json.dumps(filters)},
+                )
+                self.assertEqual(response.status_code, 400)
+
+class UploadLifecycleTests(SurveyTestCase):
+    """Chunked uploads, from their declaration to the deletion of the answer using them"""
+
+    def upload(self, content, checksum=None):
+        result = self.client.post(reverse('file-uploads'), {
+            'purpose': Upload.Purpose.ANSWER,
+            'question': self.questions[Question.QUESTION_TYPES.FILE].id,
+            'extension': 'pdf',
+            'size': len(content),
+            'checksum': hashlib.sha256(content).hexdigest() if checksum is None else checksum,
+        }, format='json')
+        self.assertEqual(result.status_code, 201, result.data)
+        return result.data['id']
+
+    def send_chunk(self, upload_id, offset, chunk):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.generic(
+                'PATCH', reverse('file-upload', kwargs={'upload_id': upload_id}), chunk,
+                content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET=str(offset),
+            )
+
+    def test_upload_attached_then_deleted(self):
+        content = os.urandom(100_000)
+        upload_id = self.upload(content)
+        result = self.send_chunk(upload_id, 0, content[:60_000])
+        self.assertEqual((result.status_code, result.data['offset']), (200, 60_000))
+        self.assertEqual(self.send_chunk(upload_id, 0, content[:10]).status_code, 409)
+        self.assertEqual(self.client.get(reverse('file-upload', kwargs={'upload_id': upload_id})).data['offset'], 60_000)
+        result = self.send_chunk(upload_id, 60_000, content[60_000:])
+        self.assertEqual(result.data['status'], Upload.Status.COMPLETED)
+
+        path = stored_file_path(hashlib.sha256(content).hexdigest(), 'pdf')
+        with default_storage.open(path) as stored:
+            self.assertEqual(stored.read(), content)
+        self.assertEqual(StoredFile.objects.get(sha256=hashlib.sha256(content).hexdigest()).ref_count, 1)
+
+        response = self.submit(upload=upload_id)
+        answer = response.answers.get(question=self.questions[Question.QUESTION_TYPES.FILE])
+        self.assertEqual(answer.value['file_path'], path)
+        self.assertFalse(Upload.objects.filter(pk=upload_id).exists())
+        # the reference of the upload now belongs to the answer
+        self.assertEqual(StoredFile.objects.get(sha256=hashlib.sha256(content).hexdigest()).ref_count, 1)
+        result = self.client.post(reverse('survey-responses-list'), {
+            'survey': self.survey.id, 'answers': [{'question': answer.question_id, 'upload': upload_id}],
+        }, format='json')
+        self.assertEqual(result.status_code, 400)
+
+        ResponseViewSet().perform_destroy(response)
+        drain_file_deletions()
+        self.assertFalse(StoredFile.objects.filter(sha256=hashlib.sha256(content).hexdigest()).exists())
+        self.assertFalse(default_storage.exists(path))
+
+    def test_checksum_mismatch_starts_over(self):
+        upload_id = self.upload(b'abcde', checksum='0' * 64)
+        result = self.send_chunk(upload_id, 0, b'abcde')
+        self.assertEqual((result.status_code, result.data['offset']), (422, 0))
+        self.assertEqual(Upload.objects.get(pk=upload_id).status, Upload.Status.UPLOADING)
+
+    def test_discarded_upload_releases_its_file(self):
+        content = os.urandom(1000)
+        upload_id = self.upload(content)
+        self.send_chunk(upload_id, 0, content)
+        path = stored_file_path(hashlib.sha256(content).hexdigest(), 'pdf')
+        self.assertTrue(default_storage.exists(path))
+
+        self.assertEqual(self.client.delete(reverse('file-upload', kwargs={'upload_id': upload_id})).status_code, 204)
+        drain_file_deletions()
+        self.assertFalse(Upload.objects.filter(pk=upload_id).exists())
+        self.assertFalse(StoredFile.objects.filter(sha256=hashlib.sha256(content).hexdigest()).exists())
+        self.assertFalse(default_storage.exists(path))
+
+
+    def test_question_deleted_with_its_uploads(self):
+        content = os.urandom(1000)
+        completed, uploading = self.upload(content), self.upload(content[:500])
+        self.send_chunk(completed, 0, content)
+        self.send_chunk(uploading, 0, content[:100])
+        partial = partial_path(Upload.objects.get(pk=uploading))
+        self.assertTrue(os.path.exists(partial))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.questions[Question.QUESTION_TYPES.FILE].delete()
+        drain_file_deletions()
+        self.assertFalse(Upload.objects.filter(pk__in=[completed, uploading]).exists())
+        self.assertFalse(StoredFile.objects.filter(sha256=hashlib.sha256(content).hexdigest()).exists())
+        self.assertFalse(default_storage.exists(stored_file_path(hashlib.sha256(content).hexdigest(), 'pdf')))
+        self.assertFalse(os.path.exists(partial))
+
+class StoredFileTests(SurveyTestCase):
+    """Reference counts of the files stored once by content"""
+
+    def stored(self, content):
+        return StoredFile.objects.filter(sha256=hashlib.sha256(content).hexdigest()).first()
+
+    def test_identical_files_are_shared(self):
+        content = os.urandom(1000)
+        with self.captureOnCommitCallbacks(execute=True):
+            path = store_file(ContentFile(content, name='first.pdf'))
+            self.assertEqual(store_file(ContentFile(content, name='second.PDF')), path)
+        self.assertEqual(self.stored(content).ref_count, 2)
+        self.assertEqual(os.listdir(os.path.dirname(default_storage.path(path))), [os.path.basename(path)])
+
+        release_files([path])
+        drain_file_deletions()
+        self.assertEqual(self.stored(content).ref_count, 1)
+        self.assertTrue(default_storage.exists(path))
+        release_files([path])
+        drain_file_deletions()
+        self.assertIsNone(self.stored(content))
+        self.assertFalse(default_storage.exists(path))
+
+    def test_answer_files_are_referenced(self):
+        content = os.urandom(1000)
+        file_data = f"data:application/pdf;base64,{base64.b64encode(content).decode()}"
+        responses = [self.submit(file_data=file_data) for _ in range(2)]
+        self.assertEqual(self.stored(content).ref_count, 2)
+        ResponseViewSet().perform_destroy(responses[0])
+        drain_file_deletions()
+        self.assertEqual(self.stored(content).ref_count, 1)
+
+    def test_rolled_back_file_is_not_written(self):
+        content = os.urandom(1000)
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    path = store_file(ContentFile(content, name='file.pdf'))
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertIsNone(self.stored(content))
+        self.assertFalse(default_storage.exists(path))
+
+    def test_file_stored_again_before_its_deletion(self):
+        content = os.urandom(1000)
+        with self.captureOnCommitCallbacks(execute=True):
+            path = store_file(ContentFile(content, name='file.pdf'))
+        release_files([path])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(store_file(ContentFile(content, name='file.pdf')), path)
+        drain_file_deletions()
+        self.assertEqual(self.stored(content).ref_count, 1)
+        self.assertTrue(default_storage.exists(path))
+
+    def test_synthetic_file_answers_are_referenced(self):
+        paths = Answer.objects.filter(
+            response__survey=self.survey, question__question_type=Question.QUESTION_TYPES.FILE
+        ).values_list('value__file_path', flat=True)
+        expected = {}
+        for path in paths:
+            expected[path] = expected.get(path, 0) + 1
+        for path, count in expected.items():
+            stored = StoredFile.objects.get(sha256=os.path.basename(path).split('.')[0])
+            self.assertEqual(stored.ref_count, count)
+            self.assertTrue(default_storage.exists(path))
+
+
+class ExportJobTests(SurveyTestCase):
+    """Exports of older data versions are deleted once a newer one is generated"""
+
+    def job(self, data_version, export_format=ExportJob.Format.CSV, options=None, status=ExportJob.Status.COMPLETED):
+        options = {'include_stats': False} if options is None else options
+        job = ExportJob(
+            survey=self.survey,
+            format=export_format,
+            options=options,
+            data_version=data_version,
+            fingerprint=export_fingerprint(self.survey.id, export_format, options, data_version),
+            status=status,
+        )
+        job.artifact_path = export_artifact_path(job)
+        job.save()
+        if status == ExportJob.Status.COMPLETED:
+            default_storage.save(job.artifact_path, ContentFile(b'export'))
+        return job
+
+    def test_superseded_jobs_deleted(self):
+        superseded = [self.job(1), self.job(2, status=ExportJob.Status.FAILED)]
+        kept = [
+            self.job(1, export_format=ExportJob.Format.NDJSON),
+            self.job(1, options={'include_stats': True}),
+            self.job(2, status=ExportJob.Status.RUNNING),
+        ]
+        current = self.job(3)
+
+        delete_superseded_jobs(current)
+        self.assertFalse(ExportJob.objects.filter(pk__in=[job.pk for job in superseded]).exists())
+        self.assertFalse(default_storage.exists(superseded[0].artifact_path))
+        self.assertEqual(
+            set(ExportJob.objects.filter(survey=self.survey).values_list('pk', flat=True)),
+            {job.pk for job in [*kept, current]},
+        )
+        self.assertTrue(default_storage.exists(kept[0].artifact_path))
+        self.assertTrue(default_storage.exists(current.artifact_path))
+
+
+class StatisticsCacheTests(SurveyTestCase):
+    """The statistics of a closed survey are computed once per data version and parameters"""
+
+    def setUp(self):
+        super().setUp()
+        Survey.objects.filter(pk=self.survey.pk).update(closes_at=timezone.now() - timedelta(days=1))
+        self.client.force_authenticate(self.survey.creator)
+        compute = mock.patch.object(
+            SurveyViewSet, '_compute_statistics', autospec=True, side_effect=SurveyViewSet._compute_statistics
+        )
+        self.compute = compute.start()
+        self.addCleanup(compute.stop)
+
+    def statistics(self, **params):
+        result = self.client.get(reverse('survey-statistics', kwargs={'pk': self.survey.pk}), params)
+        self.assertEqual(result.status_code, 200, result.data)
+        return result.data
+
+    def test_hits_and_misses(self):
+        first = self.statistics()
+        self.assertEqual(self.statistics(), first)
+        # a filter without its value is not applied, the result is the same
+        self.assertEqual(self.statistics(filter_question=self.questions[Question.QUESTION_TYPES.SINGLE].id), first)
+        self.assertEqual(self.compute.call_count, 1)
+
+        self.statistics(general_correlation='true')
+        self.assertEqual(self.compute.call_count, 2)
+        # another worker finds the result in the shared cache
+        local_cache.clear()
+        self.assertEqual(self.statistics(), first)
+        self.assertEqual(self.compute.call_count, 2)
+
+    def test_invalidated_by_answer_changes(self):
+        rating = self.questions[Question.QUESTION_TYPES.RATING]
+        total_ratings = {stats['id']: stats for stats in self.statistics()['questions']}[rating.id]['total_ratings']
+        ResponseAnswerViewSet().perform_destroy(Answer.objects.filter(question=rating).first())
+        stats = {stats['id']: stats for stats in self.statistics()['questions']}[rating.id]
+        self.assertEqual(stats['total_ratings'], total_ratings - 1)
+        self.assertEqual(self.compute.call_count, 2)
+
+    def test_invalidated_by_respondent_group_changes(self):
+        grouped = self.statistics(group_by='respondent__gender')
+        respondent = self.survey.responses.exclude(respondent=None).first().respondent
+        respondent.last_login = timezone.now()
+        respondent.save(update_fields=['last_login'])
+        self.assertEqual(self.statistics(group_by='respondent__gender'), grouped)
+        self.assertEqual(self.compute.call_count, 1)
+
+        respondent.gender = User.Gender.FEMALE if respondent.gender == User.Gender.MALE else User.Gender.MALE
+        respondent.save()
+        self.statistics(group_by='respondent__gender')
+        self.assertEqual(self.compute.call_count, 2)
+
+    def test_age_groups_keyed_by_day(self):
+        tomorrow = timezone.now() + timedelta(days=1)
+        for group_by, expected_equal in [('respondent__date_of_birth', False), ('respondent__gender', True)]:
+            with self.subTest(group_by=group_by):
+                params = normalize_statistics_params(QueryDict(f'group_by={group_by}'))
+                key = statistics_cache_key(self.survey, params)
+                with mock.patch('Survey.cache.timezone.now', return_value=tomorrow):
+                    self.assertEqual(statistics_cache_key(self.survey, params) == key, expected_equal)
+
+
+class PurgeSurveysTests(SurveyTestCase):
+    """Surveys closed for long enough are archived and deleted by batches of responses"""
+
+    def setUp(self):
+        super().setUp()
+        Survey.objects.filter(pk=self.survey.pk).update(closes_at=timezone.now() - timedelta(days=10))
+
+    def purge(self, *args):
+        stdout = io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('purge_surveys', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_dry_run(self):
+        output = self.purge('--days', '5', '--dry-run')
+        self.assertIn(f"Survey {self.survey.id} ", output)
+        self.assertIn('20 responses', output)
+        self.assertEqual(self.survey.responses.count(), 20)
+
+    def test_recent_surveys_kept(self):
+        self.purge('--days', '30')
+        self.assertTrue(Survey.objects.filter(pk=self.survey.pk).exists())
+        self.assertEqual(self.survey.responses.count(), 20)
+
+    def test_archived_then_deleted(self):
+        file_paths = set(Answer.objects.filter(
+            response__survey=self.survey, question__question_type=Question.QUESTION_TYPES.FILE
+        ).values_list('value__file_path', flat=True))
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_dir, ignore_errors=True)
+        output = self.purge('--days', '5', '--archive-dir', archive_dir, '--batch-size', '7')
+        self.assertIn(f"Survey {self.survey.id}: deleted 14 responses", output)
+
+        with gzip.open(os.path.join(archive_dir, f"survey-{self.survey.id}.ndjson.gz"), 'rt') as archive:
+            header, *responses = [json.loads(line) for line in archive]
+        self.assertEqual(header['survey']['id'], self.survey.id)
+        self.assertEqual(len(header['questions']), sum(QUESTION_COUNTS.values()))
+        self.assertEqual(len(responses), 20)
+
+        self.assertFalse(Survey.objects.filter(pk=self.survey.pk).exists())
+        self.assertFalse(Response.objects.filter(survey_id=self.survey.pk).exists())
+        drain_file_deletions()
+        for path in file_paths:
+            self.assertFalse(default_storage.exists(path))
+
+    def test_invalid_options(self):
+        with self.assertRaises(CommandError):
+            call_command('purge_surveys', '--days', '5', '--batch-size', '0')
+
+
+
+class ResponseListingTests(SurveyTestCase):
+    """The responses of a survey are listed newest first, a page at a time from a cursor"""
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.survey.creator)
+        self.url = reverse('survey-mng-responses', kwargs={'survey_id': self.survey.id})
+
+    def read_pages(self, url, link='next'):
+        pages = []
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                result = self.client.get(url)
+            self.assertEqual(result.status_code, 200, result.data)
+            pages.append((result.data['results'], len(queries)))
+            url = result.data[link]
+        return pages
+
+    def test_pages(self):
+        # responses submitted at the same time are ordered by id
+        Response.objects.filter(pk__in=self.survey.responses.order_by('id').values('pk')[:10]).update(
+            submitted_at=timezone.now() - timedelta(days=30)
+        )
+        expected = list(self.survey.responses.order_by('-submitted_at', '-id').values_list('id', flat=True))
+        pages = self.read_pages(f"{self.url}?page_size=6")
+        self.assertEqual([response['response_id'] for page, _ in pages for response in page], expected)
+        self.assertEqual([len(page) for page, _ in pages], [6, 6, 6, 2])
+        # every page costs the same whatever its depth
+        self.assertEqual(len({query_count for _, query_count in pages}), 1)
+        answer_counts = dict(Answer.objects.filter(response__survey=self.survey).values_list('response').annotate(Count('id')))
+        for page, _ in pages:
+            for response in page:
+                self.assertEqual(response['answer_count'], answer_counts.get(response['response_id'], 0))
+
+        last = self.client.get(f"{self.url}?page_size=6")
+        while last.data['next']:
+            last = self.client.get(last.data['next'])
+        backwards = self.read_pages(last.data['previous'], link='previous')
+        self.assertEqual([response['response_id'] for page, _ in backwards[::-1] for response in page], expected[:18])
+
+    def test_responses_submitted_while_paginating(self):
+        expected = list(self.survey.responses.order_by('-submitted_at', '-id').values_list('id', flat=True))
+        first = self.client.get(self.url, {'page_size': 10})
+        self.submit()
+        second = self.client.get(first.data['next'])
+        self.assertEqual(
+            [response['response_id'] for response in first.data['results'] + second.data['results']], expected
+        )
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(self.url, {'cursor': 'garbage'}).status_code, 404)
+
+class SurveyListingTests(SurveyTestCase):
+    """Survey listings are read a page at a time from a cursor, with the selected fields"""
+
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            list(generate_dataset(self.seed + 1, surveys=6, responses=0, respondents=1, closed=False))
+        # surveys of the same title created at the same time only differ by their id
+        Survey.objects.update(title='Same title', created_at=timezone.now())
+        self.survey_ids = sorted(Survey.objects.filter(is_active=True).values_list('id', flat=True))
+
+    def read_pages(self, url, link='next'):
+        pages = []
+        while url:
+            result = self.client.get(url)
+            self.assertEqual(result.status_code, 200, result.data)
+            pages.append([survey['id'] for survey in result.data['results']])
+            url = result.data[link]
+        return pages
+
+    def test_pages_of_equal_surveys(self):
+        for ordering, expected in [('title', self.survey_ids), ('-created_at', self.survey_ids[::-1])]:
+            with self.subTest(ordering=ordering):
+                first_url = f"{reverse('survey-list')}?ordering={ordering}&page_size=2"
+                pages = self.read_pages(first_url)
+                self.assertEqual([survey_id for page in pages for survey_id in page], expected)
+                self.assertTrue(all(len(page) == 2 for page in pages[:-1]))
+
+                # and back from the last page
+                last = self.client.get(first_url)
+                while last.data['next']:
+                    last = self.client.get(last.data['next'])
+                backwards = self.read_pages(last.data['previous'], link='previous')
+                self.assertEqual(backwards[::-1] + [pages[-1]], pages)
+
+    def test_sparse_fields(self):
+        result = self.client.get(reverse('survey-list'), {'fields': 'id,title', 'page_size': 1})
+        self.assertEqual(set(result.data['results'][0]), {'id', 'title'})
+        # the questions are only included when expanded
+        result = self.client.get(reverse('survey-list'), {'fields': 'id,questions', 'page_size': 1})
+        self.assertEqual(set(result.data['results'][0]), {'id'})
+        result = self.client.get(reverse('survey-list'), {'fields': 'id,questions', 'expand': 'questions', 'page_size': 1})
+        self.assertEqual(set(result.data['results'][0]), {'id', 'questions'})
+
+    def test_invalid_cursors(self):
+        next_url = self.client.get(reverse('survey-list'), {'ordering': 'title', 'page_size': 2}).data['next']
+        cursor = next_url.split('cursor=')[1].split('&')[0]
+        self.assertEqual(self.client.get(reverse('survey-list'), {'cursor': 'garbage'}).status_code, 404)
+        # a cursor is only valid for the ordering it was read with
+        self.assertEqual(self.client.get(reverse('survey-list'), {'cursor': cursor, 'ordering': 'closes_at'}).status_code, 404)
+
+
+class PDFExportTests(SurveyTestCase):
+    """The streamed PDF exports, rendered by this process or by a pool of worker processes"""
+
+    def setUp(self):
+        super().setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            # a few pages of responses
+            self.survey, = generate_dataset(
+                self.seed + 1, responses=100, respondents=3, question_counts=QUESTION_COUNTS, closed=False
+            )
+        self.addCleanup(lambda: exports._pool is not None and exports._discard_pool(exports._pool))
+
+    def read_pdf(self, pdf):
+        """Texts drawn on every page of the PDF, checking that its cross-reference table points to its objects"""
+        xref = pdf[int(pdf.rsplit(b'startxref\n', 1)[1].split()[0]):]
+        offsets = [int(entry.split()[0]) for entry in xref.split(b'\n')[3:] if entry.endswith(b' n ')]
+        for object_id, offset in enumerate(offsets, start=1):
+            self.assertTrue(pdf[offset:].startswith(b'%d 0 obj' % object_id))
+        pages = []
+        for match in re.finditer(rb'/Length (\d+) /Filter /FlateDecode >>\nstream\n', pdf):
+            content = zlib.decompress(pdf[match.end():match.end() + int(match.group(1))])
+            pages.append([text.decode('cp1252') for text in re.findall(rb'\((.*?)\) Tj', content)])
+        return pages
+
+    def test_parallel_rendering_matches_serial(self):
+        serial = b''.join(stream_responses_pdf(self.survey, include_stats=True))
+        with mock.patch('Survey.exports.PARALLEL_PAGES_PER_TASK', 1):
+            parallel = b''.join(stream_responses_pdf(self.survey, include_stats=True, processes=2))
+            pool = exports._pool
+            self.assertEqual(b''.join(stream_responses_pdf(self.survey, include_stats=True, processes=2)), serial)
+        self.assertEqual(parallel, serial)
+        self.assertIn(b'/Count 4', serial)
+        # the pool of worker processes is shared by the exports
+        self.assertIs(exports._pool, pool)
+
+    def test_responses_of_the_page_count(self):
+        expected = b''.join(stream_responses_pdf(self.survey))
+        for processes in [1, 2]:
+            with self.subTest(processes=processes):
+                pages = stream_responses_pdf(self.survey, processes=processes)
+                started = next(pages)
+                # submitted once the pages are counted
+                response = self.submit()
+                self.assertEqual(started + b''.join(pages), expected)
+                ResponseViewSet().perform_destroy(response)
+
+    def test_streamed_pages(self):
+        pdf = b''.join(stream_responses_pdf(self.survey, include_stats=True, chunk_size=7))
+        self.assertTrue(pdf.startswith(b'%PDF-1.4') and pdf.endswith(b'%%EOF\n'))
+        pages = self.read_pdf(pdf)
+        self.assertEqual(len(pages), -(-100 // ROWS_PER_PAGE))
+        self.assertIn('Total Responses: 100', pages[0][1])
+        response_ids = [str(response_id) for response_id in self.survey.responses.order_by('id').values_list('id', flat=True)]
+        exported_ids = []
+        for number, texts in enumerate(pages, start=1):
+            self.assertEqual(texts[-1], f"Page {number} of {len(pages)}")
+            # the first cell of every row after the headers is the response id
+            cells = texts[texts.index(self.survey.questions.order_by('order').last().question_text) + 1:-1]
+            row_size = 3 + self.survey.questions.count()
+            exported_ids.extend(cells[::row_size])
+        self.assertEqual(exported_ids, response_ids)
+
+    def test_streamed_export_view(self):
+        self.client.force_authenticate(self.survey.creator)
+        result = self.client.get(
+            reverse('survey-responses-export', kwargs={'survey_id': self.survey.id}), {'mode': 'stream'}
+        )
+        self.assertEqual((result.status_code, result['Content-Type']), (200, 'application/pdf'))
+        self.assertEqual(b''.join(result.streaming_content), b''.join(stream_responses_pdf(self.survey)))
+
+
+
+class FlatExportTests(SurveyTestCase):
+    """CSV and NDJSON exports stream one row per response with one column per question"""
+
+    def setUp(self):
+        super().setUp()
+        response = self.submit()
+        Answer.objects.filter(response=response, question=self.questions[Question.QUESTION_TYPES.TEXT]).update(
+            value='Commas, "quotes"\nand lines'
+        )
+        self.client.force_authenticate(self.survey.creator)
+        self.responses = list(self.survey.responses.order_by('id').select_related('respondent'))
+        self.question_list = list(self.survey.questions.all())
+        self.values = {
+            (answer.response_id, answer.question_id): answer.value
+            for answer in Answer.objects.filter(response__survey=self.survey)
+        }
+
+    def export(self, export_format):
+        result = self.client.get(
+            reverse('survey-responses-export', kwargs={'survey_id': self.survey.id}), {'format': export_format}
+        )
+        self.assertEqual(result.status_code, 200)
+        return result, b''.join(result.streaming_content)
+
+    def test_csv(self):
+        result, content = self.export('csv')
+        self.assertEqual(result['Content-Type'], 'text/csv; charset=utf-8')
+        header, *rows = list(csv.reader(io.StringIO(content.decode())))
+        self.assertEqual(header[4:], [question.question_text for question in self.question_list])
+        self.assertEqual(len(rows), len(self.responses))
+        for row, response in zip(rows, self.responses):
+            self.assertEqual(row[:4], [
+                str(response.id), response.submitted_at.isoformat(),
+                str(response.completion_time.total_seconds()) if response.completion_time is not None else '',
+                response.respondent.email if response.respondent else '',
+            ])
+            self.assertEqual(row[4:], [
+                answer_display_value(self.values.get((response.id, question.id))) for question in self.question_list
+            ])
+        # the chunks read do not change the export
+        self.assertEqual(b''.join(stream_responses_csv(self.survey, chunk_size=3)), content)
+
+    def test_ndjson(self):
+        result, content = self.export('ndjson')
+        self.assertEqual(result['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual([line['response_id'] for line in lines], [response.id for response in self.responses])
+        for line, response in zip(lines, self.responses):
+            self.assertEqual(line['respondent'], response.respondent.email if response.respondent else None)
+            self.assertEqual(line['answers'], {
+                str(question.id): self.values.get((response.id, question.id)) for question in self.question_list
+            })
+        self.assertEqual(b''.join(stream_responses_ndjson(self.survey, chunk_size=3)), content)
+
+class LiveStatisticsAuthenticationTests(SurveyTestCase):
+    """The live statistics stream is opened with a short-lived token of the survey, never with the API token"""
+
+    def setUp(self):
+        super().setUp()
+        self.creator_client = APIClient()
+        self.creator_client.force_authenticate(self.survey.creator)
+
+    def open_stream(self, token=None, authorization=None):
+        headers = {'HTTP_AUTHORIZATION': authorization} if authorization else {}
+        result = Client().get(
+            reverse('survey-live-statistics', kwargs={'survey_id': self.survey.id}),
+            {'token': token} if token else {}, **headers
+        )
+        # the events are not read
+        result.close()
+        return result.status_code
+
+    def live_token(self, survey_id=None):
+        result = self.creator_client.post(reverse('survey-live-token', kwargs={'pk': survey_id or self.survey.id}))
+        self.assertEqual(result.status_code, 200, result.data)
+        return result.data['token']
+
+    def test_live_token(self):
+        self.assertEqual(self.open_stream(token=self.live_token()), 200)
+        # only the creator gets tokens
+        self.assertEqual(self.client.post(reverse('survey-live-token', kwargs={'pk': self.survey.id})).status_code, 404)
+
+    def test_rejected_tokens(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            other, = generate_dataset(self.seed + 1, responses=0, respondents=1, creator=self.survey.creator, closed=False)
+        self.assertEqual(self.open_stream(token=self.live_token(other.id)), 401)
+        self.assertEqual(self.open_stream(token='garbage'), 401)
+        token = self.live_token()
+        with mock.patch('Survey.live.LIVE_STATISTICS_TOKEN_MAX_AGE', -1):
+            self.assertEqual(self.open_stream(token=token), 401)
+
+    def test_api_token(self):
+        api_token = Token.objects.create(user=self.survey.creator).key
+        self.assertEqual(self.open_stream(token=api_token), 401)
+        self.assertEqual(self.open_stream(authorization=f'Token {api_token}'), 200)
+
+
+class LiveStatisticsEventsTests(SurveyTestCase):
+    """The live statistics of a survey are pushed as events when its data changes"""
+
+    @override_settings(SURVEY_LIVE_STATISTICS_INTERVAL=0.01)
+    def test_events(self):
+        rating_ids = set(self.survey.questions.filter(
+            question_type=Question.QUESTION_TYPES.RATING
+        ).values_list('id', flat=True))
+
+        async def read_events():
+            events = live_statistics_events(self.survey.id, keepalive=5)
+            try:
+                self.assertEqual(await anext(events), 'retry: 10\n\n')
+                first = parse_event(await anext(events))
+                await sync_to_async(self.submit)()
+                second = parse_event(await anext(events))
+                await sync_to_async(self.survey.delete)()
+                return first, second, parse_event(await anext(events))
+            finally:
+                await events.aclose()
+
+        def parse_event(text):
+            fields = dict(line.split(': ', 1) for line in text.strip().splitlines())
+            return fields['event'], fields.get('id'), json.loads(fields['data'])
+
+        first, second, deleted = async_to_sync(read_events)()
+        self.assertEqual((first[0], first[2]['total_responses']), ('statistics', 20))
+        self.assertEqual((second[0], second[2]['total_responses']), ('statistics', 21))
+        self.assertGreater(int(second[1]), int(first[1]))
+        # the new response rated every rating question
+        ratings = [
+            {stats['id']: stats['total_ratings'] for stats in event[2]['questions'] if stats['id'] in rating_ids}
+            for event in [first, second]
+        ]
+        self.assertEqual(ratings[1], {question_id: count + 1 for question_id, count in ratings[0].items()})
+        self.assertEqual(deleted[0], 'deleted')
+
+
+class GeneralCorrelationTests(SurveyTestCase):
+    """The correlations of all the question pairs computed at once are those of the answers"""
+
+    def labels_of(self, question, value):
+        if question.question_type == Question.QUESTION_TYPES.RATING:
+            return [] if value is None else [float(value)]
+        if question.question_type == Question.QUESTION_TYPES.SINGLE:
+            return [value['choice']]
+        return value['choices']
+
+    def assertCorrelationsMatchAnswers(self, responses):
+        payload = _calculate_general_correlation(self.survey, responses)
+        questions = {question.id: question for question in self.survey.questions.filter(question_type__in=ACCEPTED_Q_TYPES)}
+        self.assertEqual(set(payload['questions']), {str(question_id) for question_id in questions})
+        answers = {}
+        for response_id, question_id, value in Answer.objects.filter(
+            response__in=responses, question__in=questions
+        ).values_list('response_id', 'question_id', 'value'):
+            answers.setdefault(response_id, {})[question_id] = self.labels_of(questions[question_id], value)
+
+        pairs = rating_pairs = 0
+        for first, second in itertools.combinations(questions.values(), 2):
+            labels = [payload['questions'][str(question.id)]['labels'] for question in (first, second)]
+            counts = [[0] * len(labels[1]) for _ in labels[0]]
+            for response_answers in answers.values():
+                for first_label in response_answers.get(first.id, []):
+                    for second_label in response_answers.get(second.id, []):
+                        counts[labels[0].index(first_label)][labels[1].index(second_label)] += 1
+            pair = payload['pairs'].get(f"{first.id}_{second.id}")
+            if not any(map(any, counts)):
+                self.assertIsNone(pair)
+                continue
+            pairs += 1
+            with self.subTest(pair=(first.question_type, second.question_type)):
+                self.assertEqual(pair['counts'], counts)
+                types = {first.question_type, second.question_type}
+                if Question.QUESTION_TYPES.RATING in types and len(types) == 2:
+                    choice, rating = (first, second) if second.question_type == Question.QUESTION_TYPES.RATING else (second, first)
+                    ratings = {}
+                    for response_answers in answers.values():
+                        for label in response_answers.get(choice.id, []):
+                            ratings.setdefault(label, []).extend(response_answers.get(rating.id, []))
+                    choice_labels = payload['questions'][str(choice.id)]['labels']
+                    expected = [statistics.mean(ratings[label]) if ratings.get(label) else None for label in choice_labels]
+                    for mean, expected_mean in zip(pair['rating_by_choice']['mean'], expected, strict=True):
+                        self.assertEqual(mean is None, expected_mean is None)
+                        if mean is not None:
+                            self.assertAlmostEqual(mean, expected_mean)
+                    rating_pairs += 1
+        self.assertGreater(pairs, 0)
+        self.assertGreater(rating_pairs, 0)
+
+        rating_ids = payload['pearson']['questions']
+        for i, first_id in enumerate(rating_ids):
+            for j, second_id in enumerate(rating_ids):
+                both = [values for values in answers.values() if values.get(first_id) and values.get(second_id)]
+                expected = statistics.correlation([values[first_id][0] for values in both], [values[second_id][0] for values in both])
+                self.assertAlmostEqual(payload['pearson']['matrix'][i][j], expected)
+
+    def test_all_responses(self):
+        # ratings missing from some responses are left out of their pairs only
+        optional_rating = self.survey.questions.filter(question_type=Question.QUESTION_TYPES.RATING, required=False).first()
+        for _ in range(3):
+            self.submit(skip={optional_rating.id})
+        self.assertCorrelationsMatchAnswers(self.survey.responses.all())
+
+    def test_some_responses(self):
+        self.assertCorrelationsMatchAnswers(self.survey.responses.order_by('id')[:12])
+
+
+class LoadTestRecorderTests(SimpleTestCase):
+    """The summary of a load test and its request budget"""
+
+    def test_summary(self):
+        recorder = Recorder()
+        for latency in range(1, 101):
+            recorder.record('retrieve', 200, latency / 1000)
+        recorder.record('submit', 400, 0.5)
+        recorder.record('submit', 'ConnectionRefusedError', 0.1)
+        summary = recorder.summary(elapsed=2)
+        self.assertEqual(list(summary['endpoints']), ['retrieve', 'submit'])
+        retrieve = summary['endpoints']['retrieve']
+        self.assertEqual((retrieve['requests'], retrieve['throughput'], retrieve['errors']), (100, 50, 0))
+        self.assertAlmostEqual(retrieve['latency_ms']['p50'], 50.5)
+        self.assertAlmostEqual(retrieve['latency_ms']['max'], 100)
+        self.assertEqual(summary['endpoints']['submit']['error_rate'], 1)
+        self.assertEqual(summary['total']['statuses'], {'200': 100, '400': 1, 'ConnectionRefusedError': 1})
+        self.assertEqual((summary['total']['requests'], summary['total']['errors']), (102, 2))
+
+    def test_budget(self):
+        budget = Budget(5)
+        self.assertEqual(sum(budget.take() for _ in range(8)), 5)
+        self.assertTrue(all(Budget(None).take() for _ in range(8)))
+
+
+class LoadTestTests(LiveServerTestCase):
+    """
+    The load test run against a live server. The threads of the server share the
+    connection to the in-memory test database, which cannot run concurrent
+    transactions, so a single worker sends the requests.
+    """
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        overridden = override_settings(MEDIA_ROOT=self.media_root, CACHES=LOCAL_CACHES)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        schedule_drain = mock.patch('Survey.deletion.schedule_drain')
+        schedule_drain.start()
+        self.addCleanup(schedule_drain.stop)
+        _validators_cache.clear()
+        local_cache.clear()
+        for alias in LOCAL_CACHES:
+            caches[alias].clear()
+
+    def test_run(self):
+        fixture = create_fixture(seed=3, respondents=1)
+        results = run_load_test(fixture, self.live_server_url, workers=1, duration=60, requests=40, seed=3)
+        self.assertEqual(results['total']['requests'], 40)
+        self.assertEqual(results['total']['errors'], 0, results['endpoints'])
+        submitted = results['endpoints']['submit']['statuses'].get('201', 0)
+        self.assertEqual(fixture.survey.responses.count(), submitted)
+        added = results['endpoints'].get('add_answers', {'requests': 0})['requests']
+        self.assertEqual(Answer.objects.filter(question=fixture.added_question).count(), added)
+
+    def test_command(self):
+        output = os.path.join(self.media_root, 'loadtest.json')
+        stdout = io.StringIO()
+        call_command(
+            'loadtest', url=self.live_server_url, workers=1, requests=20, mix='retrieve=1,submit=1', output=output,
+            stdout=stdout,
+        )
+        with open(output) as output_file:
+            results = json.load(output_file)
+        self.assertEqual(set(results['endpoints']), {'retrieve', 'submit'})
+        self.assertEqual(results['total']['requests'], 20)
+        self.assertEqual(results['total']['errors'], 0, results['endpoints'])
+        self.assertIn('total', stdout.getvalue())
+        # the survey under load is deleted afterwards
+        self.assertFalse(Survey.objects.exists())
+
+        for mix in ('unknown=1', 'submit=x', 'submit=0'):
+            with self.subTest(mix=mix), self.assertRaises(CommandError):
+                call_command('loadtest', url=self.live_server_url, mix=mix)
@@ -0,0 +1,187 @@
+"""
+Chunked, resumable uploads of answer files and question attachments.
+
+An upload is declared with the size, extension and optionally the sha256 of the
+file, which are checked against the limits of the question before any byte is
+sent. Its content is then sent in one or more chunks, each appended at the offset
+received so far: the request body is streamed by blocks to a partial file, the
+declared size is enforced as the bytes arrive, and an interrupted upload resumes
+from what was received. Once complete the file is hashed and stored, and answers
+and questions reference it by id instead of carrying it base64 encoded.
+"""
+import hashlib
+import io
+import os
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import serializers, status
+
+from .config import UPLOAD_READ_SIZE
+from .deletion import release_file, release_files
+from .files import store_file
+from .models import Upload
+
+try:
+    import fcntl
+except ImportError:  # Windows, uploads are only serialized within the process
+    fcntl = None
+
+_process_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    """A chunk that cannot be appended to an upload, with the HTTP status to answer with"""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def partial_path(upload):
+    return os.path.join(settings.UPLOAD_PARTIAL_DIR, f"{upload.pk.hex}.part")
+
+
+@contextmanager
+def _locked(partial):
+    """Hold the partial file of an upload, a chunk being written makes the others fail"""
+    if fcntl is None:
+        with _process_lock:
+            yield
+        return
+    try:
+        fcntl.flock(partial.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        raise UploadError('Another chunk of this upload is being written', status.HTTP_409_CONFLICT)
+    try:
+        yield
+    finally:
+        fcntl.flock(partial.fileno(), fcntl.LOCK_UN)
+
+
+def _check_writable(upload):
+    if upload.status != Upload.Status.UPLOADING:
+        raise UploadError('The upload is already complete', status.HTTP_409_CONFLICT)
+    if upload.expires_at <= timezone.now():
+        raise UploadError('The upload has expired', status.HTTP_410_GONE)
+
+
+def append_chunk(upload, offset, stream):
+    """
+    Append the bytes read from the stream (a request body) to the upload at the offset,
+    which must be the offset received so far, and complete the upload once all its
+    bytes were received. The bytes received before the client went away are kept.
+    """
+    _check_writable(upload)
+    path = partial_path(upload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b') as partial:
+        with _locked(partial):
+            # the upload may have moved on while waiting for the lock
+            upload.refresh_from_db(fields=['offset', 'status'])
+            _check_writable(upload)
+            if offset != upload.offset:
+                raise UploadError(f'The chunk must start at offset {upload.offset}', status.HTTP_409_CONFLICT)
+
+            # drop the bytes of a chunk interrupted before its offset was recorded
+            partial.seek(offset)
+            partial.truncate()
+            received = offset
+            stream = stream or io.BytesIO()
+            try:
+                while block := stream.read(UPLOAD_READ_SIZE):
+                    if received + len(block) > upload.size:
+                        partial.truncate(offset)
+                        raise UploadError(
+                            f'The file is larger than its declared size of {upload.size} bytes',
+                            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+                        )
+                    partial.write(block)
+                    received += len(block)
+            except OSError:
+                # the client went away, what was received is kept to be resumed
+                pass
+            partial.flush()
+            Upload.objects.filter(pk=upload.pk).update(offset=received, updated_at=timezone.now())
+            upload.offset = received
+
+            if received == upload.size:
+                _complete(upload, partial)
+    if upload.status == Upload.Status.COMPLETED:
+        # once the stored file was written from it
+        transaction.on_commit(lambda: os.remove(path))
+    return upload
+
+
+def _complete(upload, partial):
+    """Hash the received file, check it against its declared checksum and store it"""
+    partial.seek(0)
+    digest = hashlib.sha256()
+    while block := partial.read(UPLOAD_READ_SIZE):
+        digest.update(block)
+    if upload.checksum and digest.hexdigest() != upload.checksum:
+        partial.truncate(0)
+        Upload.objects.filter(pk=upload.pk).update(offset=0, updated_at=timezone.now())
+        upload.offset = 0
+        raise UploadError(
+            'The received file does not match its checksum, the upload starts over',
+            status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
+
+    # the upload holds a reference to the stored file until it is attached or discarded,
+    # the file is written from the partial one when both are committed, reopened by its path
+    # if it was closed by then
+    with transaction.atomic():
+        upload.file_path = store_file(
+            File(partial, name=partial_path(upload)), upload.extension, sha256=digest.hexdigest()
+        )
+        upload.sha256 = digest.hexdigest()
+        upload.status = Upload.Status.COMPLETED
+        upload.save(update_fields=['file_path', 'sha256', 'status', 'updated_at'])
+
+
+def discard_upload(upload):
+    """Delete an upload that will not be attached, with its received bytes"""
+    path = partial_path(upload)
+    if os.path.exists(path):
+        os.remove(path)
+    with transaction.atomic():
+        release_file(upload.file_path)
+        upload.delete()
+
+
+def discard_question_uploads(question):
+    """
+    Release the files of the uploads of a question being deleted, whose rows are deleted
+    with it, and remove their received bytes once the deletion is committed
+    """
+    uploads = Upload.objects.filter(question=question)
+    release_files(
+        uploads.filter(status=Upload.Status.COMPLETED).values_list('file_path', flat=True).iterator()
+    )
+    partials = [partial_path(upload) for upload in uploads.filter(status=Upload.Status.UPLOADING).only('pk')]
+
+    def remove_partials():
+        for path in partials:
+            if os.path.exists(path):
+                os.remove(path)
+
+    if partials:
+        transaction.on_commit(remove_partials)
+
+
+def attach_uploads(uploads):
+    """
+    Consume the completed uploads attached to answers or questions: their references to
+    the stored files now belong to them. Fails when one of them was already attached concurrently.
+    """
+    upload_ids = {upload.pk for upload in uploads}
+    if not upload_ids:
+        return
+    deleted, _ = Upload.objects.filter(pk__in=upload_ids, status=Upload.Status.COMPLETED).delete()
+    if deleted != len(upload_ids):
+        raise serializers.ValidationError({'upload': ['An upload can only be attached once']})
@@ -1,7 +1,7 @@
 
 from rest_framework import routers
 from django.urls import path, include
-from .views import SurveyViewSet, QuestionViewSet, ResponseViewSet, ResponseAnswerViewSet, SurveyResponseManagementView
+from .views import SurveyViewSet, QuestionViewSet, ResponseViewSet, ResponseAnswerViewSet, SurveyResponseManagementView, SurveyExportJobView, FileUploadView, survey_live_statistics
 router = routers.DefaultRouter()
 router.register(r'surveys', SurveyViewSet, basename='survey')
 
@@ -27,6 +27,15 @@ urlpatterns = [
     path('surveys/<int:survey_id>/responses/', SurveyResponseManagementView.as_view(), name='survey-mng-responses'),
     path('surveys/<int:survey_id>/responses/<int:response_id>/', SurveyResponseManagementView.as_view(), name='survey-response-detail'),
     path('surveys/<int:survey_id>/responses/export/', SurveyResponseManagementView.as_view(export_pdf=True), name='survey-responses-export'),
+    # Background export jobs
+    path('surveys/<int:survey_id>/exports/', SurveyExportJobView.as_view(), name='survey-export-jobs'),
+    path('surveys/<int:survey_id>/exports/<int:job_id>/', SurveyExportJobView.as_view(), name='survey-export-job'),
+    path('surveys/<int:survey_id>/exports/<int:job_id>/download/', SurveyExportJobView.as_view(download=True), name='survey-export-job-download'),
+    # Chunked, resumable file uploads
+    path('uploads/', FileUploadView.as_view(), name='file-uploads'),
+    path('uploads/<uuid:upload_id>/', FileUploadView.as_view(), name='file-upload'),
+    # Live statistics (server-sent events)
+    path('surveys/<int:survey_id>/live/', survey_live_statistics, name='survey-live-statistics'),
 
     # Survey Question Management URL
     path('surveys/<int:survey_pk>/questions/', QuestionViewSet.as_view({'post': 'create'}), name='survey-question-create'),
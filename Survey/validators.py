@@ -0,0 +1,183 @@
+"""
+Answer validators compiled from the question settings.
+
+The settings of every question of a survey are parsed once into a closure
+checking the value of an answer: choice options become frozensets and bounds,
+limits and steps are read ahead of time. The compiled validators of a survey are
+kept in an in-process LRU keyed by the survey id and its `schema_version`, which
+is bumped whenever one of its questions changes (see signals.py), so submissions
+reuse them until the questions are edited.
+"""
+from django.core.exceptions import ValidationError
+
+from .cache import LRUCache
+from .config import SURVEY_VALIDATORS_CACHE_SIZE
+from .models import Question
+
+_validators_cache = LRUCache(SURVEY_VALIDATORS_CACHE_SIZE)
+
+
+def _number(value):
+    """A numeric setting as a float, None when missing or invalid"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _options(settings):
+    try:
+        return frozenset(settings.get('options') or ())
+    except TypeError:
+        # unhashable options can only be compared one by one
+        return tuple(settings.get('options') or ())
+
+
+def _contains(options, choice):
+    try:
+        return choice in options
+    except TypeError:
+        return False
+
+
+def _text_validator(settings):
+    min_length = settings.get('min_length') or None
+    max_length = settings.get('max_length') or None
+
+    def validate(value):
+        if not isinstance(value, str) or value == '':
+            raise ValidationError("Text question must have a value")
+        if min_length and len(value) < min_length:
+            raise ValidationError(f"Answer must be at least {min_length} characters")
+        if max_length and len(value) > max_length:
+            raise ValidationError(f"Answer cannot exceed {max_length} characters")
+    return validate
+
+
+def _single_choice_validator(settings):
+    options = _options(settings)
+
+    def validate(value):
+        choice = value.get('choice') if isinstance(value, dict) else None
+        if not choice or not isinstance(choice, str):
+            raise ValidationError("Single choice question can only have one selected option")
+        if not _contains(options, choice):
+            raise ValidationError(f'the choice ({choice}) is not a valid choice for this question')
+    return validate
+
+
+def _multiple_choice_validator(settings):
+    min_selections = settings.get('min_selections') or None
+    max_selections = settings.get('max_selections') or None
+    # flexible questions accept choices that are not options
+    options = _options(settings) if settings.get('flexable') == False else None
+
+    def validate(value):
+        choices = value.get('choices') if isinstance(value, dict) else None
+        if not choices:
+            raise ValidationError("Muliple choice questions must have `choices` in `value` and have at least one selected option")
+        if not isinstance(choices, list):
+            raise ValidationError("the `choices` in `value` must be a list")
+        if min_selections and len(choices) < min_selections:
+            raise ValidationError(f"Choice questions must have at least {min_selections} selected options")
+        if max_selections and len(choices) > max_selections:
+            raise ValidationError(f"Choice questions must have at most {max_selections} selected options")
+        if options is not None:
+            for choice in choices:
+                if not _contains(options, choice):
+                    raise ValidationError(f'the choice `{choice}` is not a valid choice for this question')
+    return validate
+
+
+def _rating_validator(settings):
+    min_value = _number(settings.get('min_value'))
+    max_value = _number(settings.get('max_value'))
+    step = _number(settings.get('step'))
+    step_origin = min_value if min_value is not None else 0.0
+
+    def validate(value):
+        if not isinstance(value, float):
+            raise ValidationError("Rating question must have an float value")
+        if (min_value is not None and value < min_value) or (max_value is not None and value > max_value):
+            raise ValidationError("Rating question must have an float value between min value and max value")
+        if step and (value - step_origin) % step != 0:
+            raise ValidationError(f"Rating question must have an float value with the correct step {settings.get('step')}")
+    return validate
+
+
+def _file_validator(settings):
+    def validate(value):
+        # the value of a file answer is the name of the uploaded file, the upload is checked on its own
+        if value == '':
+            raise ValidationError("Text question must have a value")
+    return validate
+
+
+_VALIDATOR_FACTORIES = {
+    Question.QUESTION_TYPES.TEXT: _text_validator,
+    Question.QUESTION_TYPES.SINGLE: _single_choice_validator,
+    Question.QUESTION_TYPES.MULTIPLE: _multiple_choice_validator,
+    Question.QUESTION_TYPES.RATING: _rating_validator,
+    Question.QUESTION_TYPES.FILE: _file_validator,
+}
+
+
+def compile_answer_validator(question):
+    """Callable raising a ValidationError when a value is not a valid answer to the question"""
+    factory = _VALIDATOR_FACTORIES.get(question.question_type)
+    if factory is None:
+        return lambda value: None
+    return factory(question.settings or {})
+
+
+class UploadRules:
+    """Allowed extensions and maximum size (in MB) of the files answering a question"""
+
+    def __init__(self, settings):
+        self.allowed_extensions = list(settings.get('allowed_extensions', ['pdf', 'doc', 'docx']))
+        self.extensions = frozenset(self.allowed_extensions)
+        self.max_size = settings.get('max_file_size', 5)
+
+    def validate(self, extension, size=None):
+        if extension.lower() not in self.extensions:
+            raise ValidationError(f"File type not allowed. Allowed types: {', '.join(self.allowed_extensions)}")
+        if size is not None and size > self.max_size:
+            raise ValidationError(f"File size too large. Maximum size: {self.max_size}MB")
+
+
+class SurveyValidators:
+    """The compiled answer validators of the questions of a survey, by question id"""
+
+    def __init__(self, questions):
+        self.validators = {}
+        self.upload_rules = {}
+        for question in questions:
+            self.validators[question.id] = compile_answer_validator(question)
+            if question.question_type == Question.QUESTION_TYPES.FILE:
+                self.upload_rules[question.id] = UploadRules(question.settings or {})
+
+    def validate(self, question, value):
+        validator = self.validators.get(question.id)
+        if validator is None:
+            # a question newer than the compiled set
+            validator = compile_answer_validator(question)
+        validator(value)
+
+    def validate_upload(self, question, extension, size=None):
+        rules = self.upload_rules.get(question.id) or UploadRules(question.settings or {})
+        rules.validate(extension, size)
+
+
+def get_survey_validators(survey, questions=None):
+    """
+    The compiled validators of the survey for its current schema version, compiled
+    from `questions` (all the questions of the survey, read when not given) on a miss.
+    """
+    key = (survey.pk, survey.schema_version)
+    validators = _validators_cache.get(key)
+    if validators is None:
+        if questions is None:
+            questions = survey.questions.all()
+        validators = SurveyValidators(questions)
+        _validators_cache.set(key, validators)
+    return validators
@@ -1,27 +1,51 @@
 from rest_framework import serializers
-from .models import Survey, Question, Response, Answer
+from .models import Survey, Question, Response, Answer, ExportJob, Upload
 from django.core.files.storage import default_storage
 from django.conf import settings as project_settings
-from .config import ANSWER_FILE_PATH_KEY, QUESTION_ATTACHEMENT_FILE_PATH_KEY
+from django.contrib.auth import get_user_model
+from .config import ANSWER_FILE_PATH_KEY, QUESTION_ATTACHEMENT_FILE_PATH_KEY, LIVE_STATISTICS_KEEPALIVE_SECONDS, LIVE_STATISTICS_TOKEN_MAX_AGE, RESPONSE_BATCH_MAX_SIZE, RESPONSE_BATCH_CHUNK_SIZE
 
 from rest_framework import viewsets, status, permissions
 from rest_framework.decorators import action
 from rest_framework.response import Response as DRFResponse
-from django.db.models import Count, Avg, Max, Min, StdDev, FloatField, Case, When, Value, F, Q
-from django.db.models.functions import Cast, TruncDay, TruncWeek, TruncMonth, TruncQuarter
-from django.db import models
+from django.db.models import Count, Avg, Max, Min, StdDev, FloatField, Case, When, Value, F, Q, OuterRef, Subquery
+from django.db.models.functions import Cast, Coalesce, TruncDay, TruncWeek, TruncMonth, TruncQuarter
+from django.db import models, transaction, DatabaseError
+from django.core.exceptions import FieldError, ValidationError as DjangoValidationError
 from django.utils import timezone
 import numpy as np
 from datetime import datetime, timedelta
-from .services import _calculate_general_correlation
-from .permissions import IsVerified, SurveyAccessPermission, QuestionAccessPermission, ResponseAccessPermission, ResponseAnswerAccessPermission
+from .services import _calculate_general_correlation, _calculate_question_statistics, _calculate_matrix_question_statistics, _calculate_rollup_question_statistics, _answer_values, _filter_responses, _filter_expression_responses, ACCEPTED_Q_TYPES
+from .rollups import RollupDelta
+from .facts import add_answer_facts
+from .validators import get_survey_validators
+from .loaders import get_survey_loader
+from .uploads import UploadError, append_chunk, attach_uploads, discard_upload
+from .files import store_file
+from .deletion import release_file, delete_answers, delete_responses
+from .definitions import get_survey_definition, definition_survey, definition_response
+from .matrix import get_answer_matrix
+from .bitmaps import FilterExpressionError, expression_question_ids, get_bitmap_index
+from .cache import normalize_statistics_params, get_or_compute_statistics
+from .live import live_statistics_events, live_statistics_token, live_statistics_token_user_id
+from .exports import stream_responses_pdf, normalize_export_options, EXPORT_RENDERERS
+from .jobs import submit_export_job
+from .permissions import IsVerified, SurveyAccessPermission, QuestionAccessPermission, ResponseAccessPermission, ResponseAnswerAccessPermission, can_respond
 from rest_framework.permissions import IsAdminUser
 from django_filters.rest_framework import DjangoFilterBackend
 from django_filters import rest_framework as filters
 from rest_framework.filters import OrderingFilter
 
 from rest_framework.views import APIView
-from django.http import HttpResponse
+from rest_framework.settings import api_settings
+from .renderers import PDFRenderer, CSVRenderer, NDJSONRenderer
+from .pagination import ResponseKeysetPagination, SurveyCursorPagination
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse, FileResponse
+from django.urls import reverse
+import gzip
+from asgiref.sync import sync_to_async
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed, PermissionDenied
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter, landscape
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
@@ -176,14 +200,45 @@ class SurveyFilter(filters.FilterSet):
             ).filter(response_count__gte=value)
         return queryset
 
+class PrefetchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Primary key related field resolving the instances prefetched by a parent serializer
+    or the view in `context[context_key]`, by primary key, without a query, and the
+    others from the database.
+    """
+
+    def __init__(self, context_key, **kwargs):
+        self.context_key = context_key
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if isinstance(data, self.queryset.model):
+            # validated data validated again (nested serializers)
+            return data
+        instances = self.context.get(self.context_key)
+        if instances is not None and not isinstance(data, bool):
+            try:
+                instance = instances.get(self.queryset.model._meta.pk.to_python(data))
+            except (TypeError, ValueError, DjangoValidationError):
+                instance = None
+            if instance is not None:
+                return instance
+        return super().to_internal_value(data)
+
+
 class QuestionSerializer(serializers.ModelSerializer):
     file_data = serializers.CharField(write_only=True, required=False, allow_null=True)
     url = serializers.URLField(write_only=True, required=False, allow_null=True)
     file = serializers.FileField(write_only=True, required=False, allow_null=True)
+    # a completed attachment upload, replacing `file_data`
+    upload = PrefetchedPrimaryKeyRelatedField(
+        context_key='uploads', queryset=Upload.objects.all(), pk_field=serializers.UUIDField(),
+        write_only=True, required=False, allow_null=True
+    )
 
     class Meta:
         model = Question
-        fields = ['id', 'question_text', 'question_type', 'required', 'order', 'settings','file_data', 'url','file']
+        fields = ['id', 'question_text', 'question_type', 'required', 'order', 'settings','file_data', 'url','file', 'upload']
 
     def validate(self, data):
         if self.context.get('validated') is True:
@@ -248,6 +303,13 @@ class QuestionSerializer(serializers.ModelSerializer):
                 # self.context['file'] = ContentFile(file_data, filename)
             except Exception as e:
                 raise serializers.ValidationError({'file_data':str(e)})
+        upload = data.get('upload')
+        if upload is not None:
+            request = self.context.get('request')
+            if (upload.purpose != Upload.Purpose.ATTACHMENT or upload.status != Upload.Status.COMPLETED
+                    or request is None or upload.uploaded_by_id != request.user.id):
+                raise serializers.ValidationError({'upload': 'Not a completed attachment upload of yours'})
+            settings.update({'attachment_file_size': upload.size_mb})
         # elif question.question_type == 'file' and (file_data is None or file_data == ''):
         #     print(file_data)
         #     raise serializers.ValidationError({"file_data":"File question must have a file"})
@@ -258,34 +320,49 @@ class QuestionSerializer(serializers.ModelSerializer):
         # pop file before creating
         file_data = validated_data.pop('file', None)
         url = validated_data.pop('url', None)
+        upload = validated_data.pop('upload', None)
         # print(file_data)
         question = Question(**validated_data)
         question.clean()
                 
-        if file_data:
-            file_path = answer_file_upload_path(question, file_data.name, 'questions')
-            default_storage.save(file_path, file_data)
-            validated_data.get('settings').update({'attachment_file_path':file_path})
+        if upload is not None:
+            question.settings.update({QUESTION_ATTACHEMENT_FILE_PATH_KEY: upload.file_path})
 
         if url:
             validated_data.get('settings').update({'attachment_url': url})
-        question.save()
+        with transaction.atomic():
+            if file_data:
+                question.settings.update({QUESTION_ATTACHEMENT_FILE_PATH_KEY: store_file(file_data)})
+            question.save()
+            if upload is not None:
+                attach_uploads([upload])
         # answer = Answer.objects.create(**validated_data) # question, value
 
 
         return question
+    @transaction.atomic
     def update(self, instance, validated_data):
-        if validated_data.get('file'):
-            file_path = answer_file_upload_path(instance, validated_data.get('file').name, 'questions')
-            default_storage.delete(instance.settings.get(QUESTION_ATTACHEMENT_FILE_PATH_KEY))
-            default_storage.save(file_path, validated_data.get('file'))
-            validated_data.get('settings').update({QUESTION_ATTACHEMENT_FILE_PATH_KEY:file_path})
+        previous_path = instance.settings.get(QUESTION_ATTACHEMENT_FILE_PATH_KEY)
+        file_data = validated_data.pop('file', None)
+        upload = validated_data.pop('upload', None)
+        if file_data:
+            validated_data.setdefault('settings', dict(instance.settings)).update(
+                {QUESTION_ATTACHEMENT_FILE_PATH_KEY: store_file(file_data)}
+            )
+        elif upload is not None:
+            validated_data.setdefault('settings', dict(instance.settings)).update(
+                {QUESTION_ATTACHEMENT_FILE_PATH_KEY: upload.file_path}
+            )
+            attach_uploads([upload])
 
         url = validated_data.pop('url', None)
         if url:
             validated_data.get('settings').update({'attachment_url': url})
 
-        return super().update(instance, validated_data)
+        instance = super().update(instance, validated_data)
+        if (file_data or upload is not None) and previous_path:
+            release_file(previous_path)
+        return instance
 
 
 # class AnswerSerializer(serializers.ModelSerializer):
@@ -298,38 +375,21 @@ import uuid
 from django.core.files.base import ContentFile
 import os
 
-def answer_file_upload_path(instance, filename, prefix):
-    """
-    Generate file path: answers/survey_id/response_id/question_id/filename for answers
-    else: questions/survey_id/question_{id}.ext for 
-    This creates organized file storage structure
-    """
-    ext = filename.split('.')[-1]
-    if isinstance(instance,Question):
-        new_filename = f"question_{instance.id}.{ext}" if getattr(instance,'id') is not None else f"question_{filename}"
-        return os.path.join(
-            prefix,
-            str(instance.survey.id),
-            new_filename
-        )
-    new_filename = f"{instance.question.id}_{instance.response.id}.{ext}"
-    return os.path.join(
-        prefix,
-        # 'surveys',
-        str(instance.question.survey.id),
-        str(instance.response.id),
-        str(instance.question.id),
-        new_filename
-    )
 class AnswerSerializer(serializers.ModelSerializer):
     # question = serializers.PrimaryKeyRelatedField(queryset=Question.objects.all())
+    question = PrefetchedPrimaryKeyRelatedField(context_key='questions', queryset=Question.objects.all())
     id = serializers.IntegerField(read_only=True)
     file_data = serializers.CharField(write_only=True, required=False)
     file = serializers.FileField(write_only=True, required=False)
+    # a completed upload of the answer file, replacing `file_data`
+    upload = PrefetchedPrimaryKeyRelatedField(
+        context_key='uploads', queryset=Upload.objects.all(), pk_field=serializers.UUIDField(),
+        write_only=True, required=False, allow_null=True
+    )
     
     class Meta:
         model = Answer
-        fields = ['id','question', 'value', 'file_data', 'file']
+        fields = ['id','question', 'value', 'file_data', 'file', 'upload']
         # extra_kwargs = {
         #     'value': {'required': False}
         # }
@@ -340,55 +400,50 @@ class AnswerSerializer(serializers.ModelSerializer):
         """
         if self.context.get('validated') is True:
             return data
-        question = data['question']
+        # partial updates of an answer (bulk_update) are validated against its question
+        question = data['question'] if 'question' in data else self.instance.question
         # print(question)
         value = data.get('value')
         # print(value)
         file_data = data.pop('file_data', None)
+        upload = data.pop('upload', None)
         # print('5') if file_data else print('0')
-        settings = question.settings
- # Validate based on question type
-        if question.question_type == Question.QUESTION_TYPES.MULTIPLE:
-            if 'choices' not in value or not value['choices']:
-                raise serializers.ValidationError({"value":"Muliple choice questions must have `choices` in `value` and have at least one selected option"})
-            if not isinstance(value['choices'],list):
-                raise serializers.ValidationError({"value":"the `choices` in `value` must be a list"})
-            if settings.get('min_selections') and len(value['choices']) < settings.get('min_selections'):
-                raise serializers.ValidationError({"value":f"Choice questions must have at least {settings.get('min_selections')} selected options"})
-            if settings.get('max_selections') and len(value['choices']) > settings.get('max_selections'):
-                raise serializers.ValidationError({"value":f"Choice questions must have at most {settings.get('max_selections')} selected options"})
-            # check each answer choice if its in the options
-            if settings.get('flexable') == False:
-                for choice in value['choices']:
-                    if choice not in settings.get('options'):
-                        raise serializers.ValidationError({"value":f'the choice `{choice}` is not a valid choice for this question'})
-        elif question.question_type == Question.QUESTION_TYPES.SINGLE:
-            if 'choice' not in value or not value['choice'] or not isinstance(value['choice'],str):
-                raise serializers.ValidationError({"value":"Single choice question can only have one selected option"})
-            if value['choice'] not in question.settings.get('options'):
-                raise serializers.ValidationError({"value":f'the choice ({value["choice"]}) is not a valid choice for this question'})
-        elif question.question_type == Question.QUESTION_TYPES.RATING:
-            if not isinstance(value,float):
-                raise serializers.ValidationError({"value":"Rating question must have an float value"})
-            if not (settings.get('min_value') <= value <= settings.get('max_value')):
-                raise serializers.ValidationError({"value":"Rating question must have an float value between min value and max value"})
-            if not (value - settings.get('min_value')) % settings.get('step') == 0:
-                raise serializers.ValidationError({"value":f"Rating question must have an float value with the correct step {settings.get('step')}"})
-        elif question.question_type == Question.QUESTION_TYPES.TEXT and not isinstance(value, str) or value == '': #('answer_text' not in value or not value['answer_text']):
-            raise serializers.ValidationError({"value":"Text question must have a value"})
+        # validate with the compiled validators of the survey, the batch endpoint provides its questions
+        validators = get_survey_validators(
+            question.survey, self.context.get('survey_questions', {}).get(question.survey_id)
+        )
+        try:
+            validators.validate(question, value)
+        except DjangoValidationError as e:
+            raise serializers.ValidationError({"value": e.messages})
         # Handle file upload
-        if question.question_type == 'file' and file_data:#(file_data is not None or file_data != ''):
+        if question.question_type == 'file' and upload is not None:
+            request = self.context.get('request')
+            user_id = request.user.id if request is not None else None
+            # uploads of a user can only be attached by them, anonymous ones by whoever holds their id
+            if (upload.purpose != Upload.Purpose.ANSWER or upload.question_id != question.id
+                    or upload.status != Upload.Status.COMPLETED
+                    or (upload.uploaded_by_id is not None and upload.uploaded_by_id != user_id)):
+                raise serializers.ValidationError({'upload': 'Not a completed upload of a file for this question'})
+            try:
+                # the question settings may have changed since the upload was declared
+                validators.validate_upload(question, upload.extension, upload.size_mb)
+            except DjangoValidationError as e:
+                raise serializers.ValidationError({'upload': e.messages})
+            data['value'] = {
+                'size': upload.size_mb,
+                'type': upload.extension,
+                ANSWER_FILE_PATH_KEY: upload.file_path,
+            }
+            data['upload'] = upload
+        elif question.question_type == 'file' and file_data:#(file_data is not None or file_data != ''):
             try:
                 # Parse file data (format: "data:mimetype;base64,<base64-data>")
                 file_format, filestr = file_data.split(';base64,')
                 ext = file_format.split('/')[-1]
                 
                 # Validate file extension
-                allowed_extensions = question.settings.get('allowed_extensions', ['pdf', 'doc', 'docx'])
-                if ext.lower() not in allowed_extensions:
-                    raise serializers.ValidationError(
-                        f"File type not allowed. Allowed types: {', '.join(allowed_extensions)}"
-                    )
+                validators.validate_upload(question, ext)
 
                 # Decode file data
                 file_data = base64.b64decode(filestr)
@@ -396,11 +451,7 @@ class AnswerSerializer(serializers.ModelSerializer):
                 file_size = len(file_data) / (1024 * 1024)  # Convert to MB TODO round
                 
                 # Validate file size
-                max_size = question.settings.get('max_file_size', 5)  # Default 5MB
-                if file_size > max_size:
-                    raise serializers.ValidationError(
-                        f"File size too large. Maximum size: {max_size}MB"
-                    )
+                validators.validate_upload(question, ext, file_size)
 
                 # Generate unique filename
                 filename = f"{value if value else 'file'}-{uuid.uuid4().hex}.{ext}"
@@ -417,8 +468,7 @@ class AnswerSerializer(serializers.ModelSerializer):
             except Exception as e:
                 raise serializers.ValidationError({'file_data':str(e)})
         elif question.question_type == 'file' and (file_data is None or file_data == ''):
-            print(file_data)
-            raise serializers.ValidationError({"file_data":"File question must have a file"})
+            raise serializers.ValidationError({"file_data":"File question must have a file or an `upload`"})
         
             # print(f'data: {data}\n**validated**')
         # self.context['validate'] = True
@@ -429,44 +479,139 @@ class AnswerSerializer(serializers.ModelSerializer):
 
         # pop file_data before creating
         file_data = validated_data.pop('file', None)
+        upload = validated_data.pop('upload', None)
         # print(file_data)
         answer = Answer(**validated_data)
                 
-        if file_data:
-            file_path = answer_file_upload_path(answer, file_data.name, 'answers')
-            default_storage.save(file_path, file_data)
-            validated_data.get('value').update({ANSWER_FILE_PATH_KEY:file_path})
-            # answer.value['file_path'] = file_path
-            # print(file_path)
-            # answer.save()
-        answer.save()
+        with transaction.atomic():
+            if file_data:
+                answer.value.update({ANSWER_FILE_PATH_KEY: store_file(file_data)})
+            answer.save()
+            if upload is not None:
+                attach_uploads([upload])
         # answer = Answer.objects.create(**validated_data) # question, value
 
 
         return answer
+    @transaction.atomic
     def update(self, instance, validated_data):
-        if validated_data.get('file'):
-            file_path = answer_file_upload_path(instance, validated_data.get('file').name, 'answers')
-            default_storage.delete(instance.value.get(ANSWER_FILE_PATH_KEY))
-            default_storage.save(file_path, validated_data.get('file'))
-            validated_data.get('value').update({ANSWER_FILE_PATH_KEY:file_path})
+        # ratings and text answers are not dicts
+        previous_path = instance.value.get(ANSWER_FILE_PATH_KEY) if isinstance(instance.value, dict) else None
+        file_data = validated_data.pop('file', None)
+        upload = validated_data.pop('upload', None)
+        if file_data:
+            validated_data.get('value').update({ANSWER_FILE_PATH_KEY: store_file(file_data)})
+        elif upload is not None:
+            attach_uploads([upload])
 
-        return super().update(instance, validated_data)
+        instance = super().update(instance, validated_data)
+        if (file_data or upload is not None) and previous_path:
+            release_file(previous_path)
+        return instance
 
 
 
+def _build_answers(response, answers_data):
+    """
+    Unsaved answers of a response from their validated data, with their base64 files
+    stored, and the uploads they reference
+    """
+    answers = []
+    uploads = []
+    for answer_data in answers_data:
+        answer_data = dict(answer_data)
+        file = answer_data.pop('file', None)
+        answer_data.pop('file_data', None)
+        upload = answer_data.pop('upload', None)
+        answer = Answer(response=response, **answer_data)
+        if file:
+            answer.value.update({ANSWER_FILE_PATH_KEY: store_file(file)})
+        if upload is not None:
+            uploads.append(upload)
+        answers.append(answer)
+    return answers, uploads
+
+
+def _create_responses(responses_data):
+    """
+    Insert validated responses and their answers with bulk operations in one transaction.
+    bulk_create sends no post_save, the data versions of the surveys are bumped, the
+    answer facts written and the rollups updated here. Files are stored by content,
+    a rollback only leaves unreferenced copies.
+    """
+    with transaction.atomic():
+        responses = []
+        responses_answers = []
+        for response_data in responses_data:
+            response_data = dict(response_data)
+            responses_answers.append(response_data.pop('answers'))
+            responses.append(Response(**response_data))
+        Response.objects.bulk_create(responses)
+
+        answers = []
+        uploads = []
+        for response, answers_data in zip(responses, responses_answers):
+            response_answers, response_uploads = _build_answers(response, answers_data)
+            answers.extend(response_answers)
+            uploads.extend(response_uploads)
+        Answer.objects.bulk_create(answers)
+        add_answer_facts(answers)
+        attach_uploads(uploads)
+        Survey.bump_data_version(pk__in={response.survey_id for response in responses})
+
+        rollup_delta = RollupDelta()
+        rollup_delta.add_answers(answers)
+        rollup_delta.apply()
+    return responses
+
+
 class ResponseSerializer(serializers.ModelSerializer):
+    survey = PrefetchedPrimaryKeyRelatedField(context_key='surveys', queryset=Survey.objects.all())
     answers = AnswerSerializer(many=True)
 
     class Meta:
         model = Response
         fields = ['id', 'survey', 'respondent', 'submitted_at', 'answers', 'completion_time']
         read_only_fields = ['submitted_at']
+
+    def to_internal_value(self, data):
+        request = self.context.get('request')
+        if 'questions' not in self.context and request is not None and hasattr(data, 'get'):
+            # the survey and its questions loaded for the request, shared with the permission and the view
+            loader = get_survey_loader(request)
+            if loader.get(data.get('survey')) is not None:
+                self.context.update(loader.serializer_context())
+        # resolve the questions of all the answers with a single query, unless they were loaded
+        answers_data = data.get('answers') if hasattr(data, 'get') else None
+        if isinstance(answers_data, list) and 'questions' not in self.context:
+            question_ids = set()
+            for answer_data in answers_data:
+                question_id = answer_data.get('question') if isinstance(answer_data, dict) else None
+                if isinstance(question_id, (int, str)) and str(question_id).isdigit():
+                    question_ids.add(int(question_id))
+            self.context['questions'] = Question.objects.select_related('survey').in_bulk(question_ids)
+        if isinstance(answers_data, list):
+            # resolve the uploads of the file answers with a single query
+            uploads = self.context.setdefault('uploads', {})
+            upload_ids = set()
+            for answer_data in answers_data:
+                if isinstance(answer_data, dict) and answer_data.get('upload'):
+                    try:
+                        upload_ids.add(uuid.UUID(str(answer_data['upload'])))
+                    except ValueError:
+                        pass
+            if upload_ids - uploads.keys():
+                uploads.update(Upload.objects.in_bulk(upload_ids - uploads.keys()))
+        return super().to_internal_value(data)
         
     def validate(self, data):
         answers_data = data.get('answers')
-        survey_questions = data.get('survey').questions.all()
-        required_questions = survey_questions.filter(required=True).values_list('id', flat=True)
+        # questions of the surveys loaded by the view, by survey id
+        survey_questions = self.context.get('survey_questions', {}).get(data.get('survey').pk)
+        if survey_questions is not None:
+            required_questions = [question.id for question in survey_questions if question.required]
+        else:
+            required_questions = data.get('survey').questions.filter(required=True).values_list('id', flat=True)
         answered_questions = [answer_data.get('question').id for answer_data in answers_data]
         # print(f'required_questions: {required_questions}\nanswered_questions: {answered_questions}')
         required_questions_not_answered = []
@@ -480,31 +625,19 @@ class ResponseSerializer(serializers.ModelSerializer):
         #     raise serializers.ValidationError(f'All required questions must be answered')
 
         for answer_data in answers_data:
-            if answer_data.get('question').survey.pk is not data.get('survey').pk:
+            if answer_data.get('question').survey_id != data.get('survey').pk:
                 raise serializers.ValidationError(f'this question ({answer_data.get("question")}) is not for this survey')
 
+        upload_ids = [answer_data['upload'].pk for answer_data in answers_data if answer_data.get('upload')]
+        if len(upload_ids) != len(set(upload_ids)):
+            raise serializers.ValidationError({'answers': 'An upload can only be attached to one answer'})
+
         return data
 
     def create(self, validated_data):
         # print(f'validated data: {validated_data}')
-        answers_data = validated_data.pop('answers')
-        response = Response.objects.create(**validated_data)
-        # self.answers
-        # print(f'response: {response}')
-        for answer_data in answers_data:
-            # Update answer data with question id replacing Question object
-            answer_data.update({'question': answer_data.get('question').pk})
-            # print(answer_data)
-            # Pass response instance in context for file path generation
-            answer_serializer = AnswerSerializer(
-                data=answer_data,
-                context={'response': response,'validated':True} # to avoid validating the data again and loss `file` key
-            )
-            # print(f'answer serializer: {answer_serializer}')
-            if answer_serializer.is_valid(raise_exception=True):
-                answer_serializer.save(response=response) # calls the answer serializer.create
-        
-        return response
+        # the answers were validated with the response, they are inserted at once
+        return _create_responses([validated_data])[0]
 
         # for answer_data in answers_data:
         #     Answer.objects.create(response=response, **answer_data)
@@ -552,7 +685,18 @@ class SurveyViewSet(viewsets.ModelViewSet):
                     'closes_at', 'is_active', 'respondent_auth_requirement','is_closed', 'questions']
             read_only_fields = ['creator', 'created_at']
 
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            # sparse fieldset selected by the view
+            fields = self.context.get('fields')
+            if fields is not None:
+                for field_name in set(self.fields) - set(fields):
+                    self.fields.pop(field_name)
+
     serializer_class = OutputSerializer
+    pagination_class = SurveyCursorPagination
+    # fields of listed surveys only included when asked for with ?expand=
+    expandable_fields = ['questions']
     # permission_classes = [permissions.IsAuthenticated]
     permission_classes = [SurveyAccessPermission]
     filter_backends = [DjangoFilterBackend, OrderingFilter]
@@ -562,9 +706,12 @@ class SurveyViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         if self.action in ['list', 'retrieve']:
-            return Survey.objects.filter(is_active=True)
+            queryset = Survey.objects.filter(is_active=True)
         else:
-            return Survey.objects.filter(creator=self.request.user)
+            queryset = Survey.objects.filter(creator=self.request.user)
+        if self.action in ['list', 'management'] and 'questions' in self.get_list_fields():
+            queryset = queryset.prefetch_related('questions')
+        return queryset
         # if self.action in ['list', 'retrieve']:
         #     if not self.request.user.is_authenticated or (self.request.user.is_authenticated and not self.request.user.is_verified):
         #         # For list action, show all active surveys
@@ -580,6 +727,24 @@ class SurveyViewSet(viewsets.ModelViewSet):
         if self.action == 'create':
             return self.CreateSerializer
         return super().get_serializer_class()
+
+    def get_list_fields(self):
+        """
+        Fields of the listed surveys: all of them or the ones selected with ?fields=id,title,...
+        plus the expandable ones asked for with ?expand=questions
+        """
+        fields = self.OutputSerializer.Meta.fields
+        requested = [field for field in self.request.query_params.get('fields', '').split(',') if field]
+        if requested:
+            fields = [field for field in fields if field in requested]
+        expand = self.request.query_params.get('expand', '').split(',')
+        return [field for field in fields if field not in self.expandable_fields or field in expand]
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action in ['list', 'management']:
+            context['fields'] = self.get_list_fields()
+        return context
     
     # def get_permissions(self):
     #     if self.action in ['create','statistics']:
@@ -589,12 +754,33 @@ class SurveyViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
        serializer.save(creator=self.request.user)
 
+    def retrieve(self, request, *args, **kwargs):
+        # the definition respondents load, served from the cache with an ETag
+        survey_id = kwargs[self.lookup_field]
+        definition = get_survey_definition(
+            int(survey_id), 'survey', lambda survey: self.get_serializer(survey).data
+        ) if str(survey_id).isdigit() else None
+        if definition is None or not definition['is_active']:
+            return DRFResponse({'detail': 'No Survey matches the given query.'}, status=status.HTTP_404_NOT_FOUND)
+        self.check_object_permissions(request, definition_survey(definition, survey_id))
+        return definition_response(request, definition, project_settings.SURVEY_DEFINITION_MAX_AGE)
+
     @action(detail=False, methods=['get'])
     def management(self, request):
-        creator_surveys = Survey.objects.filter(creator=self.request.user)
-        serializer = self.get_serializer(creator_surveys, many=True)
-        return DRFResponse(serializer.data)
+        creator_surveys = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(creator_surveys)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
         
+    @action(detail=True, methods=['post'])
+    def live_token(self, request, pk=None):
+        """Short-lived token opening the live statistics stream of the survey from a browser's EventSource"""
+        survey = self.get_object()
+        return DRFResponse({
+            'token': live_statistics_token(survey, request.user),
+            'expires_in': LIVE_STATISTICS_TOKEN_MAX_AGE,
+        })
+
     @action(detail=True, methods=['get'])
     def statistics(self, request, pk=None):
         survey = self.get_object()
@@ -605,17 +791,46 @@ class SurveyViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Get query parameters for analysis
-        correlation_questions = request.query_params.getlist('correlate')
-        general_correlation = request.query_params.get('general_correlation', 'false').lower() == 'true'
-        filter_question = request.query_params.get('filter_question')
-        filter_value = request.query_params.get('filter_value')
-        group_by = request.query_params.get('group_by')  # e.g., 'date', 'respondent__age_group'
-        trend_period = request.query_params.get('trend_period',None)#, 'day')  # Options: day, week, month, quarter
+        try:
+            params = normalize_statistics_params(request.query_params)
+        except FilterExpressionError as error:
+            return DRFResponse({'error': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+        if params['filters'] is not None:
+            filterable_ids = set(survey.questions.filter(question_type__in=ACCEPTED_Q_TYPES).values_list('id', flat=True))
+            unknown_ids = expression_question_ids(params['filters']) - filterable_ids
+            if unknown_ids:
+                return DRFResponse(
+                    {'error': f"Filters are only accepted on the rating and choice questions of the survey, "
+                              f"not on questions {', '.join(map(str, sorted(unknown_ids)))}"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        if params['filter_question'] is not None and params['filter_question'].isdigit():
+            filter_type = survey.questions.filter(id=params['filter_question']).values_list('question_type', flat=True).first()
+            if filter_type is not None and filter_type not in ACCEPTED_Q_TYPES:
+                return DRFResponse(
+                    {'error': f"Filters are only accepted on the rating and choice questions of the survey, "
+                              f"not on question {params['filter_question']}"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        stats = get_or_compute_statistics(survey, params, lambda: self._compute_statistics(survey, params))
+        return DRFResponse(stats)
+
+    def _compute_statistics(self, survey, params):
+        """Compute the statistics of a closed survey for the normalized query parameters"""
+        correlation_questions = params['correlate']
+        general_correlation = params['general_correlation']
+        filter_question = params['filter_question']
+        filter_value = params['filter_value']
+        group_by = params['group_by']  # e.g., 'date', 'respondent__age_group'
+        trend_period = params['trend_period']  # Options: day, week, month, quarter
+
+        # Closed surveys are analysed from their materialized answer matrix (None when disabled)
+        matrix = get_answer_matrix(survey)
+        rows = matrix.all_rows() if matrix is not None else None
 
         # Base statistics
         stats = {
-            'total_responses': survey.responses.count(),
+            'total_responses': len(matrix) if matrix is not None else survey.responses.count(),
             'questions': [],
             'correlations': {},
             'patterns': {},
@@ -625,128 +840,86 @@ class SurveyViewSet(viewsets.ModelViewSet):
 
         # Apply filters if specified
         responses = survey.responses.all()
+        filtered = False
         if filter_question and filter_value:
             try:
                 filter_q = Question.objects.get(id=filter_question, survey=survey)
-                filtered_answers = Answer.objects.filter(
-                    question=filter_q,
-                    response__in=responses,
-                    value__contains=filter_value
-                )
-                responses = Response.objects.filter(id__in=filtered_answers.values('response'))
-            except Question.DoesNotExist:
+                filter_rows = matrix.match_rows(filter_q.id, filter_value) if matrix is not None else None
+                if filter_rows is None:
+                    responses = _filter_responses(filter_q, filter_value, responses)
+                    if matrix is not None:
+                        filter_rows = matrix.rows_for_responses(responses.values_list('id', flat=True))
+                if matrix is not None:
+                    rows = filter_rows
+                filtered = True
+            except (Question.DoesNotExist, ValueError):
                 pass
+
+        # AND/OR/NOT of several conditions, evaluated on the bitmap index of the matrix rows
+        filter_expression = params['filters']
+        if filter_expression is not None:
+            if matrix is not None:
+                rows = rows & get_bitmap_index(survey, matrix).evaluate(filter_expression).to_mask()
+            else:
+                filter_questions = survey.questions.in_bulk(expression_question_ids(filter_expression))
+                responses = _filter_expression_responses(filter_expression, filter_questions, responses)
+            filtered = True
         
         if trend_period:
-            trends = self._calculate_trends(responses, trend_period)
+            trends = self._calculate_trends(responses, trend_period, matrix, rows)
             stats['trends'] = trends
             
 
         # Process each question's statistics
-        for question in survey.questions.all():
-            question_stats = {
-                'id': question.id,
-                'question_text': question.question_text,
-                'question_type': question.question_type,
-                'response_rate': 0,
-                # 'temporal_analysis': {},
-            }
-            
-            answers = Answer.objects.filter(question=question, response__in=responses)
-            total_answers = answers.count()
-            question_stats['response_rate'] = (total_answers / stats['total_responses']) * 100 if stats['total_responses'] > 0 else 0
-
-
-            if question.question_type in [Question.QUESTION_TYPES.SINGLE, Question.QUESTION_TYPES.MULTIPLE]:
-                option_counts = {}
-                percentage_distribution = {}
-                CHOICE_KEY = 'choices' if question.question_type == Question.QUESTION_TYPES.MULTIPLE else 'choice'
-                
-                for answer in answers:
-                    choices = answer.value.get(CHOICE_KEY)
-                    if isinstance(choices, list):
-                        for choice in choices:
-                            option_counts[choice] = option_counts.get(choice, 0) + 1
-                    else:
-                        option_counts[choices] = option_counts.get(choices, 0) + 1
-
-                # Calculate percentages
-                for option, count in option_counts.items():
-                    percentage_distribution[option] = (count / total_answers * 100) if total_answers > 0 else 0
-
-                question_stats.update({
-                    'option_distribution': option_counts,
-                    'percentage_distribution': percentage_distribution,
-                    'most_common_answer': max(option_counts.items(), key=lambda x: x[1])[0] if option_counts else None,
-                })
-
-            elif question.question_type == Question.QUESTION_TYPES.RATING:
-                rating_stats = answers.aggregate(
-                    avg_rating=Avg(Cast('value', FloatField())),
-                    max_rating=Max(Cast('value', FloatField())),
-                    min_rating=Min(Cast('value', FloatField())),
-                    count_ratings=Count('id'),
-                    stddev_rating=StdDev(Cast('value', FloatField()))
-                )
-                
-                # Calculate rating distribution
-                rating_distribution = answers.values('value').annotate(
-                    count=Count('id')
-                ).order_by('value')
-
-                question_stats.update({
-                    'average_rating': float(rating_stats['avg_rating']) if rating_stats['avg_rating'] is not None else None,
-                    'max_rating': float(rating_stats['max_rating']) if rating_stats['max_rating'] is not None else None,
-                    'min_rating': float(rating_stats['min_rating']) if rating_stats['min_rating'] is not None else None,
-                    'total_ratings': rating_stats['count_ratings'],
-                    'standard_deviation': float(rating_stats['stddev_rating']) if rating_stats['stddev_rating'] is not None else None,
-                    'rating_distribution': list(rating_distribution)
-                })
-
-            stats['questions'].append(question_stats)
+        questions = list(survey.questions.all())
+        questions_stats = None
+        if not filtered:
+            # statistics of all the responses are read from the question rollups in O(questions)
+            questions_stats = _calculate_rollup_question_statistics(questions, stats['total_responses'])
+        if questions_stats is None and matrix is not None:
+            questions_stats = _calculate_matrix_question_statistics(matrix, questions, rows, stats['total_responses'])
+        elif questions_stats is None:
+            questions_stats = _calculate_question_statistics(survey, responses, stats['total_responses'])
+        stats['questions'] = questions_stats
 
         # Calculate correlations between specified questions
+        questions_by_id = {str(question.id): question for question in questions}
         if len(correlation_questions) >= 2:
             for i in range(len(correlation_questions)):
                 for j in range(i + 1, len(correlation_questions)):
                     q1_id, q2_id = correlation_questions[i], correlation_questions[j]
-                    try:
-                        q1 = Question.objects.get(id=q1_id, survey=survey)
-                        q2 = Question.objects.get(id=q2_id, survey=survey)
-                        
-                        correlation_key = f"{q1_id}_{q2_id}"
-                        correlation_data = self._calculate_correlation(q1, q2, responses)
-                        stats['correlations'][correlation_key] = {
-                            'questions': [q1.question_text, q2.question_text],
-                            'data': correlation_data
-                        }
-                    except Question.DoesNotExist:
+                    q1 = questions_by_id.get(q1_id)
+                    q2 = questions_by_id.get(q2_id)
+                    if q1 is None or q2 is None:
                         continue
+
+                    correlation_key = f"{q1_id}_{q2_id}"
+                    correlation_data = self._calculate_correlation(q1, q2, responses, matrix, rows)
+                    stats['correlations'][correlation_key] = {
+                        'questions': [q1.question_text, q2.question_text],
+                        'data': correlation_data
+                    }
         
         if general_correlation:
-            stats['correlations'] = _calculate_general_correlation(survey,responses)
+            stats['correlations'] = _calculate_general_correlation(survey, responses, matrix, rows)
 
         # Pattern recognition
         if group_by:
-            patterns = self._recognize_patterns(survey, responses, group_by)
+            patterns = self._recognize_patterns(survey, responses, group_by, matrix, rows)
             stats['patterns'] = patterns
 
-        return DRFResponse(stats)
+        return stats
 
-    def _calculate_correlation(self, q1, q2, responses):
+    def _calculate_correlation(self, q1, q2, responses, matrix=None, rows=None):
         """Calculate correlation between two questions"""
         correlation_data = {
             'joint_distribution': {},
             'correlation_strength': None
         }
 
-        # Get answers for both questions
-        answers1 = Answer.objects.filter(question=q1, response__in=responses)
-        answers2 = Answer.objects.filter(question=q2, response__in=responses)
-
         # Create a mapping of response_id to answers
-        answers1_map = {a.response_id: a.value for a in answers1}
-        answers2_map = {a.response_id: a.value for a in answers2}
+        answers1_map = _answer_values(q1, responses, matrix, rows)
+        answers2_map = _answer_values(q2, responses, matrix, rows)
 
         # Calculate joint distribution
         common_responses = set(answers1_map.keys()) & set(answers2_map.keys())
@@ -763,12 +936,18 @@ class SurveyViewSet(viewsets.ModelViewSet):
             values2 = [float(answers2_map[r]) for r in common_responses]
             
             if values1 and values2:
-                correlation_data['correlation_strength'] = np.corrcoef(values1, values2)[0, 1]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    strength = float(np.corrcoef(values1, values2)[0, 1])
+                # constant answers (e.g. after filtering on one of the questions) have no correlation
+                correlation_data['correlation_strength'] = None if np.isnan(strength) else strength
 
         return correlation_data
 
-    def _recognize_patterns(self, survey, responses, group_by):
+    def _recognize_patterns(self, survey, responses, group_by, matrix=None, rows=None):
         """Recognize patterns in survey responses based on grouping"""
+        if matrix is not None:
+            return self._recognize_matrix_patterns(survey, group_by, matrix, rows)
+
         patterns = {
             'group_analysis': [],
             'trends': {}
@@ -940,7 +1119,120 @@ class SurveyViewSet(viewsets.ModelViewSet):
 
         return patterns
 
-    def _calculate_trends(self, responses, trend_period):
+    def _recognize_matrix_patterns(self, survey, group_by, matrix, rows):
+        """
+        Same patterns as _recognize_patterns, computed from the answer matrix.
+        The demographic values of the respondents are fetched with a single query.
+        """
+        patterns = {
+            'group_analysis': [],
+            'trends': {}
+        }
+        if not group_by.startswith('respondent__'):
+            return patterns
+
+        field = group_by.split('__')[1]
+        try:
+            respondent_values = dict(
+                Response.objects.filter(survey=survey, respondent__isnull=False).values_list('id', f'respondent__{field}')
+            )
+        except FieldError:
+            return patterns
+
+        row_response_ids = matrix.response_ids.tolist()
+        row_values = [respondent_values.get(response_id) if rows[i] else None for i, response_id in enumerate(row_response_ids)]
+
+        # Special handling for age groups if grouping by date_of_birth
+        if field == 'date_of_birth':
+            today = timezone.now().date()
+            row_ages = [
+                today.year - value.year - ((today.month, today.day) < (value.month, value.day)) if value else None
+                for value in row_values
+            ]
+            ages = np.array([age for age in row_ages if age is not None])
+            row_values = [None] * len(row_values)
+            if ages.size:
+                # Calculate age groups dynamically using numpy percentiles
+                min_age = np.min(ages)
+                max_age = np.max(ages)
+                if len(ages) >= 4:  # If we have enough data, create quartiles
+                    percentiles = np.percentile(ages, [25, 50, 75])
+                    age_ranges = [
+                        (min_age, int(percentiles[0])),
+                        (int(percentiles[0]) + 1, int(percentiles[1])),
+                        (int(percentiles[1]) + 1, int(percentiles[2])),
+                        (int(percentiles[2]) + 1, max_age)
+                    ]
+                else:  # If we have limited data, create equal-width groups
+                    group_width = max(1, (max_age - min_age) // 3)
+                    age_ranges = [
+                        (min_age, min_age + group_width),
+                        (min_age + group_width + 1, min_age + 2 * group_width),
+                        (min_age + 2 * group_width + 1, max_age)
+                    ]
+                row_values = [
+                    next((f"{start}-{end} years" for start, end in age_ranges if start <= age <= end), "Unknown")
+                    if age is not None else None
+                    for age in row_ages
+                ]
+
+        # Group rows by demographic value, in order of first appearance
+        group_rows = {}
+        for i, value in enumerate(row_values):
+            if value:
+                group_rows.setdefault(value, []).append(i)
+
+        questions = [
+            question for question in survey.questions.all()
+            if question.question_type in [Question.QUESTION_TYPES.RATING, Question.QUESTION_TYPES.SINGLE, Question.QUESTION_TYPES.MULTIPLE]
+            and matrix.is_encoded(question.id)
+        ]
+        for group, indices in group_rows.items():
+            group_mask = np.zeros(len(matrix), dtype=bool)
+            group_mask[indices] = True
+            metrics = {
+                'count': len(indices),
+                'questions': {}
+            }
+            for question_type in [Question.QUESTION_TYPES.RATING, Question.QUESTION_TYPES.SINGLE, Question.QUESTION_TYPES.MULTIPLE]:
+                for question in questions:
+                    if question.question_type != question_type:
+                        continue
+                    answered_rows = group_mask & matrix.answered_rows(question.id)
+                    if question_type == Question.QUESTION_TYPES.RATING:
+                        rating_values = matrix.ratings(question.id)[answered_rows]
+                        rating_values = rating_values[~np.isnan(rating_values)]
+                        if rating_values.size:
+                            metrics['questions'][question.id] = {
+                                'question_text': question.question_text,
+                                'type': 'rating',
+                                'stats': {
+                                    'avg_rating': float(np.mean(rating_values)),
+                                    'std_dev': float(np.std(rating_values)),
+                                    'min_rating': float(np.min(rating_values)),
+                                    'max_rating': float(np.max(rating_values))
+                                }
+                            }
+                        continue
+
+                    counts = matrix.selections(question.id)[answered_rows].sum(axis=0)
+                    options = matrix.options(question.id)
+                    distribution = {str(options[j]): int(count) for j, count in enumerate(counts) if count}
+                    if distribution:
+                        metrics['questions'][question.id] = {
+                            'question_text': question.question_text,
+                            'type': question_type,
+                            'distribution': dict(sorted(distribution.items()))
+                        }
+
+            patterns['group_analysis'].append({
+                'group': group,
+                'metrics': metrics
+            })
+
+        return patterns
+
+    def _calculate_trends(self, responses, trend_period, matrix=None, rows=None):
         # Calculate trends based on submitted_at
         trunc_mapping = {
             'day': TruncDay,
@@ -955,12 +1247,15 @@ class SurveyViewSet(viewsets.ModelViewSet):
                 {'error': 'Invalid trend_period. Must be one of: day, week, month, quarter'}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
-        trend_data = responses.annotate(
-            period=trunc_func('submitted_at')
-        ).values('period').annotate(
-            count=Count('id'),
-            avg_completion_time=Avg('completion_time')
-        ).order_by('period')
+        if matrix is not None:
+            trend_data = self._matrix_trend_data(matrix, rows, trend_period if trend_period in trunc_mapping else 'day')
+        else:
+            trend_data = responses.annotate(
+                period=trunc_func('submitted_at')
+            ).values('period').annotate(
+                count=Count('id'),
+                avg_completion_time=Avg('completion_time')
+            ).order_by('period')
 
         if trend_data:
             
@@ -1019,6 +1314,34 @@ class SurveyViewSet(viewsets.ModelViewSet):
             }
             return trends
 
+    def _matrix_trend_data(self, matrix, rows, trend_period):
+        """Per period response counts and average completion times of the matrix rows, like the Trunc* queries"""
+        days = matrix.submitted_at[rows].astype('datetime64[D]')
+        if trend_period == 'week':
+            # weeks start on monday, 1970-01-01 was a thursday
+            periods = days - (days.astype(np.int64) + 3) % 7
+        elif trend_period == 'month':
+            periods = days.astype('datetime64[M]').astype('datetime64[D]')
+        elif trend_period == 'quarter':
+            months = days.astype('datetime64[M]').astype(np.int64)
+            periods = (months - months % 3).astype('datetime64[M]').astype('datetime64[D]')
+        else:
+            periods = days
+
+        unique_periods, inverse, counts = np.unique(periods, return_inverse=True, return_counts=True)
+        completion_seconds = np.asarray(matrix.completion_seconds[rows])
+        known = ~np.isnan(completion_seconds)
+        completion_sums = np.bincount(inverse[known], weights=completion_seconds[known], minlength=len(unique_periods))
+        completion_counts = np.bincount(inverse[known], minlength=len(unique_periods))
+        return [
+            {
+                'period': period.item(),
+                'count': int(count),
+                'avg_completion_time': timedelta(seconds=completion_sum / completion_count) if completion_count else None
+            }
+            for period, count, completion_sum, completion_count in zip(unique_periods, counts, completion_sums, completion_counts)
+        ]
+
 class QuestionViewSet(viewsets.ModelViewSet):
     serializer_class = QuestionSerializer
     permission_classes = [QuestionAccessPermission]
@@ -1031,30 +1354,23 @@ class QuestionViewSet(viewsets.ModelViewSet):
 
     def perform_create(self, serializer):
         survey = Survey.objects.get(pk=self.kwargs['survey_pk'])
-        if survey.creator != self.request.user:
+        if survey.creator_id != self.request.user.id:
             raise serializers.ValidationError("You are not the creator of this survey",
                                               code=status.HTTP_403_FORBIDDEN)
         serializer.save(survey=survey)
     
     @action(detail=False, methods=['get'], url_path='survey-questions/(?P<survey_pk>[0-9]+)')
     def survey_questions(self, request, survey_pk=None):
-        try:
-            survey = Survey.objects.get(pk=survey_pk)
-        except Survey.DoesNotExist:
+        definition = get_survey_definition(
+            int(survey_pk), 'questions',
+            lambda survey: QuestionSerializer(survey.questions.all(), many=True).data
+        )
+        if definition is None:
             return DRFResponse(
                 {'error': 'Survey does not exist'}, 
                 status=status.HTTP_404_NOT_FOUND
             )
-        # if not survey.is_closed:
-        #     return DRFResponse(
-        #         {'error': 'Survey is still active'}, 
-        #         status=status.HTTP_400_BAD_REQUEST
-        #     )
-        # print(survey)
-        questions = Question.objects.filter(survey=survey)
-        # print(questions)
-        serializer = QuestionSerializer(questions, many=True)
-        return DRFResponse(serializer.data)
+        return definition_response(request, definition, project_settings.SURVEY_DEFINITION_MAX_AGE)
 
 class ResponseViewSet(viewsets.ModelViewSet):
     """
@@ -1071,9 +1387,8 @@ class ResponseViewSet(viewsets.ModelViewSet):
         return Response.objects.filter(respondent=self.request.user).prefetch_related('survey__questions')
 
     def perform_create(self, serializer):
-        print('perform create in response view')
-        ## seems a response is created , use transaction
-        survey = Survey.objects.get(pk=self.request.data['survey'])
+        # the survey loaded for the request by the permission
+        survey = serializer.validated_data['survey']
         
         if survey.is_closed:
             raise serializers.ValidationError("Survey is closed")
@@ -1083,6 +1398,79 @@ class ResponseViewSet(viewsets.ModelViewSet):
             respondent=self.request.user if self.request.user.is_authenticated else None
         )
 
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        rollup_delta = RollupDelta()
+        rollup_delta.remove_answers(instance.answers.select_related('question'))
+        delete_responses(Response.objects.filter(pk=instance.pk))
+        rollup_delta.apply()
+
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """
+        Submit many responses at once, to one or more surveys, e.g. synced by offline kiosks.
+        The surveys and questions of the batch are loaded once, every item is validated on
+        its own and the valid ones are inserted by chunks, each chunk in its own transaction.
+        The result of every item is returned so a bad item does not fail the whole batch.
+        """
+        items = request.data.get('responses') if isinstance(request.data, dict) else request.data
+        if not isinstance(items, list) or not items:
+            return DRFResponse({'error': 'Expected a non empty list of responses'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > RESPONSE_BATCH_MAX_SIZE:
+            return DRFResponse(
+                {'error': f'At most {RESPONSE_BATCH_MAX_SIZE} responses can be submitted at once'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        survey_ids = {
+            int(item['survey']) for item in items
+            if isinstance(item, dict) and str(item.get('survey', '')).isdigit()
+        }
+        loader = get_survey_loader(request)
+        loader.load(survey_ids)
+        context = {**self.get_serializer_context(), **loader.serializer_context()}
+        respondent = request.user if request.user.is_authenticated else None
+
+        results = [None] * len(items)
+        valid_items = []  # (index, validated data)
+        for index, item in enumerate(items):
+            serializer = self.get_serializer(data=item, context=context)
+            if not serializer.is_valid():
+                results[index] = {'index': index, 'status': 'error', 'errors': serializer.errors}
+                continue
+            survey = serializer.validated_data['survey']
+            if survey.is_closed:
+                results[index] = {'index': index, 'status': 'error', 'errors': {'survey': ['Survey is closed']}}
+            elif not can_respond(request.user, survey):
+                results[index] = {
+                    'index': index, 'status': 'error',
+                    'errors': {'survey': ['You do not meet the authentication requirement of this survey']}
+                }
+            else:
+                valid_items.append((index, {**serializer.validated_data, 'respondent': respondent}))
+
+        for start in range(0, len(valid_items), RESPONSE_BATCH_CHUNK_SIZE):
+            chunk = valid_items[start:start + RESPONSE_BATCH_CHUNK_SIZE]
+            try:
+                responses = _create_responses([response_data for _, response_data in chunk])
+            except DatabaseError as e:
+                for index, _ in chunk:
+                    results[index] = {'index': index, 'status': 'error', 'errors': {'non_field_errors': [str(e)]}}
+                continue
+            except serializers.ValidationError as e:
+                # an upload attached concurrently, or by two items of the chunk
+                for index, _ in chunk:
+                    results[index] = {'index': index, 'status': 'error', 'errors': e.detail}
+                continue
+            for (index, _), response in zip(chunk, responses):
+                results[index] = {'index': index, 'status': 'created', 'id': response.id}
+
+        created = sum(result['status'] == 'created' for result in results)
+        return DRFResponse(
+            {'created': created, 'failed': len(items) - created, 'results': results},
+            status=status.HTTP_201_CREATED if created == len(items) else status.HTTP_207_MULTI_STATUS
+        )
+
 from django.shortcuts import get_object_or_404
 
 class ResponseAnswerViewSet(viewsets.ModelViewSet):
@@ -1122,8 +1510,24 @@ class ResponseAnswerViewSet(viewsets.ModelViewSet):
     #         raise serializers.ValidationError("Cannot delete answers - survey is closed")
     #     instance.delete()
     
+    @transaction.atomic
+    def perform_update(self, serializer):
+        rollup_delta = RollupDelta()
+        rollup_delta.remove(serializer.instance.question, serializer.instance.value)
+        answer = serializer.save()
+        rollup_delta.add(answer.question, answer.value)
+        rollup_delta.apply()
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        rollup_delta = RollupDelta()
+        rollup_delta.remove(instance.question, instance.value)
+        delete_answers(Answer.objects.filter(pk=instance.pk))
+        rollup_delta.apply()
+
     ####### check kwargs
     @action(detail=False, methods=['put', 'patch'],url_path='bulk_update/(?P<response_pk>[0-9]+)')
+    @transaction.atomic
     def bulk_update(self, request, response_pk=None):
         """
         Bulk update answers for a response.
@@ -1148,7 +1552,7 @@ class ResponseAnswerViewSet(viewsets.ModelViewSet):
         )
         
         if response.survey.is_closed:
-            return Response(
+            return DRFResponse(
                 {"detail": "Cannot modify answers - survey is closed"},
                 status=status.HTTP_400_BAD_REQUEST
             )
@@ -1156,21 +1560,31 @@ class ResponseAnswerViewSet(viewsets.ModelViewSet):
         answers_data = request.data.get('answers', [])
         updated_answers = []
         errors = []
+        rollup_delta = RollupDelta()
         
         for answer_data in answers_data:
             answer_id = answer_data.get('id')
             try:
-                answer = Answer.objects.get(
+                answer = Answer.objects.select_related('question').get(
                     id=answer_id,
                     response=response
                 )
+                previous_value = answer.value
+                if 'question' in answer_data and str(answer_data['question']) != str(answer.question_id):
+                    errors.append({
+                        'id': answer_id,
+                        'errors': 'The question of an answer cannot be changed'
+                    })
+                    continue
                 serializer = self.get_serializer(
                     answer,
                     data=answer_data,#{'question': answer.question.id, 'value': answer_data.get('value')},
                     partial=True
                 )
                 if serializer.is_valid():
-                    serializer.save()
+                    rollup_delta.remove(answer.question, previous_value)
+                    answer = serializer.save()
+                    rollup_delta.add(answer.question, answer.value)
                     updated_answers.append(serializer.data)
                 else:
                     errors.append({
@@ -1184,12 +1598,14 @@ class ResponseAnswerViewSet(viewsets.ModelViewSet):
                 })
         
         # Answer.objects.bulk_update(updated_answers, ['value'])
+        rollup_delta.apply()
         return DRFResponse({
             'updated': updated_answers,
             'errors': errors
         })
 
-    @action(detail=False, methods=['post'])
+    @action(detail=False, methods=['post'], url_path='add_answers/(?P<response_pk>[0-9]+)')
+    @transaction.atomic
     def add_answers(self, request, response_pk=None):
         """
         Add new answers to an existing response.
@@ -1214,7 +1630,7 @@ class ResponseAnswerViewSet(viewsets.ModelViewSet):
         )
         
         if response.survey.is_closed:
-            return Response(
+            return DRFResponse(
                 {"detail": "Cannot add answers - survey is closed"},
                 status=status.HTTP_400_BAD_REQUEST
             )
@@ -1222,8 +1638,18 @@ class ResponseAnswerViewSet(viewsets.ModelViewSet):
         answers_data = request.data.get('answers', [])
         created_answers = []
         errors = []
+        rollup_delta = RollupDelta()
+        survey_question_ids = {str(question_id) for question_id in response.survey.questions.values_list('id', flat=True)}
         
         for answer_data in answers_data:
+            # Only questions of the survey of the response can be answered
+            if str(answer_data.get('question')) not in survey_question_ids:
+                errors.append({
+                    'question': answer_data.get('question'),
+                    'errors': 'Question does not belong to the survey of this response'
+                })
+                continue
+
             # Check if answer already exists for this question
             existing_answer = Answer.objects.filter(
                 response=response,
@@ -1239,7 +1665,8 @@ class ResponseAnswerViewSet(viewsets.ModelViewSet):
             
             serializer = self.get_serializer(data=answer_data)
             if serializer.is_valid():
-                serializer.save(response=response)
+                answer = serializer.save(response=response)
+                rollup_delta.add(answer.question, answer.value)
                 created_answers.append(serializer.data)
             else:
                 errors.append({
@@ -1247,6 +1674,7 @@ class ResponseAnswerViewSet(viewsets.ModelViewSet):
                     'errors': serializer.errors
                 })
         
+        rollup_delta.apply()
         return DRFResponse({
             'created': created_answers,
             'errors': errors
@@ -1259,6 +1687,7 @@ class SurveyResponseManagementView(APIView):
     and exporting to PDF with optional statistics.
     """
     permission_classes = [permissions.IsAuthenticated]
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [PDFRenderer, CSVRenderer, NDJSONRenderer]
     export_pdf = False
 
     def get_survey(self, survey_id):
@@ -1273,7 +1702,24 @@ class SurveyResponseManagementView(APIView):
             return DRFResponse({'error': 'Survey not found'}, status=status.HTTP_404_NOT_FOUND)
 
         if self.export_pdf:
+            export_format = request.query_params.get('format', ExportJob.Format.PDF)
+            if export_format in [ExportJob.Format.CSV, ExportJob.Format.NDJSON]:
+                # full answers, one row per response and one column per question, for analysis tools
+                content_type, extension, render = EXPORT_RENDERERS[export_format]
+                response = StreamingHttpResponse(render(survey, {}), content_type=content_type)
+                response['Content-Disposition'] = f'attachment; filename="survey_responses_{survey_id}.{extension}"'
+                return response
+
             include_stats = request.query_params.get('include_stats', 'false').lower() == 'true'
+            mode = request.query_params.get('mode')
+            if mode in ['stream', 'parallel']:
+                # bounded memory export for large surveys, pages are sent as soon as they are laid out,
+                # in parallel mode by a pool of processes
+                processes = project_settings.EXPORT_PDF_PROCESSES if mode == 'parallel' else 1
+                pages = stream_responses_pdf(survey, include_stats, processes=processes)
+                response = StreamingHttpResponse(pages, content_type='application/pdf')
+                response['Content-Disposition'] = f'attachment; filename="survey_responses_{survey_id}.pdf"'
+                return response
             responses = Response.objects.filter(survey=survey)
             pdf = self._generate_pdf(survey, responses, include_stats)
             response = HttpResponse(content_type='application/pdf')
@@ -1284,7 +1730,7 @@ class SurveyResponseManagementView(APIView):
         if response_id:
             # Retrieve single response with details
             try:
-                response = Response.objects.get(pk=response_id, survey=survey)
+                response = Response.objects.select_related('respondent').get(pk=response_id, survey=survey)
                 data = {
                     'response_id': response.id,
                     'submitted_at': response.submitted_at,
@@ -1303,14 +1749,23 @@ class SurveyResponseManagementView(APIView):
                         'question_text': answer.question.question_text,
                         'question_type': answer.question.question_type,
                         'value': answer.value
-                    } for answer in response.answers.all()]
+                    } for answer in response.answers.select_related('question')]
                 }
                 return DRFResponse(data)
             except Response.DoesNotExist:
                 return DRFResponse({'error': 'Response not found'}, status=status.HTTP_404_NOT_FOUND)
         
-        # List all responses with basic info
-        responses = Response.objects.filter(survey=survey)
+        # List the responses with basic info, newest first, a page at a time
+        # a correlated count only counts the answers of the page, a GROUP BY would aggregate
+        # every response of the survey before the pagination limit applies
+        answer_count = Answer.objects.filter(response=OuterRef('pk')).order_by().values('response').annotate(
+            count=Count('id')
+        ).values('count')
+        responses = Response.objects.filter(survey=survey).select_related('respondent').annotate(
+            answer_count=Coalesce(Subquery(answer_count), 0)
+        )
+        paginator = ResponseKeysetPagination()
+        responses = paginator.paginate_queryset(responses, request, view=self)
         data = [{
             'response_id': response.id,
             'submitted_at': response.submitted_at,
@@ -1319,9 +1774,9 @@ class SurveyResponseManagementView(APIView):
                 'email': response.respondent.email if response.respondent else None,
                 'name': f"{response.respondent.first_name} {response.respondent.last_name}" if response.respondent else None,
             } if response.respondent else None,
-            'answer_count': response.answers.count()
+            'answer_count': response.answer_count
         } for response in responses]
-        return DRFResponse(data)
+        return paginator.get_paginated_response(data)
     # def get(self, request, survey_id, response_id=None):
     #     survey = self.get_survey(survey_id)
     #     if not survey:
@@ -1567,4 +2022,252 @@ class SurveyResponseManagementView(APIView):
     #     response = HttpResponse(content_type='application/pdf')
     #     response['Content-Disposition'] = f'attachment; filename="survey_responses_{survey_id}.pdf"'
     #     response.write(pdf)
-    #     return response
\ No newline at end of file
+    #     return response
+
+class SurveyExportJobView(APIView):
+    """
+    Background exports of the survey responses for the survey creator.
+    POST submits an export, GET lists the jobs or returns the status of one,
+    and the download view serves the artifact of a completed job.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    download = False
+
+    class JobSerializer(serializers.ModelSerializer):
+        download_url = serializers.SerializerMethodField()
+
+        class Meta:
+            model = ExportJob
+            fields = ['id', 'survey', 'format', 'options', 'status', 'data_version', 'artifact_size',
+                      'error', 'created_at', 'started_at', 'finished_at', 'download_url']
+            read_only_fields = fields
+
+        def get_download_url(self, job):
+            if job.status != ExportJob.Status.COMPLETED:
+                return None
+            return reverse('survey-export-job-download', kwargs={'survey_id': job.survey_id, 'job_id': job.id})
+
+    def get_survey(self, survey_id):
+        return Survey.objects.filter(pk=survey_id, creator=self.request.user).first()
+
+    def post(self, request, survey_id):
+        survey = self.get_survey(survey_id)
+        if not survey:
+            return DRFResponse({'error': 'Survey not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        export_format = request.data.get('format', ExportJob.Format.PDF)
+        if export_format not in ExportJob.Format.values:
+            return DRFResponse(
+                {'format': f"Unsupported export format, choose one of: {', '.join(ExportJob.Format.values)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        options = normalize_export_options(export_format, request.data)
+        job, created = submit_export_job(survey, export_format, options, requested_by=request.user)
+        return DRFResponse(
+            self.JobSerializer(job).data,
+            status=status.HTTP_202_ACCEPTED if created else status.HTTP_200_OK
+        )
+
+    def get(self, request, survey_id, job_id=None):
+        survey = self.get_survey(survey_id)
+        if not survey:
+            return DRFResponse({'error': 'Survey not found'}, status=status.HTTP_404_NOT_FOUND)
+        if job_id is None:
+            return DRFResponse(self.JobSerializer(survey.export_jobs.all(), many=True).data)
+
+        job = survey.export_jobs.filter(pk=job_id).first()
+        if not job:
+            return DRFResponse({'error': 'Export job not found'}, status=status.HTTP_404_NOT_FOUND)
+        if not self.download:
+            return DRFResponse(self.JobSerializer(job).data)
+
+        if job.status != ExportJob.Status.COMPLETED:
+            return DRFResponse(
+                {'error': 'Export is not ready', 'status': job.status},
+                status=status.HTTP_409_CONFLICT
+            )
+        if not default_storage.exists(job.artifact_path):
+            return DRFResponse({'error': 'Export artifact not found'}, status=status.HTTP_410_GONE)
+
+        content_type, extension, _ = EXPORT_RENDERERS[job.format]
+        artifact = default_storage.open(job.artifact_path, 'rb')
+        if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+            # artifacts are stored compressed, send them as they are
+            response = FileResponse(artifact, content_type=content_type)
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = StreamingHttpResponse(_decompressed_chunks(artifact), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="survey_responses_{survey_id}.{extension}"'
+        response['Vary'] = 'Accept-Encoding'
+        return response
+
+
+def _decompressed_chunks(artifact, chunk_size=64 * 1024):
+    with artifact, gzip.GzipFile(fileobj=artifact, mode='rb') as decompressed:
+        while chunk := decompressed.read(chunk_size):
+            yield chunk
+
+
+class FileUploadView(APIView):
+    """
+    Chunked, resumable uploads of answer files and question attachments (see uploads.py).
+    POST declares an upload, PATCH appends the raw bytes of its body at the `Upload-Offset`
+    header, GET returns the offset to resume from and DELETE discards the upload.
+    Answers and questions reference the completed upload by id in their `upload` field.
+    """
+
+    class UploadSerializer(serializers.ModelSerializer):
+        question = serializers.PrimaryKeyRelatedField(
+            queryset=Question.objects.select_related('survey'), required=False, allow_null=True
+        )
+
+        class Meta:
+            model = Upload
+            fields = ['id', 'purpose', 'question', 'extension', 'size', 'checksum', 'offset', 'status', 'expires_at']
+            read_only_fields = ['offset', 'status', 'expires_at']
+
+        def validate_extension(self, value):
+            value = value.lstrip('.').lower()
+            if not value.isalnum():
+                raise serializers.ValidationError('Invalid file extension')
+            return value
+
+        def validate_size(self, value):
+            if value <= 0:
+                raise serializers.ValidationError('The file must not be empty')
+            return value
+
+        def validate_checksum(self, value):
+            value = value.lower()
+            if value and (len(value) != 64 or any(c not in '0123456789abcdef' for c in value)):
+                raise serializers.ValidationError('The checksum must be the hex sha256 of the file')
+            return value
+
+        def validate(self, data):
+            user = self.context['request'].user
+            if data.get('purpose', Upload.Purpose.ANSWER) == Upload.Purpose.ANSWER:
+                question = data.get('question')
+                if question is None or question.question_type != Question.QUESTION_TYPES.FILE:
+                    raise serializers.ValidationError({'question': 'Answer files must be uploaded for a file question'})
+                if question.survey.is_closed:
+                    raise serializers.ValidationError({'question': 'Survey is closed'})
+                if not can_respond(user, question.survey):
+                    raise PermissionDenied('You do not meet the authentication requirement of this survey')
+                # the limits of the question are enforced before any byte is sent
+                try:
+                    get_survey_validators(question.survey).validate_upload(
+                        question, data['extension'], data['size'] / (1024 * 1024)
+                    )
+                except DjangoValidationError as e:
+                    raise serializers.ValidationError({'file': e.messages})
+            else:
+                if not (user.is_authenticated and user.is_verified):
+                    raise PermissionDenied('Only verified users can upload question attachments')
+                max_size = getattr(project_settings, 'max_file_size', 5 * 1024 * 1024)
+                if data['size'] > max_size:
+                    raise serializers.ValidationError(
+                        {'size': f"File size too large. Maximum size: {max_size / (1024 * 1024):g}MB"}
+                    )
+                data['question'] = None
+            return data
+
+    def get_upload(self, upload_id):
+        upload = Upload.objects.filter(pk=upload_id).first()
+        # uploads of a user are only reachable by them, anonymous ones by whoever holds their id
+        if upload is None or (upload.uploaded_by_id is not None and upload.uploaded_by_id != self.request.user.id):
+            return None
+        return upload
+
+    def upload_response(self, upload, status_code=status.HTTP_200_OK, **extra):
+        response = DRFResponse({**self.UploadSerializer(upload).data, **extra}, status=status_code)
+        response['Upload-Offset'] = str(upload.offset)
+        return response
+
+    def post(self, request):
+        serializer = self.UploadSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        upload = serializer.save(
+            uploaded_by=request.user if request.user.is_authenticated else None,
+            expires_at=timezone.now() + timedelta(seconds=project_settings.UPLOAD_EXPIRY),
+        )
+        response = self.upload_response(upload, status.HTTP_201_CREATED)
+        response['Location'] = reverse('file-upload', kwargs={'upload_id': upload.pk})
+        return response
+
+    def get(self, request, upload_id):
+        upload = self.get_upload(upload_id)
+        if not upload:
+            return DRFResponse({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+        return self.upload_response(upload)
+
+    def patch(self, request, upload_id):
+        upload = self.get_upload(upload_id)
+        if not upload:
+            return DRFResponse({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            offset = int(request.headers['Upload-Offset'])
+        except (KeyError, ValueError):
+            return DRFResponse(
+                {'error': 'The `Upload-Offset` header must be the offset of the chunk in the file'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            # the body is read by blocks from the request, never loaded at once
+            append_chunk(upload, offset, request.stream)
+        except UploadError as e:
+            return self.upload_response(upload, e.status_code, error=str(e))
+        return self.upload_response(upload)
+
+    def delete(self, request, upload_id):
+        upload = self.get_upload(upload_id)
+        if not upload:
+            return DRFResponse({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+        discard_upload(upload)
+        return DRFResponse(status=status.HTTP_204_NO_CONTENT)
+
+def _live_statistics_user(request, survey_id):
+    """
+    Authentication of a live statistics request: with the token of the Authorization
+    header, or as browsers' EventSource cannot set headers, with a live statistics token
+    of the survey (see SurveyViewSet.live_token) as the `token` query parameter. The API
+    token is never accepted in the URL, where proxies and server logs would keep it.
+    """
+    if request.GET.get('token'):
+        user_id = live_statistics_token_user_id(request.GET['token'], survey_id)
+        if user_id is None:
+            return None
+        return get_user_model().objects.filter(pk=user_id, is_active=True).first()
+    try:
+        user_auth = TokenAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    return user_auth[0] if user_auth else None
+
+
+def _live_statistics_survey(survey_id):
+    return Survey.objects.filter(pk=survey_id).only('id', 'creator_id').first()
+
+
+async def survey_live_statistics(request, survey_id):
+    """
+    Server-sent events stream of the statistics of a survey for its creator, pushing
+    total responses, per option counts and rating means as responses come in.
+    Meant to be served by an ASGI server (SurveyPlane.asgi).
+    """
+    user = await sync_to_async(_live_statistics_user)(request, survey_id)
+    if user is None or not user.is_verified:
+        return JsonResponse({'error': 'Authentication credentials were not provided'}, status=status.HTTP_401_UNAUTHORIZED)
+    survey = await sync_to_async(_live_statistics_survey)(survey_id)
+    if survey is None:
+        return JsonResponse({'error': 'Survey not found'}, status=status.HTTP_404_NOT_FOUND)
+    if survey.creator_id != user.id:
+        return JsonResponse({'error': 'Only the survey creator can watch its statistics'}, status=status.HTTP_403_FORBIDDEN)
+
+    response = StreamingHttpResponse(
+        live_statistics_events(survey.id, LIVE_STATISTICS_KEEPALIVE_SECONDS),
+        content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    # do not let nginx buffer the events
+    response['X-Accel-Buffering'] = 'no'
+    return response
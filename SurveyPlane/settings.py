@@ -93,6 +93,13 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # background exports read for a long time, in WAL mode readers do not block writers
+            'init_command': 'PRAGMA journal_mode=WAL;',
+            # transactions take the write lock when they begin, waiting for the background writers
+            # (file deletions, exports) instead of failing when they try to write after reading
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
@@ -179,6 +186,44 @@ EMAIL_USE_SSL = False
 
 ## uploading files
 max_file_size = 5 * 1024 * 1024 # 5 MB
+# chunks of unfinished uploads are appended to files of this local directory, shared by the workers
+UPLOAD_PARTIAL_DIR = env.str('UPLOAD_PARTIAL_DIR', os.path.join(BASE_DIR, 'uploads'))
+# seconds an upload may take to be completed and attached
+UPLOAD_EXPIRY = env.int('UPLOAD_EXPIRY', 24 * 3600)
+
+## analytics
+# materialize closed surveys' answers as memory-mapped numpy files under MEDIA_ROOT/analytics
+SURVEY_ANSWER_MATRIX_ENABLED = env.bool('SURVEY_ANSWER_MATRIX_ENABLED', True)
+# memoize statistics results per survey data version and query parameters,
+# ANALYTICS_CACHE_URL should point to a shared backend (e.g. redis with allkeys-lru) in production
+ANALYTICS_CACHE_ENABLED = env.bool('ANALYTICS_CACHE_ENABLED', True)
+ANALYTICS_CACHE_LOCAL_MAX_ENTRIES = env.int('ANALYTICS_CACHE_LOCAL_MAX_ENTRIES', 64)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'analytics': env.cache_url(
+        'ANALYTICS_CACHE_URL',
+        'filecache://' + os.path.join(BASE_DIR, 'cache', 'analytics') + '?MAX_ENTRIES=1000&TIMEOUT=86400',
+    ),
+    # rendered survey definitions, shared by all the workers
+    'definitions': env.cache_url(
+        'DEFINITIONS_CACHE_URL',
+        'filecache://' + os.path.join(BASE_DIR, 'cache', 'definitions') + '?MAX_ENTRIES=10000&TIMEOUT=86400',
+    ),
+}
+# seconds between two live statistics events of a survey, bursts of responses are coalesced
+SURVEY_LIVE_STATISTICS_INTERVAL = env.float('SURVEY_LIVE_STATISTICS_INTERVAL', 2.0)
+# seconds clients may reuse a survey definition without revalidating its ETag
+SURVEY_DEFINITION_MAX_AGE = env.int('SURVEY_DEFINITION_MAX_AGE', 60)
+
+## exports
+# background export jobs are run by a pool of threads of the serving process
+EXPORT_WORKERS = env.int('EXPORT_WORKERS', 2)
+# seconds after which an unfinished export job is considered lost and submitted again
+EXPORT_JOB_TIMEOUT = env.int('EXPORT_JOB_TIMEOUT', 3600)
+# worker processes rendering the pages of `mode=parallel` PDF exports
+EXPORT_PDF_PROCESSES = env.int('EXPORT_PDF_PROCESSES', os.cpu_count() or 1)
 
 ## CORS
 CORS_ALLOW_ALL_ORIGINS = True